@@ -8,6 +8,7 @@ import time
 import pdb
 from datetime import datetime
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import boto3
 
 import config
@@ -107,7 +108,39 @@ Cloudwatch GetMetricData, DynamoDB queries...)
 It disables completly CloneSquad. While disabled, the Lambda will continue to be started every minute to test
 if this flag changed its status and allow normal operation again."""
                },
-           "app.archive_interact_events": "0"
+           "app.archive_interact_events": "0",
+           "app.fast_path.enable,Stable": {
+                "DefaultValue": 0,
+                "Format": "Bool",
+                "Description": """Enable the Main function fast path when nothing changed.
+
+When enabled, the Main function computes a fingerprint of its inputs (fleet inventory and instance statuses, target health,
+alarm states, band of the scale score computed from the polled alarm metrics and compiled configuration). If the fingerprint 
+matches the one of the previous run, the fleet was stable at the end of the latest full run and 
+[`app.fast_path.max_skip_duration`](#appfast_pathmax_skip_duration) is not elapsed, the scheduling stages (SSM, target groups, 
+instance scheduling, alarms, RDS, TransferFamily, dashboard and interact data) are skipped. Metrics are still published.
+
+The scale score band is either 'scaleout' (score >= 1.0), 'scalein' (score below 
+`ec2.schedule.scalein.threshold_ratio`) or 'steady': Metric variations inside a band 
+do not trigger a full run. Trends leading to a predictive scaleout inside the 'steady' band are detected within 
+[`app.fast_path.max_skip_duration`](#appfast_pathmax_skip_duration).
+
+Only periodic invocations (scheduled event and SQS heartbeat messages) can take the fast path: Any other event 
+(ex: Spot notification) forces a full run.
+
+> Inputs are gathered before the fast path decision: The fast path saves the scheduling stages and their API calls 
+(start/stop, target group, alarm and dashboard management) but not the inventory and metric polling.
+
+The decision and its reasons are logged at each run and stored in the 'ec2.schedule.fast_path.state' key of the State table."""
+               },
+           "app.stages.max_concurrency": "4",
+           "app.fast_path.max_skip_duration,Stable": {
+                "DefaultValue": "minutes=2",
+                "Format": "Duration",
+                "Description": """Maximum duration without a full Main run when the fast path is enabled.
+
+Time-based algorithms (instance bouncing, cooldowns...) are evaluated at least at this period."""
+               }
         })
 
     log.debug("Setup management objects.")
@@ -135,6 +168,128 @@ if this flag changed its status and allow normal operation again."""
     ctx["o_transferfamily"]  = transferfamily.TransferFamily(ctx, ctx["o_state"], ctx["o_cloudwatch"])
 
 
+def get_main_run_fingerprint():
+    """ Return a digest of all the inputs that could lead the Main function to take a new decision.
+    """
+    o_ec2     = ctx["o_ec2"]
+    inventory = [(i["InstanceId"], i["State"]["Name"], i["InstanceType"], o_ec2.get_scaling_state(i["InstanceId"]))
+                    for i in o_ec2.get_instances()]
+    statuses  = [(s["InstanceId"], s.get("InstanceStatus", {}).get("Status"), s.get("SystemStatus", {}).get("Status"))
+                    for s in o_ec2.get_instance_statuses()]
+    targets   = [(t["Target"].get("Id"), t["TargetHealth"]["State"]) 
+                    for tg in ctx["o_targetgroup"].get_registered_targets(nolog=True) for t in tg]
+    alarms    = sorted((name, a.get("StateValue")) for name, a in ctx["o_cloudwatch"].get_alarm_data_index().items())
+    # Polled metric values change at almost every run: They are only taken into account through the band of 
+    #   the scale score they produce (see EC2_Schedule.get_guilties_sum_points()).
+    band      = ctx["o_ec2_schedule"].get_scale_score_band()
+    return misc.sha256(f"{inventory}|{statuses}|{targets}|{alarms}|{band}|{Cfg.fingerprint()}")
+
+def get_non_periodic_event_reasons(event):
+    """ Return the reasons why the Lambda event is not a periodic invocation of the Main function.
+
+    Periodic invocations are the EventBridge scheduled event and the 'CallMeBack' SQS heartbeat messages: They are
+    eligible to the fast path. Spot notifications are reported by sqs.process_sqs_records() and force a full run separately.
+
+    :param event: The Lambda event
+    :return A list of reasons (empty for a periodic invocation)
+    """
+    if event is None or len(event) == 0:
+        return []
+    if event.get("source") == "aws.events" and event.get("detail-type") == "Scheduled Event":
+        return []
+    if "Records" not in event:
+        return ["Called by an unexpected event"]
+    reasons = []
+    for r in event["Records"]:
+        try:
+            body = json.loads(r["body"]) if r.get("eventSource") == "aws:sqs" else {}
+        except:
+            body = {}
+        if not isinstance(body, dict) or "SQSHeartBeat" not in body:
+            reasons.append("Called by a non-periodic event (%s)" % r.get("eventSource"))
+            break
+    return reasons
+
+def evaluate_fast_path(event, forced_full_run, fast_path_state):
+    """ Decide if the current Main run can take the fast path.
+
+    :param event:               The Lambda event
+    :param forced_full_run:     'True' if a full run is required (ex: Spot notification received)
+    :param fast_path_state:     The fast path state recorded by previous runs (updated with the new fingerprint)
+    :return A tuple (fast_path, reasons) where 'reasons' explains the decision
+    """
+    now         = ctx["now"]
+    fingerprint = get_main_run_fingerprint()
+    previous    = fast_path_state.get("Fingerprint")
+    fast_path_state["Fingerprint"] = fingerprint
+
+    reasons = []
+    if forced_full_run:
+        reasons.append("Full run forced by SQS notification")
+    reasons.extend(get_non_periodic_event_reasons(event))
+    if fingerprint != previous:
+        reasons.append("Inputs changed since previous run")
+    if not fast_path_state.get("Stable", False):
+        reasons.append("Fleet was not stable after latest full run (%s)" % ", ".join(fast_path_state.get("UnstableReasons", [])))
+    last_full_run = misc.str2utc(fast_path_state.get("LastFullRunDate"), default=misc.epoch())
+    if (now - last_full_run).total_seconds() >= Cfg.get_duration_secs("app.fast_path.max_skip_duration"):
+        reasons.append("app.fast_path.max_skip_duration elapsed since latest full run")
+    if len(reasons):
+        return (False, reasons)
+    return (True, ["Fleet inventory, target health, alarm states, scale score band and configuration unchanged since %s" % last_full_run])
+
+def run_stages(stages):
+    """ Run Main pipeline stages as soon as the stages they depend on are done.
+
+    Independent stages run concurrently on a thread pool of 'app.stages.max_concurrency' workers (1 means serial
+    execution in declaration order). A stage is skipped when one of its dependencies failed or was skipped (ex: instances
+    are not scheduled when target group management failed) while independent stages still perform.
+
+    :param stages: An ordered list of tuples (stage_name, function, [names of stages to run before])
+    :return A dict {stage_name: {"Duration": seconds, "Exception": exception or None, "Skipped": bool}}
+    """
+    results      = {}
+    max_workers  = max(1, Cfg.get_int("app.stages.max_concurrency"))
+    trace_entity = xray_recorder.get_trace_entity()
+
+    def _run(name, func, deps, in_thread):
+        failed_deps = [d for d in deps if results[d]["Exception"] is not None or results[d]["Skipped"]]
+        if len(failed_deps):
+            log.warning(f"Main stage '{name}' skipped as stage(s) {failed_deps} did not complete!")
+            return {"Duration": 0.0, "Exception": None, "Skipped": True}
+        if in_thread:
+            xray_recorder.set_trace_entity(trace_entity)
+        log.debug(f"Main - {name}()")
+        start_time = time.time()
+        exception  = None
+        try:
+            func()
+        except Exception as e:
+            log.exception(f"Main stage '{name}' failed!")
+            exception = e
+        return {"Duration": time.time() - start_time, "Exception": exception, "Skipped": False}
+
+    if max_workers == 1:
+        for name, func, deps in stages:
+            results[name] = _run(name, func, deps, False)
+        return results
+
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while len(pending) or len(running):
+            for stage in list(pending):
+                name, func, deps = stage
+                if all(d in results for d in deps):
+                    pending.remove(stage)
+                    running[pool.submit(_run, name, func, deps, True)] = name
+            if not len(running):
+                raise Exception("Unresolvable Main stage dependencies: %s" % [s[0] for s in pending])
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+    return results
+
 @xray_recorder.capture()
 def main_handler(event, context):
     log.debug("Handler start.")
@@ -205,31 +360,60 @@ def main_handler_entrypoint(event, context):
 
     Cfg.dump()
 
+    # Check if we can skip scheduling stages because nothing changed since the previous run
+    fast_path       = False
+    fast_path_state = None
+    if Cfg.get_int("app.fast_path.enable"):
+        fast_path_state    = ctx["o_ec2"].get_state_json("ec2.schedule.fast_path.state", default={})
+        fast_path, reasons = evaluate_fast_path(event, no_is_called_too_early, fast_path_state)
+        fast_path_state["LastDecision"] = {"Date": str(ctx["now"]), "FastPath": fast_path, "Reasons": reasons}
+        log.info("Fast path %s: %s" % ("taken (scheduling stages skipped)" if fast_path else "not taken", "; ".join(reasons)))
+
     # Perform actions:
     log.debug("Main processing.")
-    log.debug("Main - prepare_ssm()")
-    ctx["o_ssm"].prepare_ssm()
-    log.debug("Main - manage_targetgroup()")
-    ctx["o_targetgroup"].manage_targetgroup()
-    log.debug("Main - schedule_instances()")
-    ctx["o_ec2_schedule"].schedule_instances()
-    log.debug("Main - configure_alarms()")
-    ctx["o_cloudwatch"].configure_alarms()
-    log.debug("Main - RDS - manage_subfleet()")
-    ctx["o_rds"].manage_subfleet()
-    log.debug("Main - TransferFamily - manage_subfleet()")
-    ctx["o_transferfamily"].manage_subfleet()
-    log.debug("Main - prepara_metrics()")
-    ctx["o_ec2_schedule"].prepare_metrics()
-    log.debug("Main - send_metrics()")
-    ctx["o_cloudwatch"].send_metrics()
-    log.debug("Main - send_events()")
-    ctx["o_ec2_schedule"].send_events()
-
-    log.debug("Main - configure_dashboard()")
-    ctx["o_cloudwatch"].configure_dashboard()
-    log.debug("Main - pregenerate_interact_data()")
-    ctx["o_interact"].pregenerate_interact_data()
+    if fast_path:
+        log.debug("Main - load_scale_scores()")
+        ctx["o_ec2_schedule"].load_scale_scores()
+        log.debug("Main - prepara_metrics()")
+        ctx["o_ec2_schedule"].prepare_metrics()
+        log.debug("Main - send_metrics()")
+        ctx["o_cloudwatch"].send_metrics()
+    else:
+        # Stages are declared with the stages they depend on. Fleet scaling stages form the critical path while
+        #   RDS, TransferFamily and dashboard management run aside.
+        stage_results = run_stages([
+            ("prepare_ssm",                   ctx["o_ssm"].prepare_ssm,                   []),
+            ("manage_targetgroup",            ctx["o_targetgroup"].manage_targetgroup,    ["prepare_ssm"]),
+            ("schedule_instances",            ctx["o_ec2_schedule"].schedule_instances,   ["manage_targetgroup"]),
+            ("rds.manage_subfleet",           ctx["o_rds"].manage_subfleet,               []),
+            ("transferfamily.manage_subfleet",ctx["o_transferfamily"].manage_subfleet,    []),
+            ("configure_dashboard",           ctx["o_cloudwatch"].configure_dashboard,    []),
+            ("configure_alarms",              ctx["o_cloudwatch"].configure_alarms,       ["schedule_instances"]),
+            ("prepare_metrics",               ctx["o_ec2_schedule"].prepare_metrics,      ["schedule_instances"]),
+            ("send_metrics",                  ctx["o_cloudwatch"].send_metrics,           
+                ["prepare_metrics", "rds.manage_subfleet", "transferfamily.manage_subfleet"]),
+            ("send_events",                   ctx["o_ec2_schedule"].send_events,          ["schedule_instances"]),
+            ("pregenerate_interact_data",     ctx["o_interact"].pregenerate_interact_data,
+                ["configure_alarms", "send_metrics", "send_events", "configure_dashboard"]),
+        ])
+        log.info("Main stage durations: %s" % ", ".join("%s=%.2fs" % (name, r["Duration"]) for name, r in stage_results.items()))
+        failed_stages = [name for name, r in stage_results.items() if r["Exception"] is not None]
+        if len(failed_stages):
+            log.error("Main stages %s failed!" % failed_stages)
+            raise stage_results[failed_stages[0]]["Exception"]
+
+        if fast_path_state is not None:
+            unstable_reasons = ctx["o_ec2_schedule"].get_unstable_reasons()
+            if ctx["o_targetgroup"].is_state_changed():
+                unstable_reasons.append("Target group registrations changed during the run")
+            fast_path_state.update({
+                "LastFullRunDate": str(ctx["now"]),
+                "Stable": len(unstable_reasons) == 0,
+                "UnstableReasons": unstable_reasons
+            })
+
+    if fast_path_state is not None:
+        ctx["o_ec2"].set_state_json("ec2.schedule.fast_path.state", fast_path_state)
 
     # If we got woke up by SNS, acknowledge the message(s) now
     sqs.process_sqs_records(ctx, event)
@@ -1,9 +1,11 @@
 import os
 import re
+import math
 import json
 import yaml
 from datetime import datetime, timezone, timedelta
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 import base64
 import boto3
 
@@ -26,6 +28,8 @@ class CloudWatch:
         self.context = context                   
         self.ec2 = ec2
         self.alarms = None
+        self.alarm_index = {}
+        self.alarm_name_resolver = None
         self.metrics = []
         Cfg.register({
                     "cloudwatch.describe_alarms.max_results" : "50",
@@ -52,6 +56,73 @@ It support regex patterns.
                     "cloudwatch.metrics.cache.max_retention_period": "minutes=15",
                     "cloudwatch.metrics.instance_minimum_age_for_cpu_credit_polling": "minutes=10",
                     "cloudwatch.metrics.minimum_polled_alarms_per_run": "1",
+                    "cloudwatch.metrics.adaptive_polling.enable,Stable": {
+                        "DefaultValue": "1",
+                        "Format": "Bool",
+                        "Description": """Enable prioritization of alarm metric polling based on per-metric staleness budgets.
+
+Each alarm metric gets a staleness budget between [`app.run_period`](#apprun_period) and 
+[`cloudwatch.metrics.time_for_full_metric_refresh`](#cloudwatchmetricstime_for_full_metric_refresh). The budget shrinks when 
+the latest metric value gets close to the alarm threshold, relatively to the metric volatility (see 
+[`cloudwatch.metrics.adaptive_polling.volatility_factor`](#cloudwatchmetricsadaptive_pollingvolatility_factor)).
+
+At each run, alarms whose budget is expired are polled first, the most expired first. The remaining per-run polling capacity
+is filled with the oldest sampled alarms, so the same number of alarm metrics is polled at each run as when this setting is 
+disabled. When disabled, alarm metrics are polled from the oldest to the newest.
+                        """
+                    },
+                    "cloudwatch.metrics.adaptive_polling.volatility_factor,Stable": {
+                        "DefaultValue": "3.0",
+                        "Format": "Float",
+                        "Description": """Number of standard deviations of an alarm metric considered as 'close' to the alarm threshold.
+
+The staleness budget of an alarm metric is computed as:
+
+    closeness = distance / (distance + volatility_factor * stddev)
+    budget    = app.run_period + (time_for_full_metric_refresh - app.run_period) * closeness
+
+where 'distance' is the relative distance between the latest metric value and the alarm threshold and 'stddev' the relative 
+standard deviation of the metric (see [`cloudwatch.metrics.adaptive_polling.ewma_alpha`](#cloudwatchmetricsadaptive_pollingewma_alpha)).
+Increasing this value makes polling more aggressive for volatile metrics.
+                        """
+                    },
+                    "cloudwatch.metrics.adaptive_polling.ewma_alpha,Stable": {
+                        "DefaultValue": "0.3",
+                        "Format": "Float",
+                        "Description": """Smoothing factor of the alarm metric volatility.
+
+The volatility of each alarm metric is an exponentially weighted moving variance updated at each new sample. Values close
+to 1.0 make the volatility follow quickly the latest samples while values close to 0.0 give more weight to the history.
+                        """
+                    },
+                    "cloudwatch.metrics.get_metric_data.max_concurrency": "4",
+                    "cloudwatch.metrics.aggregation.mode,Stable": {
+                        "DefaultValue": "",
+                        "Format": "String",
+                        "Description": """Fetch instance alarm metrics as fleet-wide aggregates.
+
+When set to `Average`, instance alarms created from the same alarm definition and watching the same `InstanceId` dimensioned 
+metric are fetched with `AVG(SEARCH(...))` metric math expressions instead of one GetMetricData query per instance. The fleet 
+average is then used as the metric of each of these alarms. Aggregated alarms are polled at each run.
+
+As CloudWatch bills SEARCH expressions per metric returned by the search, this setting does not reduce the GetMetricData cost:
+It can even increase it as all aggregated instance metrics are fetched at each run instead of a part of them (see
+[`cloudwatch.metrics.time_for_full_metric_refresh`](#cloudwatchmetricstime_for_full_metric_refresh)). The `Cloudwatch.GetMetricData` 
+metric accounts for one query per aggregated instance. It reduces the number of queries sent and keeps all instance metrics fresh 
+but instance level metric spikes are smoothed by the average.
+
+An empty value disables aggregation.
+                        """
+                    },
+                    "cloudwatch.metrics.aggregation.max_expression_length,Stable": {
+                        "DefaultValue": "1000",
+                        "Format": "Integer",
+                        "Description": """Maximum length of the SEARCH query string of an aggregate expression.
+
+Large fleets are split in several SEARCH expressions combined by CloneSquad. The value is capped to 1024, the maximum
+length accepted by CloudWatch.
+                        """
+                    },
                     "cloudwatch.metrics.time_for_full_metric_refresh,Stable": {
                         "DefaultValue": "minutes=1,seconds=30",
                         "Format": "Duration",
@@ -101,6 +172,10 @@ See [Alarm specification documentation](ALARMS_REFERENCE.md)  for more details.
                      { "MetricName": "Cloudwatch.GetMetricData",
                        "Unit": "Count",
                        "StorageResolution": 60 
+                     },
+                     { "MetricName": "Cloudwatch.GetMetricDataBudgetUsage",
+                       "Unit": "Percent",
+                       "StorageResolution": 60 
                      }])
 
         self.ec2.register_state_aggregates([
@@ -156,29 +231,40 @@ See [Alarm specification documentation](ALARMS_REFERENCE.md)  for more details.
             alarm_definitions[index] = alarm_defs
 
         self.alarm_definitions = alarm_definitions
+        self.compile_alarm_name_resolver()
 
 
-        # Read all existing CloudWatch alarms
-        alarms = []
-        paginator = client.get_paginator('describe_alarms')
-        response_iterator = paginator.paginate(MaxRecords=Cfg.get_int("cloudwatch.describe_alarms.max_results"))
-        for response in response_iterator:
-            #log.debug(Dbg.pprint(response))
-            for alarm in response["MetricAlarms"]:
-                alarm_name = alarm["AlarmName"]
-                alarm_def  = self.get_alarm_configuration_by_name(alarm_name)
-                if alarm_def is not None:
-                    # This is an alarm thats belong to this CloneSquad instance
-                    alarms.append(alarm)
+        # Read existing CloudWatch alarms: Only alarms with a name prefix that can match an alarm definition are paged in
+        alarms      = []
+        alarm_names = set()
+        paginator   = client.get_paginator('describe_alarms')
+        for prefix in self.get_alarm_name_prefixes():
+            args = {"MaxRecords": Cfg.get_int("cloudwatch.describe_alarms.max_results")}
+            if prefix != "": args["AlarmNamePrefix"] = prefix
+            response_iterator = paginator.paginate(**args)
+            for response in response_iterator:
+                #log.debug(Dbg.pprint(response))
+                for alarm in response["MetricAlarms"]:
+                    alarm_name = alarm["AlarmName"]
+                    if alarm_name in alarm_names:
+                        continue
+                    alarm_def  = self.get_alarm_configuration_by_name(alarm_name)
+                    if alarm_def is not None:
+                        # This is an alarm thats belong to this CloneSquad instance
+                        alarms.append(alarm)
+                        alarm_names.add(alarm_name)
         #log.debug(Dbg.pprint(alarms))
-        self.alarms = alarms
+        self.alarms      = alarms
+        self.alarm_index = {}
+        for a in alarms:
+            self.alarm_index.setdefault(a["AlarmName"], a)
 
         # Sanity check
         for index in self.alarm_definitions.keys():
             alarm_def = self.alarm_definitions[index]
             if "AlarmName" not in alarm_def:
                 continue
-            alarm = next(filter(lambda a: a["AlarmName"] == alarm_def["AlarmName"], self.alarms), None)
+            alarm = self.alarm_index.get(alarm_def["AlarmName"])
             if alarm is None:
                 log.warning("Alarm definition [%s](%s => %s) doesn't match an existing CloudWatch alarm!" % 
                         (alarm_def["Definition"]["Key"], alarm_def["Definition"]["Value"], alarm_def["Definition"]["Status"]))
@@ -196,27 +282,36 @@ See [Alarm specification documentation](ALARMS_REFERENCE.md)  for more details.
         instance_scale_score      = self.ec2.get_integrated_float_state("ec2.schedule.scaleout.instance_scale_score", integration_period)
 
         self.metric_cache         = self.get_metric_cache()
+        self.metric_cache_changed = False
+        now_secs                  = misc.seconds_from_epoch_utc(now=now)
 
         query = {
                 "IdMapping": {},
                 "Queries"  : []
             }
+        aggregates = {}
 
         # Build query for Alarm metrics
         if Cfg.get("ec2.schedule.desired_instance_count") == "-1":
             # Sort by oldest alarms first in cache
-            cached_metric_names   = [ m["_MetricId"] for m in self.metric_cache]
             valid_alarms          = []
             for a in alarms:
                 alarm_name = a["AlarmName"]
                 alarm_def  = self.get_alarm_configuration_by_name(alarm_name)
                 if alarm_def is None or alarm_def["AlarmDefinition"]["Url"].startswith("alarmname:"):
                     continue
-                a["_SamplingTime"] = self.get_metric_by_id(alarm_name)["_SamplingTime"] if alarm_name in cached_metric_names else str(misc.epoch())
+                cached_metric      = self.metric_cache.get(alarm_name)
+                a["_SamplingTime"] = cached_metric["_SamplingTime"] if cached_metric is not None else 0
                 valid_alarms.append(a)
-            sorted_alarms = sorted(valid_alarms, key=lambda a: misc.str2utc(a["_SamplingTime"]))
 
-            # We poll from the oldest to the newest and depending on the instance_scale_score to limit CloudWacth GetMetricData costs
+            # Fleet-wide aggregates are cheap to query: They are polled at each run
+            aggregation_mode = Cfg.get("cloudwatch.metrics.aggregation.mode")
+            if aggregation_mode != "":
+                aggregates   = self.format_aggregate_queries(query, valid_alarms, aggregation_mode)
+                valid_alarms = [a for a in valid_alarms if "_Aggregate" not in a]
+            sorted_alarms = sorted(valid_alarms, key=lambda a: a["_SamplingTime"])
+
+            # The number of alarms polled per run depends on the instance_scale_score to limit CloudWacth GetMetricData costs
             time_for_full_metric_refresh  = max(Cfg.get_duration_secs("cloudwatch.metrics.time_for_full_metric_refresh"), 1)
             app_run_period                = Cfg.get_duration_secs("app.run_period")
             minimum_polled_alarms_per_run = Cfg.get_int("cloudwatch.metrics.minimum_polled_alarms_per_run")
@@ -224,9 +319,18 @@ See [Alarm specification documentation](ALARMS_REFERENCE.md)  for more details.
             maximum_polled_alarms_per_run = min(maximum_polled_alarms_per_run, 1.0)
             weight                        = min(instance_scale_score, maximum_polled_alarms_per_run)
             max_alarms_for_this_run       = max(minimum_polled_alarms_per_run, int(min(weight, 1.0) * len(sorted_alarms)))
-            for alarm in sorted_alarms[:max_alarms_for_this_run]:
+            if Cfg.get_int("cloudwatch.metrics.adaptive_polling.enable"):
+                # Poll the alarms with the most expired staleness budget first then the oldest ones
+                polled_alarms, expired_alarms = self.get_prioritized_alarms(sorted_alarms, now_secs, max_alarms_for_this_run)
+            else:
+                # We poll from the oldest to the newest
+                polled_alarms  = sorted_alarms[:max_alarms_for_this_run]
+                expired_alarms = len(polled_alarms)
+            for alarm in polled_alarms:
                 alarm_name          = alarm["AlarmName"]
                 CloudWatch._format_query(query, alarm_name, alarm)
+            self.set_metric("Cloudwatch.GetMetricDataBudgetUsage", 
+                    100.0 * expired_alarms / max_alarms_for_this_run if max_alarms_for_this_run else 0.0)
 
             # We always poll user supplied alarms
             for alarm in alarms:
@@ -251,17 +355,28 @@ See [Alarm specification documentation](ALARMS_REFERENCE.md)  for more details.
 
             if (now - i["LaunchTime"]).total_seconds() < instance_minimum_age_for_cpu_credit_polling:
                 continue
-            cached_metric = self.get_metric_by_id(f"CPUCreditBalance/{instance_id}")
-            if cached_metric is not None:
+            cached_metric = self.metric_cache.get(f"CPUCreditBalance/{instance_id}")
+            if self.ec2.is_cpu_credit_projected(i):
+                # The scheduler works with projected balances for draining instances: Only poll when the last observation is too old
+                if not self.ec2.is_cpu_credit_polling_needed(i):
+                    continue
+                if (cached_metric is not None and cached_metric.get("_LastSamplingAttempt") is not None and
+                        now_secs - cached_metric["_LastSamplingAttempt"] < misc.str2duration_seconds("minutes=1")):
+                    continue # We do not want to poll more than one per minute
+                if cached_metric is not None: 
+                    cached_metric["_LastSamplingAttempt"] = now_secs
+                    self.metric_cache_changed             = True
+            elif cached_metric is not None:
                 # Note: Polling of CPU Credit Balance is a bit tricky as this API takes a lot of time to update and sometime
                 #   do send back results from time to time. So we need to try multiple times...
-                if ("_LastSamplingAttempt" in cached_metric and 
-                        (now - misc.str2utc(cached_metric["_LastSamplingAttempt"])).total_seconds() < misc.str2duration_seconds("minutes=1")):
+                if (cached_metric.get("_LastSamplingAttempt") is not None and 
+                        now_secs - cached_metric["_LastSamplingAttempt"] < misc.str2duration_seconds("minutes=1")):
                     continue # We do not want to poll more than one per minute
-                if (now - misc.str2utc(cached_metric["_SamplingTime"])).total_seconds() < max_retention_period * 0.8:
+                if now_secs - cached_metric["_SamplingTime"] < max_retention_period * 0.8:
                     # Current data point is not yet expired. Keep of this attempt
                     continue
-                cached_metric["_LastSamplingAttempt"] = now
+                cached_metric["_LastSamplingAttempt"] = now_secs
+                self.metric_cache_changed             = True
             cpu_credit_polling += 1
             CloudWatch._format_query(query, "%s/%s" % ("CPUCreditBalance", instance_id), {
                     "MetricName": "CPUCreditBalance",
@@ -275,26 +390,37 @@ See [Alarm specification documentation](ALARMS_REFERENCE.md)  for more details.
                 })
         log.log(log.NOTICE, f"Will poll {cpu_credit_polling} instances for CPU Credit balance.")
 
-        # Make request to CloudWatch
+        # Make request to CloudWatch: Batches of 500 queries are sent concurrently
         query_counter  = self.ec2.get_state_int("cloudwatch.metric.query_counter", default=0)
         queries        = query["Queries"]
-        metric_results = []
-        metric_ids     = []
-        no_metric_ids  = []
-        while len(queries) > 0:
-            q        = queries[:500]
-            queries  = queries[500:]
-            results  = []
-            args = {
-                "MetricDataQueries" : q,
-                "StartTime" : now - timedelta(seconds=Cfg.get_duration_secs("cloudwatch.metrics.data_period")),
-                "EndTime" : now
-            }
+        batches        = [queries[i:i+500] for i in range(0, len(queries), 500)]
+        trace_entity   = xray_recorder.get_trace_entity()
+        def _get_metric_data(q):
+            xray_recorder.set_trace_entity(trace_entity)
+            results   = []
+            pages     = 0
             paginator = client.get_paginator('get_metric_data')
-            response_iterator = paginator.paginate(**args)
+            response_iterator = paginator.paginate(
+                MetricDataQueries=q,
+                StartTime=now - timedelta(seconds=Cfg.get_duration_secs("cloudwatch.metrics.data_period")),
+                EndTime=now
+            )
             for response in response_iterator:
                 results.extend(response["MetricDataResults"])
-                query_counter += len(q)
+                pages += 1
+            return (q, results, pages)
+
+        metric_results = {}
+        no_metric_ids  = []
+        cpu_credit_observations = {}
+        aggregate_results       = defaultdict(list)
+        max_workers    = max(1, min(Cfg.get_int("cloudwatch.metrics.get_metric_data.max_concurrency"), len(batches)))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            batch_results = list(pool.map(_get_metric_data, batches))
+        for q, results, pages in batch_results:
+            # SEARCH expressions are billed per metric returned by the search
+            query_counter += sum(aggregates[query["IdMapping"][m["Id"]]]["InstanceCount"] 
+                    if query["IdMapping"][m["Id"]] in aggregates else 1 for m in q) * pages
 
             for r in results:
                 if r["StatusCode"] != "Complete":
@@ -304,41 +430,51 @@ See [Alarm specification documentation](ALARMS_REFERENCE.md)  for more details.
                 if len(r["Timestamps"]) == 0:
                     if metric_id not in no_metric_ids: no_metric_ids.append(metric_id)
                     continue
-                if metric_id not in metric_ids: metric_ids.append(metric_id)
-                r["_MetricId"]     = metric_id
-                r["_SamplingTime"] = str(now)
                 log.debug(r)
-                metric_results.append(r)
+                if metric_id in aggregates:
+                    aggregate_results[aggregates[metric_id]["Group"]].append((aggregates[metric_id], r))
+                    continue
+                if metric_id in metric_results:
+                    continue # First result wins
+                metric_results[metric_id] = CloudWatch._make_metric_record(metric_id, now_secs,
+                        [misc.seconds_from_epoch_utc(now=t) for t in r["Timestamps"]], r["Values"])
+                if metric_id.startswith("CPUCreditBalance/"):
+                    # Remember newly observed CPU Credit balances for projection
+                    cpu_credit_observations[metric_id.split("/")[1]] = (r["Values"][0], r["Timestamps"][0])
         if len(no_metric_ids):
             log.info(f"No metrics returned for alarm '{no_metric_ids}'")
+        # Fleet-wide aggregates are spread as the metric of each alarm of the aggregated fleet
+        metric_results.update(self.get_aggregate_metric_records(aggregate_results, now_secs))
 
         # Merge with existing cache metric
-        metric_cache      = self.metric_cache
-        self.metric_cache = metric_results
-        for m in metric_cache:
-            if m["_MetricId"] in metric_ids or "_SamplingTime" not in m: 
-                continue
-            if (now - misc.str2utc(m["_SamplingTime"])).total_seconds() < max_retention_period:
-                    self.metric_cache.append(m)
+        for metric_id, m in list(self.metric_cache.items()):
+            if metric_id not in metric_results and now_secs - m["_SamplingTime"] >= max_retention_period:
+                del self.metric_cache[metric_id]
+                self.metric_cache_changed = True
+        if len(metric_results):
+            alpha = min(max(Cfg.get_float("cloudwatch.metrics.adaptive_polling.ewma_alpha"), 0.0), 1.0)
+            for metric_id, m in metric_results.items():
+                CloudWatch._update_metric_volatility(m, self.metric_cache.get(metric_id), alpha)
+            self.metric_cache.update(metric_results)
+            self.metric_cache_changed = True
 
         self.ec2.set_state("cloudwatch.metric.query_counter"  , query_counter,     TTL=Cfg.get_duration_secs("cloudwatch.default_ttl"))
-        self.ec2.set_state_json("cloudwatch.metrics.cache"    , self.metric_cache, TTL=Cfg.get_duration_secs("cloudwatch.default_ttl"))
+        if self.metric_cache_changed:
+            self.save_metric_cache()
         self.set_metric("Cloudwatch.GetMetricData", query_counter)
 
-        # Augment Alarm definitions and Instances with associated metrics
-        for metric in self.metric_cache:
-            metric_id  = metric["_MetricId"]
+        self.ec2.record_cpu_credit_observations(cpu_credit_observations)
 
-            alarm_data = self.get_alarm_data_by_name(metric_id)
-            if alarm_data is not None : 
+        # Augment Alarm definitions and Instances with associated metrics
+        for alarm_data in self.alarms:
+            metric = self.metric_cache.get(alarm_data["AlarmName"])
+            if metric is not None:
                 alarm_data["MetricDetails"] = metric
-                continue
-            
-            instance   = next(filter(lambda i: "CPUCreditBalance/%s" % i["InstanceId"] == metric_id, burstable_instances), None)
-            if instance is not None:
+        for instance in burstable_instances:
+            metric = self.metric_cache.get("CPUCreditBalance/%s" % instance["InstanceId"])
+            if metric is not None:
                 instance["_Metrics"] = {}
                 instance["_Metrics"]["CPUCreditBalance"] = metric
-                continue
 
 
     def _format_query(query, metric_id, metric):
@@ -360,11 +496,217 @@ See [Alarm specification documentation](ALARMS_REFERENCE.md)  for more details.
         if "Unit"       in metric: q["MetricStat"]["Unit"]       = metric["Unit"]
         query["Queries"].append(q)
 
+    def get_staleness_budget(self, alarm, metric):
+        """ Return the maximum age (in seconds) that the cached metric of the specified alarm can reach before being polled again.
+
+        The budget shrinks when the latest metric value gets close to the alarm threshold, relatively to the metric volatility
+        (exponentially weighted moving variance of the sampled values): 
+            closeness = distance / (distance + volatility_factor * stddev)
+            budget    = app.run_period + (time_for_full_metric_refresh - app.run_period) * closeness
+        A metric sitting on its threshold or highly volatile is so polled at each run while a steady metric far from its
+        threshold is polled every 'cloudwatch.metrics.time_for_full_metric_refresh'. The budget is capped to this value as a
+        flat metric has no volatility: A sudden step of the load must not be seen later than with oldest first polling.
+        """
+        app_run_period = Cfg.get_duration_secs("app.run_period")
+        # The cached value must not expire before the next poll
+        max_staleness  = min(Cfg.get_duration_secs("cloudwatch.metrics.time_for_full_metric_refresh"),
+                Cfg.get_duration_secs("cloudwatch.metrics.cache.max_retention_period") * 0.8)
+        max_staleness  = max(max_staleness, app_run_period)
+        if metric is None or len(metric["Values"]) == 0 or "Threshold" not in alarm:
+            return max_staleness
+        threshold = float(alarm["Threshold"])
+        scale     = max(abs(threshold), abs(float(metric["Values"][0])), 0.000001)
+        distance  = abs(threshold - float(metric["Values"][0])) / scale
+        stddev    = math.sqrt(max(metric.get("_Variance", 0.0), 0.0)) / scale
+        factor    = Cfg.get_float("cloudwatch.metrics.adaptive_polling.volatility_factor")
+        if distance == 0:
+            return app_run_period
+        closeness = distance / (distance + factor * stddev)
+        return app_run_period + (max_staleness - app_run_period) * closeness
+
+    def get_prioritized_alarms(self, alarms, now_secs, max_polled_alarms):
+        """ Return the list of alarms to poll in this run.
+
+        Each alarm gets a priority equal to the age of its cached metric divided by its staleness budget (see get_staleness_budget()).
+        Alarms with an expired budget (priority >= 1.0) are returned first, highest priority first, up to 'max_polled_alarms' 
+        (the per-run GetMetricData cost budget). The unused part of this budget is filled with the oldest sampled alarms.
+
+        :param alarms: The candidate alarms sorted from the oldest sampled to the newest
+        :return A tuple (polled alarms, number of polled alarms with an expired budget)
+        """
+        priorities = []
+        for a in alarms:
+            metric = self.metric_cache.get(a["AlarmName"])
+            if metric is None:
+                priority = float("inf") # Never sampled
+            else:
+                priority = (now_secs - metric["_SamplingTime"]) / max(self.get_staleness_budget(a, metric), 1)
+            priorities.append((priority, a))
+        priorities.sort(key=lambda p: p[0], reverse=True) # Stable: Oldest sampled alarms first on priority ties
+        polled  = [a for priority, a in priorities[:max_polled_alarms] if priority >= 1.0]
+        expired = len(polled)
+        # Fill the remaining budget from the oldest to the newest
+        polled_names = set(a["AlarmName"] for a in polled)
+        polled.extend([a for a in alarms if a["AlarmName"] not in polled_names][:max_polled_alarms - expired])
+        log.log(log.NOTICE, f"Will poll {len(polled)} alarm metric(s) out of {len(alarms)} ({expired} with expired staleness budget, "
+                f"Budget={max_polled_alarms}).")
+        return polled, expired
+
+    def format_aggregate_queries(self, query, alarms, mode):
+        """ Add metric math queries fetching fleet-wide aggregates of instance alarm metrics.
+
+        Instance alarms created from the same alarm definition (same alarm index) and watching the same single 'InstanceId' 
+        dimensioned metric are grouped. Each group is fetched with 'AVG(SEARCH(...))' expressions instead of one query per 
+        instance. As SEARCH expressions are length limited, large groups are split in chunks combined later by 
+        get_aggregate_metric_records().
+
+        Only averages are supported: The aggregate is stored as the metric of every alarm of the group and so, scored as
+        many times as the group size by get_guilties_sum_points(). It is equivalent to scoring each instance metric for an
+        average but a maximum would be counted once per instance.
+
+        Grouped alarms are marked with an '_Aggregate' key.
+
+        :param query: The query structure to append queries to (see _format_query())
+        :param alarms: The candidate alarms
+        :param mode: Only 'Average' is supported
+        :return A dict {aggregate_metric_id: {"Group": group_key, "AlarmNames": [alarm names], "InstanceCount": chunk size}}
+        """
+        if mode != "Average":
+            log.warning(f"Unknown 'cloudwatch.metrics.aggregation.mode' value '{mode}'! Expecting 'Average'.")
+            return {}
+        groups = defaultdict(list)
+        for a in alarms:
+            alarm_def  = self.get_alarm_configuration_by_name(a["AlarmName"])
+            dimensions = a.get("Dimensions", [])
+            if ("InstanceId" not in alarm_def or "Statistic" not in a or len(dimensions) != 1 or 
+                    dimensions[0]["Name"] != "InstanceId" or dimensions[0]["Value"] != alarm_def["InstanceId"]):
+                continue
+            group_key = (alarm_def["AlarmDefinition"]["Index"], a["Namespace"], a["MetricName"], a["Period"], a["Statistic"])
+            groups[group_key].append(a)
+
+        def _search_query(namespace, metric_name, chunk):
+            terms = " OR ".join(f'InstanceId="{a["Dimensions"][0]["Value"]}"' for a in chunk)
+            return f'{{{namespace},InstanceId}} MetricName="{metric_name}" ({terms})'
+
+        aggregates = {}
+        # CloudWatch rejects SEARCH query strings longer than 1024 characters
+        max_length = min(Cfg.get_int("cloudwatch.metrics.aggregation.max_expression_length"), 1024)
+        for group_key, group_alarms in groups.items():
+            index, namespace, metric_name, period, statistic = group_key
+            chunks = [[]]
+            for a in group_alarms:
+                if len(chunks[-1]) and len(_search_query(namespace, metric_name, chunks[-1] + [a])) > max_length:
+                    chunks.append([])
+                chunks[-1].append(a)
+            for i, chunk in enumerate(chunks):
+                expression = f"AVG(SEARCH('{_search_query(namespace, metric_name, chunk)}', '{statistic}', {period}))"
+                metric_id  = f"Aggregate/{index}/{namespace}/{metric_name}/{period}/{statistic}/{i}"
+                uniq_id    = "id%s" % misc.sha256(metric_id)
+                query["IdMapping"][uniq_id] = metric_id
+                query["Queries"].append({
+                    "Id"        : uniq_id,
+                    "Expression": expression,
+                    "Period"    : period,
+                    "ReturnData": True
+                })
+                aggregates[metric_id] = {
+                    "Group": group_key,
+                    "AlarmNames": [a["AlarmName"] for a in chunk],
+                    "InstanceCount": len(chunk)
+                }
+                for a in chunk: a["_Aggregate"] = metric_id
+        if len(aggregates):
+            log.log(log.NOTICE, f"Will poll {len(aggregates)} fleet-wide aggregate(s) for {sum(len(g) for g in groups.values())} alarm(s).")
+        return aggregates
+
+    def get_aggregate_metric_records(self, aggregate_results, now_secs):
+        """ Combine chunked aggregate results and return a metric record for each alarm of the aggregated groups.
+
+        :param aggregate_results: A dict {group_key: [(aggregate, GetMetricData result)]}
+        :return A dict {alarm_name: metric record}
+        """
+        records = {}
+        for group_key, results in aggregate_results.items():
+            timestamp = max(r["Timestamps"][0] for aggregate, r in results)
+            count     = sum(aggregate["InstanceCount"] for aggregate, r in results)
+            value     = sum(float(r["Values"][0]) * aggregate["InstanceCount"] for aggregate, r in results) / count
+            alarm_names = [name for aggregate, r in results for name in aggregate["AlarmNames"]]
+            for alarm_name in alarm_names:
+                records[alarm_name] = CloudWatch._make_metric_record(alarm_name, now_secs, 
+                        [misc.seconds_from_epoch_utc(now=timestamp)], [value])
+        return records
+
+    def _update_metric_volatility(metric, previous_metric, alpha):
+        """ Update the exponentially weighted moving average and variance of a newly sampled metric.
+        """
+        value = float(metric["Values"][0])
+        if previous_metric is None or "_Mean" not in previous_metric:
+            metric["_Mean"]     = value
+            metric["_Variance"] = 0.0
+            return
+        delta               = value - previous_metric["_Mean"]
+        metric["_Mean"]     = previous_metric["_Mean"] + alpha * delta
+        metric["_Variance"] = (1 - alpha) * (previous_metric["_Variance"] + alpha * delta * delta)
+
+    def _make_metric_record(metric_id, sampling_time, timestamps, values, last_sampling_attempt=None, mean=None, variance=None):
+        record = {
+                "_MetricId": metric_id,
+                "_SamplingTime": sampling_time,
+                "Timestamps": timestamps,
+                "Values": values
+            }
+        if last_sampling_attempt is not None: record["_LastSamplingAttempt"] = last_sampling_attempt
+        if mean is not None:
+            record["_Mean"]     = mean
+            record["_Variance"] = variance
+        return record
+
     def get_metric_cache(self):
-        return self.ec2.get_state_json("cloudwatch.metrics.cache", [])
+        """ Return the persisted metric cache as a dict of metric records keyed by metric id.
+
+        Sampling times and data point timestamps are expressed in seconds since Epoch.
+        """
+        cache = self.ec2.get_state_json("cloudwatch.metrics.cache", {})
+        if isinstance(cache, list):
+            # Legacy format: A list of raw GetMetricData results with string dates
+            metrics = {}
+            for m in cache:
+                if "_MetricId" not in m or "_SamplingTime" not in m or m["_MetricId"] in metrics:
+                    continue
+                last_attempt = m.get("_LastSamplingAttempt")
+                metrics[m["_MetricId"]] = CloudWatch._make_metric_record(m["_MetricId"],
+                        misc.seconds_from_epoch_utc(now=misc.str2utc(m["_SamplingTime"])),
+                        [misc.seconds_from_epoch_utc(now=misc.str2utc(t)) for t in m.get("Timestamps", [])],
+                        m.get("Values", []),
+                        last_sampling_attempt=misc.seconds_from_epoch_utc(now=misc.str2utc(last_attempt)) if last_attempt else None)
+            return metrics
+        if not isinstance(cache, dict) or cache.get("Version") != 2:
+            return {}
+        return {metric_id: CloudWatch._make_metric_record(metric_id, m[0], m[2], m[3], last_sampling_attempt=m[1],
+                    mean=m[4] if len(m) > 5 else None, variance=m[5] if len(m) > 5 else None) 
+                for metric_id, m in cache["Metrics"].items()}
+
+    def save_metric_cache(self):
+        """ Persist the metric cache in a compact format: 
+                [SamplingTime, LastSamplingAttempt, Timestamps, Values(, Mean, Variance)] per metric id.
+        """
+        def _record(m):
+            r = [m["_SamplingTime"], m.get("_LastSamplingAttempt"), m["Timestamps"], m["Values"]]
+            if "_Mean" in m: r.extend([m["_Mean"], m["_Variance"]])
+            return r
+        cache = {
+                "Version": 2,
+                "Metrics": {metric_id: _record(m) for metric_id, m in self.metric_cache.items()}
+            }
+        self.ec2.set_state_json("cloudwatch.metrics.cache", cache, TTL=Cfg.get_duration_secs("cloudwatch.default_ttl"))
 
     def get_metric_by_id(self, metric_id):
-        return next(filter(lambda m: m["_MetricId"] == metric_id, self.metric_cache), None)
+        return self.metric_cache.get(metric_id)
+
+    def get_metric_index(self):
+        """ Return a dict of cached metrics indexed by metric id.
+        """
+        return self.metric_cache
 
     def _get_alarm_name(self, group_name, instance_id, index):
         return "CloneSquad-%s-%s-%02d" % (group_name, instance_id, index)
@@ -373,107 +715,222 @@ See [Alarm specification documentation](ALARMS_REFERENCE.md)  for more details.
         return [ a["AlarmName"] for a in self.alarms ]
 
     def get_alarm_data_by_name(self, alarm_name):
-        return next(filter(lambda alarm: alarm["AlarmName"] == alarm_name, self.alarms), None)
+        return self.alarm_index.get(alarm_name)
+
+    def get_alarm_data_index(self):
+        """ Return a dict of alarm data indexed by alarm name (first occurence wins).
+        """
+        return self.alarm_index
+
+    def compile_alarm_name_resolver(self):
+        """ Compile the regexes used by get_alarm_configuration_by_name() for the current alarm definitions.
+        """
+        user_alarms = []
+        for alarm_idx in self.alarm_definitions:
+            alarm_def = self.alarm_definitions[alarm_idx]
+            if "AlarmName" in alarm_def:
+                try:
+                    user_alarms.append((re.compile(alarm_def["AlarmName"]), alarm_def))
+                except Exception as e:
+                    log.error(f"Invalid alarm name regex '{alarm_def['AlarmName']}' in '{alarm_def['Key']}' : {e}")
+        self.alarm_name_resolver = {
+            "Managed": re.compile(r"^CloneSquad-%s-(i-[0-9a-z]+)-(\d\d)$" % re.escape(self.context["GroupName"])),
+            "UserAlarms": user_alarms,
+            "Cache": {}
+        }
+
+    def get_alarm_name_prefixes(self):
+        """ Return the list of alarm name prefixes to page in with CloudWatch.DescribeAlarms.
+
+        CloneSquad managed alarms are named 'CloneSquad-<GroupName>-'. User supplied alarms ('alarmname:' definitions) are 
+        regexes: Their leading literal part is used as prefix. When a regex has no usable literal prefix, all alarms of the
+        account have to be paged in (returned as an empty prefix).
+        """
+        prefixes = ["CloneSquad-%s-" % self.context["GroupName"]]
+        for regex, alarm_def in self.alarm_name_resolver["UserAlarms"]:
+            pattern = regex.pattern
+            prefix  = ""
+            if "|" not in pattern:
+                m      = re.match(r"^\^?([^.^$*+?{}\[\]\\|()]*)", pattern)
+                prefix = m.group(1)
+                # A quantifier makes the last literal character optional
+                if len(prefix) and len(pattern) > m.end() and pattern[m.end()] in "*?{":
+                    prefix = prefix[:-1]
+            if prefix == "":
+                log.log(log.NOTICE, f"Alarm name regex '{pattern}' has no literal prefix: All account alarms need to be described!")
+                return [""]
+            if not any(prefix.startswith(p) for p in prefixes):
+                prefixes.append(prefix)
+        return prefixes
 
     def get_alarm_configuration_by_name(self, alarm_name):
+        if self.alarm_name_resolver is None:
+            self.compile_alarm_name_resolver()
+        cache = self.alarm_name_resolver["Cache"]
+        if alarm_name in cache:
+            return cache[alarm_name]
+
         # First) Try to detect a CloneSquad managed alarm
-        try:
-            m = re.search('^CloneSquad-%s-(i-[0-9a-z]+)-(\d\d)$' % (self.context["GroupName"]), alarm_name)
-            return {
+        m = self.alarm_name_resolver["Managed"].match(alarm_name)
+        if m is not None and m.group(2) in self.alarm_definitions:
+            cache[alarm_name] = {
                 "InstanceId"      : m.group(1),
                 "AlarmDefinition" : self.alarm_definitions[m.group(2)]
             }
-        except: pass
+            return cache[alarm_name]
 
         # Second) Try to lookup an alarmname definition (regex based)
-        for alarm_idx in self.alarm_definitions:
-            alarm_def = self.alarm_definitions[alarm_idx]
-            if "AlarmName" in alarm_def:
-                if re.match(alarm_def["AlarmName"], alarm_name) is not None:
-                    return {
-                        "AlarmName"       : alarm_def["AlarmName"],
-                        "AlarmDefinition" : alarm_def
+        cache[alarm_name] = None
+        for regex, alarm_def in self.alarm_name_resolver["UserAlarms"]:
+            if regex.match(alarm_name) is not None:
+                cache[alarm_name] = {
+                    "AlarmName"       : alarm_def["AlarmName"],
+                    "AlarmDefinition" : alarm_def
+                }
+                break
+        return cache[alarm_name]
+
+    ALARM_SPEC_HASH_PATTERN  = r"\[clonesquad:spec-hash=([0-9a-f]+)\]"
+    # Must be a valid YAML plain scalar: A '{InstanceId}' marker would be parsed as a flow mapping
+    ALARM_INSTANCE_ID_MARKER = "__CLONESQUAD_INSTANCE_ID__"
+    # Alarm fields compared at each run to detect out-of-band modifications of alarms with an up-to-date specification hash
+    ALARM_CHECKED_FIELDS     = ["Threshold", "ComparisonOperator", "AlarmActions", "OKActions", "InsufficientDataActions"]
+
+    def get_alarm_template(self, alarm_definition):
+        """ Return the pre-parsed template of an alarm definition.
+
+        The YAML alarm definition is formatted with the context and parsed once. The 'InstanceId' placeholder is formatted 
+        as the ALARM_INSTANCE_ID_MARKER string substituted by render_alarm(). The template digest identifies the resulting alarm specification and 
+        is used to detect changes without rendering alarms (see get_alarm_spec_hash()).
+
+        :return A dict {"Alarm": parsed template, "Digest": sha256 digest} or None if the definition can't be used
+        """
+        if "_Template" in alarm_definition:
+            return alarm_definition["_Template"]
+        template = None
+        if "Content" in alarm_definition:
+            try:
+                kwargs = self.context.copy()
+                kwargs["InstanceId"] = CloudWatch.ALARM_INSTANCE_ID_MARKER
+                alarm = yaml.safe_load(alarm_definition["Content"].format(**kwargs))
+                # Add technical information to the alarm if not present in the loaded document.
+                tech_details = {
+                    "ActionsEnabled": True,
+                    "Dimensions": [{
+                        "Name": "InstanceId",
+                        "Value": CloudWatch.ALARM_INSTANCE_ID_MARKER
+                        }],
+                        "OKActions": [self.context["GenericOkActions_SNSTopicArn"]],
+                        "AlarmActions": [self.context["ScaleUp_SNSTopicArn"]],
+                        "InsufficientDataActions": [self.context["GenericInsufficientDataActions_SNSTopicArn"]],
+                        "Tags": [{
+                            "Key": "clonesquad:group-name",
+                            "Value": self.context["GroupName"]
+                            }]
                     }
-        return None
+                for d in tech_details:
+                    if d not in alarm: 
+                        alarm[d] = tech_details[d]
+                template = {
+                    "Alarm": alarm,
+                    "Digest": misc.sha256(json.dumps(alarm, sort_keys=True, default=str))
+                }
+            except Exception as e:
+                log.exception(f"[ERROR] Failed to read YAML alarm file '{alarm_definition['Url']}' : {e}")
+        alarm_definition["_Template"] = template
+        return template
+
+    def render_alarm(self, template, alarm_name, instance_id, spec_hash):
+        """ Return the PutMetricAlarm arguments of an instance alarm from a pre-parsed template.
+
+        The specification hash is recorded in the alarm description (CloudWatch does not return alarm Tags).
+        """
+        def _render(v):
+            if isinstance(v, str):  return v.replace(CloudWatch.ALARM_INSTANCE_ID_MARKER, instance_id)
+            if isinstance(v, dict): return {k: _render(x) for k, x in v.items()}
+            if isinstance(v, list): return [_render(x) for x in v]
+            return v
+        alarm = _render(template["Alarm"])
+        alarm["AlarmName"]        = alarm_name
+        description               = alarm["AlarmDescription"] if "AlarmDescription" in alarm else ""
+        alarm["AlarmDescription"] = f"{description} [clonesquad:spec-hash={spec_hash}]".strip()
+        return alarm
+
+    def get_alarm_spec_hash(self, template, instance_id):
+        return misc.sha256(f"{template['Digest']}:{instance_id}")
+
+    def is_alarm_up_to_date(self, existing_alarm, template, spec_hash):
+        """ Return 'True' if an existing alarm matches the desired specification.
+
+        The specification hash recorded in the alarm description is compared first. As the description is not updated by
+        out-of-band modifications of the alarm, the fields in ALARM_CHECKED_FIELDS are also compared with the template.
+        Other fields are not checked.
+        """
+        m = re.search(CloudWatch.ALARM_SPEC_HASH_PATTERN, existing_alarm.get("AlarmDescription", ""))
+        if m is None or m.group(1) != spec_hash:
+            return False
+        alarm = template["Alarm"]
+        for field in CloudWatch.ALARM_CHECKED_FIELDS:
+            if field not in alarm:
+                continue
+            expected, value = alarm[field], existing_alarm.get(field)
+            if field == "Threshold":
+                try:
+                    if float(expected) != float(value): return False
+                except (TypeError, ValueError):
+                    return False
+            elif isinstance(expected, list):
+                if sorted(expected) != sorted(value if isinstance(value, list) else []): return False
+            elif expected != value:
+                return False
+        return True
 
     @xray_recorder.capture()
     def configure_alarms(self):
         """ Configure Cloudwatch Alarms for each instance.
 
-            The algorithm needs to manage missing alarm as well updating existing alarms
+            The algorithm needs to manage missing alarm as well updating existing alarms. 
+            
+            An existing alarm is up-to-date when the specification hash recorded in its description matches the hash of 
+            the desired specification and its main fields were not modified out-of-band (see is_alarm_up_to_date()): Only 
+            missing or changed alarms are rendered and sent to CloudWatch. Put and delete calls are performed concurrently, 
+            'cloudwatch.metrics.max_update_per_batch' at most per run.
         """
         now    = self.context["now"]
         client = self.context["cloudwatch.client"]
 
-        valid_alarms = []
-        nb_of_updated_alarms = 0
+        valid_alarms = set()
+        actions      = []
         max_update_per_batch = Cfg.get_int("cloudwatch.metrics.max_update_per_batch")
+        min_instance_age     = Cfg.get_duration_secs("cloudwatch.alarms.min_instance_age")
 
         log.log(log.NOTICE, "Found following Alarm definition key(s) in configuration: %s" % [d for d in self.alarm_definitions])
+        templates = {}
+        for alarm_definition in self.alarm_definitions:
+            template = self.get_alarm_template(self.alarm_definitions[alarm_definition])
+            if template is not None:
+                templates[alarm_definition] = template
 
         # Step 1) Create or Update CloudWatch Alarms for running instances
         for instance in self.ec2.get_instances(State="pending,running", ScalingState="-error,draining,excluded"):
             instance_id = instance["InstanceId"]
 
             age_secs         = (now - instance["LaunchTime"]).total_seconds()
-            min_instance_age = Cfg.get_duration_secs("cloudwatch.alarms.min_instance_age")
             if age_secs < min_instance_age:
                 log.log(log.NOTICE, f"Instance '{instance_id}' too young. Wait %d seconds before to set an alarm..." % 
                         (min_instance_age - age_secs))
                 continue
 
             #Update alarms for this instance
-            for alarm_definition in self.alarm_definitions:
-                # First, check if an alarm already exists
-                alarm_name = self._get_alarm_name(self.context["GroupName"], instance["InstanceId"], int(alarm_definition))
-                existing_alarms = list(filter(lambda x: x['AlarmName'] == alarm_name, self.alarms))
-
-                # Load alarm template
-                try:
-                    if "Content" not in self.alarm_definitions[alarm_definition]:
-                        continue
-                    kwargs = self.context.copy()
-                    kwargs["InstanceId"] = instance_id
-                    alarm_template = self.alarm_definitions[alarm_definition]["Content"].format(**kwargs)
-                    alarm = yaml.safe_load(alarm_template)
-                    # Add technical information to the alarm if not present in the loaded document.
-                    tech_details = {
-                        "ActionsEnabled": True,
-                        "Dimensions": [{
-                            "Name": "InstanceId",
-                            "Value": instance_id
-                            }],
-                            "OKActions": [self.context["GenericOkActions_SNSTopicArn"]],
-                            "AlarmActions": [self.context["ScaleUp_SNSTopicArn"]],
-                            "InsufficientDataActions": [self.context["GenericInsufficientDataActions_SNSTopicArn"]],
-                            "Tags": [{
-                                "Key": "clonesquad:group-name",
-                                "Value": self.context["GroupName"]
-                                }]
-                        }
-                    for d in tech_details:
-                        if d not in alarm: 
-                            alarm[d] = tech_details[d]
-                except Exception as e:
-                    log.exception(f"[ERROR] Failed to read YAML alarm file '{alarm_template}' : {e}")
-                    continue
-                alarm["AlarmName"] = alarm_name
-
-                valid_alarms.append(alarm_name)
-
-                #Check if an alarm already exist
-                existing_alarm = None
-                if len(existing_alarms) > 0:
-                    existing_alarm = existing_alarms[0]
-                    
-                    # Check if alarm definition will be the same
-                    a = {**existing_alarm, **alarm}
-                    # 2020/07/20: CloudWatch Alarm API does not return Tags. Have to deal with
-                    #  while comparing the configurations.
-                    if "Tags" in a and "Tags" not in existing_alarm:
-                        del a["Tags"]
-                    if a == existing_alarm:
-                        #log.debug("Not updating alarm '%s' as configuration is already ok" % alarm_name)
+            for alarm_definition, template in templates.items():
+                alarm_name = self._get_alarm_name(self.context["GroupName"], instance_id, int(alarm_definition))
+                valid_alarms.add(alarm_name)
+
+                #Check if an alarm already exists with the same specification
+                spec_hash      = self.get_alarm_spec_hash(template, instance_id)
+                existing_alarm = self.alarm_index.get(alarm_name)
+                if existing_alarm is not None:
+                    if self.is_alarm_up_to_date(existing_alarm, template, spec_hash):
                         continue
 
                     # Check if we updated this alarm very recently
@@ -482,12 +939,10 @@ See [Alarm specification documentation](ALARMS_REFERENCE.md)  for more details.
                         log.debug(f"Alarm '{alarm_name}' updated to soon")
                         continue
 
-                nb_of_updated_alarms += 1
-                if nb_of_updated_alarms > max_update_per_batch: break
-
+                if len(actions) >= max_update_per_batch: break
+                alarm = self.render_alarm(template, alarm_name, instance_id, spec_hash)
                 log.log(log.NOTICE, f"Updating/creating CloudWatch Alarm '{alarm_name}' : {alarm}")
-                resp = client.put_metric_alarm(**alarm)
-                log.debug(Dbg.pprint(resp))
+                actions.append((client.put_metric_alarm, alarm))
 
         # Step 2) Destroy CloudWatch Alarms for non existing instances (Garbage Collection)
         for existing_alarm in self.alarms:
@@ -495,13 +950,22 @@ See [Alarm specification documentation](ALARMS_REFERENCE.md)  for more details.
             if not alarm_name.startswith("CloneSquad-%s-i-" % (self.context["GroupName"])):
                 continue
             if alarm_name not in valid_alarms:
-                nb_of_updated_alarms += 1
-                if nb_of_updated_alarms > max_update_per_batch: break
+                if len(actions) >= max_update_per_batch: break
                 log.debug(f"Garbage collection orphan Cloudwatch Alarm '{alarm_name}'")
-                resp = client.delete_alarms(AlarmNames=[alarm_name])
-                log.debug(resp)
-                nb_of_updated_alarms += 1
-                if nb_of_updated_alarms > max_update_per_batch: break
+                actions.append((client.delete_alarms, {"AlarmNames": [alarm_name]}))
+
+        if len(actions) == 0:
+            return
+        trace_entity = xray_recorder.get_trace_entity()
+        def _call(action):
+            xray_recorder.set_trace_entity(trace_entity)
+            api_func, kwargs = action
+            try:
+                log.debug(Dbg.pprint(api_func(**kwargs)))
+            except Exception as e:
+                log.exception(f"Failed to call CloudWatch {api_func.__name__}({kwargs}) : {e}")
+        with ThreadPoolExecutor(max_workers=max(1, min(max_update_per_batch, len(actions)))) as pool:
+            list(pool.map(_call, actions))
 
     def register_metric(self, spec):
         for s in spec:
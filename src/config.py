@@ -1,5 +1,7 @@
 import os
 import json
+import threading
+import functools
 import yaml
 from datetime import timedelta
 import misc
@@ -12,6 +14,17 @@ log = cslog.logger(__name__)
 
 ctx   = None
 _init = None
+# Main pipeline stages can run concurrently (see app.run_stages()): Configuration changes are serialized
+_lock = threading.RLock()
+
+def synchronized(f):
+    """ Serialize calls to the decorated function with the configuration lock.
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        with _lock:
+            return f(*args, **kwargs)
+    return wrapper
 
 from aws_xray_sdk.core import xray_recorder
 
@@ -149,6 +162,7 @@ def _parameterset_sanity_check():
         if not found:
             log.warning("Active parameter set is '%s' but no parameter set with this name exists!" % _init["active_parameter_set"])
     
+@synchronized
 def register(config, ignore_double_definition=False, layer="Built-in defaults", create_layer_when_needed=False):
     if _init is None:
         return
@@ -270,10 +284,16 @@ def dump():
         log.info(Dbg.pprint(keys))
         log.info("Loaded files: %s " % [ x["source"] for x in _init["loaded_files"]])
 
+def fingerprint():
+    """ Return a digest of the compiled configuration (all keys with their current value).
+    """
+    return misc.sha256(";".join("%s=%s" % (k, get(k)) for k in sorted(keys())))
+
 def is_builtin_key_exist(key):
     builtin_layer = _init["all_configs"][0]["config"]
     return key in builtin_layer
 
+@synchronized
 def compile_keys():
     """ Build a dictionary to quickly lookup keys.
 
@@ -281,11 +301,11 @@ def compile_keys():
     """
     active_parameter_set   = _init["active_parameter_set"]
     builtin_layer          = _init["all_configs"][0]["config"]
-    _init["compiled_keys"] = {}
-
+    # Build the new lookup dict aside so concurrent readers always see a complete one
+    compiled_keys          = {}
 
     for key in keys(only_stable_keys=False):
-        r = get_extended(key) # Retrieve the error structure.
+        r = _unknown_key(key) # Retrieve the error structure.
         stable_key  = is_stable_key(key)
         r["Stable"] = stable_key
 
@@ -335,8 +355,10 @@ def compile_keys():
                     break
             if r["Success"]: 
                 break
-        _init["compiled_keys"][key] = r
+        compiled_keys[key] = r
+    _init["compiled_keys"] = compiled_keys
 
+@synchronized
 def set(key, value, ttl=None):
     if _k(key) == "config.active_parameter_set":
         _init["active_parameter_set"] = value if value != "" else None
@@ -349,6 +371,7 @@ def get_direct_from_kv(key, default=None):
     v = t.get_kv(key, direct=True)
     return v if not None else default
 
+@synchronized
 def import_dict(c, clean_stale_keys=False):
     t = _init["configuration_table"]
     t.set_dict(c, clean_stale_keys=clean_stale_keys)
@@ -357,20 +380,23 @@ def get_dict():
     t = _init["configuration_table"]
     return t.get_dict()
 
+def _unknown_key(key):
+    return {
+        "Key": key,
+        "Value" : None,
+        "Success" : False,
+        "ConfigurationOrigin": "None",
+        "Status": "[WARNING] Unknown configuration key '%s'" % key,
+        "Stable": False,
+        "Override": False
+    }
+
 def get_extended(key, fmt=None):
-    if key in _init["compiled_keys"]:
-        r = _init["compiled_keys"][key]
-    else:
-        r = {
-            "Key": key,
-            "Value" : None,
-            "Success" : False,
-            "ConfigurationOrigin": "None",
-            "Status": "[WARNING] Unknown configuration key '%s'" % key,
-            "Stable": False,
-            "Override": False
-        }
+    compiled_keys = _init["compiled_keys"]
+    r = compiled_keys[key] if key in compiled_keys else _unknown_key(key)
     if fmt:
+        # Do not alter the compiled key
+        r = dict(r)
         r["Value"] = r["Value"].format(**fmt)
     return r
 
@@ -33,8 +33,11 @@ import yaml
 from datetime import datetime
 from datetime import timedelta
 from collections import defaultdict
+from collections import deque
 from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import heapq
 
 import misc
 import kvtable
@@ -65,6 +68,8 @@ class EC2:
         self.ec2_status_override     = {}
         self.state_table             = None
         self.scaling_states          = defaultdict(dict)
+        self.instance_change_listeners     = []
+        self.instance_pre_change_listeners = []
 
         Cfg.register({
                  "ec2.describe_instances.max_results" : "500",
@@ -124,6 +129,33 @@ CloneSquad is designed to smoothly start and stop EC2 instances so, the default
 CloneSquad is designed to smoothly start and stop EC2 instances so, the default value limits the number of EC2 instances tant can be started in a single execution. In some some use-cases, for instance, users could need to start a very large amount of EC2 at once, so this value can be modified to fit this need.
                      """
                  },
+                 "ec2.instance.api_fallback.max_concurrency": "4",
+                 "ec2.instance.capacity_failure.backoff_base": "minutes=2",
+                 "ec2.instance.capacity_failure.backoff_max": "minutes=30",
+                 "ec2.instance.cpu_credit_projection.enable,Stable": {
+                     "DefaultValue": "1",
+                     "Format": "Bool",
+                     "Description": """Enable projection of the CPU Credit balance of draining burstable instances.
+
+A draining instance is no more serving so its CPU Credit earning is predictable: When enabled, its balance is projected from 
+the last observed value with the earning rate of its instance type instead of being polled from CloudWatch at each run. It 
+saves CloudWatch GetMetricData calls on large fleets of burstable instances. Other instances keep the regular polling rate 
+so CPU Credit exhaustion is detected without delay.
+
+Projected balances are corrected by a real observation at least every 
+[`ec2.instance.cpu_credit_projection.max_observation_age`](#ec2instancecpu_credit_projectionmax_observation_age).
+                     """
+                 },
+                 "ec2.instance.cpu_credit_projection.max_observation_age,Stable": {
+                     "DefaultValue": "minutes=30",
+                     "Format": "Duration",
+                     "Description": """Maximum age of an observed CPU Credit balance used as base of a projection.
+
+When the last observation is older, the balance is polled again from CloudWatch. For instances with a balance below
+[`ec2.schedule.burstable_instance.min_cpu_credit_required`](#ec2scheduleburstable_instancemin_cpu_credit_required), the 
+observation is refreshed at least every 'cloudwatch.metrics.cache.max_retention_period'.
+                     """
+                 },
                  "ec2.instance.spot.event.interrupted_at_ttl" : "minutes=10",
                  "ec2.instance.spot.event.rebalance_recommended_at_ttl" : "minutes=20",
                  "ec2.state.error_instance_ids": "",
@@ -257,6 +289,14 @@ without any TargetGroup but another external health instance source exists).
         if len(self.instance_control_excluded_ids):
             log.info("Instance ids excluded through Instance Control API GW: %s" % self.instance_control_excluded_ids)
 
+        # Read the capacity failure memory
+        self.load_capacity_failures()
+
+        # Read the last observed CPU Credit balances of burstable instances
+        self.cpu_credits             = yaml.safe_load(str(misc.get_url("internal:cpu-credits.yaml"),"utf-8"))
+        self.cpu_credit_observations = self.get_state_json("ec2.instance.cpu_credit_observations", default={})
+        if self.cpu_credit_observations is None: self.cpu_credit_observations = {}
+
         # Retrieve list of instances with appropriate tag
         Filters          = [{'Name': 'tag:clonesquad:group-name', 'Values': [self.context["GroupName"]]}]
         
@@ -562,14 +602,8 @@ without any TargetGroup but another external health instance source exists).
         ref_instances = self.instances if instances is None else instances
         if main_fleet_only: # Filter out all subfleet instances
             ref_instances = [i for i in ref_instances if self.get_subfleet_name_for_instance(i) is None]
-        instances = []
-        for instance in ref_instances:
-           state_test        = self._match_instance(details["state"], instance, State, 
-                   lambda i, value: i["State"]["Name"] in value.split(","))
-           scalingstate_test = self._match_instance(details["scalingstate"], instance, ScalingState, 
-                   lambda i, value: self.get_scaling_state(i["InstanceId"], do_not_return_excluded=True) in value.split(",") or self.get_scaling_state(i["InstanceId"]) in value.split(","))
-           if state_test and scalingstate_test:
-               instances.append(instance)
+        is_matching = self._get_instance_selector(State, ScalingState, details)
+        instances   = [instance for instance in ref_instances if is_matching(instance)]
 
         # Instance list always sorted from the oldest to the newest
         sorted_instances = self.get_timesorted_instances(instances=instances)
@@ -583,6 +617,51 @@ without any TargetGroup but another external health instance source exists).
             return sorted_instances[:max_results]
         return sorted_instances
 
+    def _call_with_bisecting_fallback(self, api_func, result_key, instance_ids):
+        """ Call an EC2 instance API (ex: start_instances(), stop_instances()) and bisect the instance id list on failure.
+
+        These EC2 APIs fail at once when a single instance can not be processed. On failure, the instance id list is split
+        in two halves that are retried concurrently (on a bounded thread pool) until faulty instances are isolated. 
+
+        :param api_func: The EC2 client method to call
+        :param result_key: Name of the response list describing processed instances (ex: 'StartingInstances')
+        :param instance_ids: List of instance ids to process
+        :return A response dict aggregating all successful sub-calls and a 'FailedInstances' list 
+            of {InstanceId, ErrorCode, Message} dicts
+        """
+        merged = {
+            result_key: [],
+            "FailedInstances": [],
+            "ResponseMetadata": {"HTTPStatusCode": 200}
+        }
+        def _call(ids):
+            try:
+                return (ids, api_func(InstanceIds=ids), None)
+            except Exception as e:
+                return (ids, None, e)
+
+        max_workers = max(1, Cfg.get_int("ec2.instance.api_fallback.max_concurrency"))
+        pending     = [instance_ids]
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            while len(pending):
+                results = list(pool.map(_call, pending))
+                pending = []
+                for ids, response, ex in results:
+                    if ex is None:
+                        status = response["ResponseMetadata"]["HTTPStatusCode"]
+                        if status != 200:
+                            merged["ResponseMetadata"]["HTTPStatusCode"] = status
+                        merged[result_key].extend(response.get(result_key, []))
+                    elif len(ids) == 1:
+                        code = ex.response["Error"]["Code"] if isinstance(ex, ClientError) else type(ex).__name__
+                        merged["FailedInstances"].append({"InstanceId": ids[0], "ErrorCode": code, "Message": str(ex)})
+                    else:
+                        half = len(ids) // 2
+                        log.log(log.NOTICE, f"Got Exception while calling {api_func.__name__} for instance(s) '{ids}' : {ex}. "
+                                "Trying again with bisected instance lists...")
+                        pending.extend([ids[:half], ids[half:]])
+        return merged
+
     def start_instances(self, instance_ids_to_start, max_started_instances=-1):
         """ Call EC2 start_instance() is a smart way...
 
@@ -593,7 +672,8 @@ without any TargetGroup but another external health instance source exists).
             * It is recommended to pass as many startable instance ids as arguments and a defined max_startable_instances value. It allows
                 the method to manage an instance failure by trying to launch the next one in the list.
             * The start_instances() API is know to fail at once when a single instance fails to start. This method detects this case and 
-                try to start one-by-one all instance required to not be stuck in always-failing loop.
+                bisects the instance list (see _call_with_bisecting_fallback()) to isolate failing instances and not be stuck 
+                in always-failing loop. A single notify record is created per batch.
             * This method manages a special case linked to Sport instance start. IT is very common that a just stopped Spot instance can not
                 restarted immediatly. The heuristic detects this case and assume that it is a transient condition and not worth to notice 
                 the user about this event.
@@ -601,114 +681,136 @@ without any TargetGroup but another external health instance source exists).
         :param instance_ids_to_start: A list of starteable instance ids
         :param max_startable_instances: Maximum number of succesfully instances to start.
         """
+        self.start_instances_by_group({None: (instance_ids_to_start, max_started_instances)})
+
+    def start_instances_by_group(self, candidates_per_group):
+        """ Start instances of several independent groups (ex: subfleets) sharing the same start_instances() API calls.
+
+        Each group is managed like a start_instances() call of its own (ordered candidates and a maximum number of instances 
+        to start successfully) but candidates of all groups are batched together in calls of up to 'ec2.instance.max_start_instance_at_once'
+        instances.
+
+        :param candidates_per_group: A dict {group: (instance_ids_to_start, max_started_instances)}
+        """
+        candidates_per_group = {g: c for g, c in candidates_per_group.items() if c[0] is not None and len(c[0])}
         # Remember when we tried to start all these instances. Used to detect instances with issues
         #    by placing them at end of get_instances() generated list
-        if instance_ids_to_start is None or len(instance_ids_to_start) == 0:
+        if len(candidates_per_group) == 0:
             log.log(log.NOTICE, "No instance to start...")
             return 
         now = self.context["now"]
 
-        max_startable_instances = max_started_instances if max_started_instances != -1 else len(instance_ids_to_start)
+        pending_ids             = {}
+        max_startable_per_group = {}
+        group_of_instance       = {}
+        failed_pools            = set()
+        for group, (instance_ids_to_start, max_started_instances) in candidates_per_group.items():
+            pending_ids[group]             = list(instance_ids_to_start)
+            max_startable_per_group[group] = max_started_instances if max_started_instances != -1 else len(instance_ids_to_start)
+            for instance_id in instance_ids_to_start:
+                group_of_instance[instance_id] = group
+                self.notify_instance_change(instance_id, "State", before=True)
 
         def _check_response(need_longterm_record, response, ex):
-            nonlocal max_startable_instances
-            nonlocal InstanceIds
             log.debug(Dbg.pprint(response))
-            if ex is None:
-                metadata = response["ResponseMetadata"]
-                if metadata["HTTPStatusCode"] == 200:
-                    s = response["StartingInstances"]
-                    for r in s:
-                        instance_id    = r["InstanceId"]
-                        previous_state = r["PreviousState"]
-                        current_state  = r["CurrentState"]
-                        if current_state["Name"] in ["pending", "running"]:
-                            self.set_scaling_state(instance_id, "") # Reset scaling state
-                            self.set_state("ec2.instance.last_start_date.%s" % instance_id, now, TTL=self.ttl)
-                            max_startable_instances -= 1
-                            # Update statuses
-                            instance = self.get_instance_by_id(instance_id)
-                            instance["State"]["Code"] = 0
-                            instance["State"]["Name"] = "pending"
-                        else:
-                            log.error("Failed to start instance '%s'! Blacklist it for a while... (pre/current status=%s/%s)" %
-                                    (instance_id, previous_state["Name"], current_state["Name"]))
-                            self.set_scaling_state(instance_id, "error")
-                            R(None, self.instance_in_error, Operation="start", InstanceId=instance_id, 
-                                    PreviousState=previous_state["Name"], CurrentState=current_state["Name"])
-                else:
-                    log.error(f"Failed to call start_instances: {response}")
-
             need_shortterm_record = True
             if ex is not None:
+                return { 
+                    "need_shortterm_record": True,
+                    "need_longterm_record": True}
+
+            metadata = response["ResponseMetadata"]
+            if metadata["HTTPStatusCode"] != 200:
+                log.error(f"Failed to call start_instances: {response}")
+            for r in response["StartingInstances"]:
+                instance_id    = r["InstanceId"]
+                previous_state = r["PreviousState"]
+                current_state  = r["CurrentState"]
+                if current_state["Name"] in ["pending", "running"]:
+                    self.clear_capacity_failure(instance_id)
+                    self.set_scaling_state(instance_id, "") # Reset scaling state
+                    self.set_state("ec2.instance.last_start_date.%s" % instance_id, now, TTL=self.ttl)
+                    max_startable_per_group[group_of_instance[instance_id]] -= 1
+                    # Update statuses
+                    instance = self.get_instance_by_id(instance_id)
+                    instance["State"]["Code"] = 0
+                    instance["State"]["Name"] = "pending"
+                    self.notify_instance_change(instance_id, "State")
+                else:
+                    log.error("Failed to start instance '%s'! Blacklist it for a while... (pre/current status=%s/%s)" %
+                            (instance_id, previous_state["Name"], current_state["Name"]))
+                    self.set_scaling_state(instance_id, "error")
+                    R(None, self.instance_in_error, Operation="start", InstanceId=instance_id, 
+                            PreviousState=previous_state["Name"], CurrentState=current_state["Name"])
+
+            failures = response["FailedInstances"]
+            if len(failures) and not len(response["StartingInstances"]):
+                # Nothing started: Do not record anything unless a failure needs user attention
+                need_shortterm_record = False
+            for failure in failures:
+                instance_id, code = (failure["InstanceId"], failure["ErrorCode"])
+                if code in ["InsufficientInstanceCapacity", "IncorrectSpotRequestState"]:
+                    self.record_capacity_failure(instance_id)
+                    failed_pools.add(self.get_capacity_pool(instance_id))
                 # If we received an IncorrectSpotRequestState exception, we do not create short and long term record (=do not notify 
                 #   user) as it could happen when a Spot instance has recently been shutdown.
-                try:
-                    if ex.response['Error']['Code'] == 'IncorrectSpotRequestState':
-                        log.log(log.NOTICE, "Failed to start a Spot instance (IncorrectSpotRequestState) among these instances to "
-                                f"start {instance_ids_to_start}. It could happen when a Spot has been recently stopped. Will try again next time...")
-                        need_shortterm_record  = False
-                        need_longterm_record   = False
-                    if ex.response['Error']['Code'] == 'InsufficientInstanceCapacity':
-                        log.warning(f"Failed to start instance due to 'InsufficientInstanceCapacity' error: {ex}")
-                        need_shortterm_record  = False
-                        need_longterm_record   = False
-                    if ex.response['Error']['Code'] == 'InternalError':
-                        if len(InstanceIds) == 1:
-                            log.warning(f"Received error while trying to start to start instance {InstanceIds} due to "
-                                "'InternalError' error: {ex}. If encrypted volumes are used, a possible cause is a lack of "
-                                "permissions to the KMS EKS used by EBS volumes connected to the EC2 instance.")
-                            need_shortterm_record  = True
-                        else:
-                            need_shortterm_record  = False
-                        need_longterm_record   = False
-                except:
-                    pass
+                if code == 'IncorrectSpotRequestState':
+                    log.log(log.NOTICE, f"Failed to start a Spot instance {instance_id} (IncorrectSpotRequestState). "
+                            "It could happen when a Spot has been recently stopped. Will try again next time...")
+                    continue
+                self.set_scaling_state(instance_id, "error")
+                if code == 'InsufficientInstanceCapacity':
+                    log.warning(f"Failed to start instance {instance_id} due to 'InsufficientInstanceCapacity' error: {failure['Message']}")
+                elif code == 'InternalError':
+                    log.warning(f"Received error while trying to start to start instance {instance_id} due to "
+                        f"'InternalError' error: {failure['Message']}. If encrypted volumes are used, a possible cause is a lack of "
+                        "permissions to the KMS EKS used by EBS volumes connected to the EC2 instance.")
+                    need_shortterm_record = True
+                else:
+                    log.warning("Got Exception while trying to start instance '%s' : %s" % (instance_id, failure["Message"]))
+                    need_shortterm_record = True
+                    need_longterm_record  = True
 
             # Instruct the notify handler about what to do regarding record creation
             return { 
                 "need_shortterm_record": need_shortterm_record,
                 "need_longterm_record": need_longterm_record}
 
-
         client = self.context["ec2.client"]
-        ids    = instance_ids_to_start
-        while len(ids):
-            max_start = max(0, min(max_startable_instances, Cfg.get_int("ec2.instance.max_start_instance_at_once")))
-            if max_start == 0:
+        def start_instances(InstanceIds=None):
+            return self._call_with_bisecting_fallback(client.start_instances, "StartingInstances", InstanceIds)
+
+        while True:
+            # Take, in each group, as many candidates as instances still to start while respecting the per-call limit
+            max_at_once = Cfg.get_int("ec2.instance.max_start_instance_at_once")
+            to_start    = []
+            for group, ids in pending_ids.items():
+                # Do not try again in this call capacity pools that just failed
+                ids                = [i for i in ids if self.get_capacity_pool(i) not in failed_pools] if len(failed_pools) else ids
+                max_start          = max(0, min(max_startable_per_group[group], max_at_once - len(to_start)))
+                to_start.extend(ids[:max_start])
+                pending_ids[group] = ids[max_start:]
+            if len(to_start) == 0:
                 break
-            to_start  = ids[:max_start]
-            ids       = ids[max_start:]
 
             for i in to_start:
                 self.set_state("ec2.instance.last_start_attempt_date.%s" % i, now)
 
             log.info("Starting instances %s..." % to_start)
-            response = None
             try:
-                InstanceIds=to_start
-                response = R_xt(_check_response, lambda args, kwargs, r: r["ResponseMetadata"]["HTTPStatusCode"] == 200,
-                    client.start_instances, InstanceIds=InstanceIds
+                R_xt(_check_response, lambda args, kwargs, r: r["ResponseMetadata"]["HTTPStatusCode"] == 200,
+                    start_instances, InstanceIds=to_start
                 )
             except Exception as e:
-                log.log(log.NOTICE, f"Got Exception while trying to start instance(s) '{to_start}' : {e}. Trying again one-by-one...")
-                for i in to_start:
-                    try:
-                        InstanceIds=[i]
-                        response = R_xt(_check_response, lambda args, kwargs, r: r["ResponseMetadata"]["HTTPStatusCode"] == 200,
-                            client.start_instances, InstanceIds=InstanceIds
-                        )
-                    except ClientError as e:
-                        if e.response['Error']['Code'] != 'IncorrectSpotRequestState':
-                            log.warning("Got Exception while trying to start instance '%s' : %s" % (i, e))
-                            self.set_scaling_state(i, "error")
+                log.warning(f"Got Exception while trying to start instance(s) '{to_start}' : {e}")
 
 
     def stop_instances(self, instance_ids_to_stop):
         """ Stop instances the smart way...
 
-        This method is paranoid in the way to stop instances. It tries first to stop them at once but it fails it falls back to
-        one-by-one stop_instances() call. It is designed to ensure that a single instance condition blocks any instance stop.
+        This method is paranoid in the way to stop instances. It tries first to stop them at once but it fails it bisects 
+        the instance list (see _call_with_bisecting_fallback()). It is designed to ensure that a single instance condition 
+        blocks any instance stop. A single notify record is created per batch.
 
         :param instance_ids_to_stop: A list of instance id to stop
         """
@@ -716,43 +818,32 @@ without any TargetGroup but another external health instance source exists).
         client   = self.context["ec2.client"]
         ids      = instance_ids_to_stop
         max_stop = Cfg.get_int("ec2.instance.max_stop_instance_at_once")
+        def stop_instances(InstanceIds=None):
+            return self._call_with_bisecting_fallback(client.stop_instances, "StoppingInstances", InstanceIds)
+
+        for instance_id in ids:
+            self.notify_instance_change(instance_id, "State", before=True)
         while len(ids):
             to_stop = ids[:max_stop]
             ids     = ids[max_stop:]
             try:
-                response = R(lambda args, kwargs, r: r["ResponseMetadata"]["HTTPStatusCode"] == 200,
-                        client.stop_instances, InstanceIds=to_stop
+                response = R(lambda args, kwargs, r: r["ResponseMetadata"]["HTTPStatusCode"] == 200 and not len(r["FailedInstances"]),
+                        stop_instances, InstanceIds=to_stop
                    )
-                if response is not None and "StoppingInstances" in response:
-                    for i in response["StoppingInstances"]:
-                        instance_id = i["InstanceId"]
-                        self.set_scaling_state(instance_id, "")
-                        self.set_state("ec2.schedule.instance.last_stop_date.%s" % instance_id, now) 
-                        # Update the statuses 
-                        instance = self.get_instance_by_id(instance_id)
-                        instance["State"]["Code"] = 64
-                        instance["State"]["Name"] = "stopping"
+                for i in response["StoppingInstances"]:
+                    instance_id = i["InstanceId"]
+                    self.set_scaling_state(instance_id, "")
+                    self.set_state("ec2.schedule.instance.last_stop_date.%s" % instance_id, now) 
+                    # Update the statuses 
+                    instance = self.get_instance_by_id(instance_id)
+                    instance["State"]["Code"] = 64
+                    instance["State"]["Name"] = "stopping"
+                    self.notify_instance_change(instance_id, "State")
+                for failure in response["FailedInstances"]:
+                    log.warning("Failed to stop_instance '%s' : %s" % (failure["InstanceId"], failure["Message"]))
                 log.debug(response)
             except Exception as e:
                 log.warning("Failed to stop_instance(s) '%s' : %s" % (to_stop, e))
-                # Failed to stop all instances at once. Try one by one...
-                for i in to_stop:
-                    try:
-                        response = R(lambda args, kwargs, r: r["ResponseMetadata"]["HTTPStatusCode"] == 200,
-                                client.stop_instances, InstanceIds=[i]
-                           )
-                        if response is not None and "StoppingInstances" in response:
-                            for i in response["StoppingInstances"]:
-                                instance_id = i["InstanceId"]
-                                self.set_scaling_state(instance_id, "")
-                                self.set_state("ec2.schedule.instance.last_stop_date.%s" % instance_id, now)
-                                # Update the statuses 
-                                instance = self.get_instance_by_id(instance_id)
-                                instance["State"]["Code"] = 64
-                                instance["State"]["Name"] = "stopping"
-                        log.debug(response)
-                    except Exception as e:
-                        log.warning("Failed to stop_instance '%s' : %s" % (i, e))
 
     def instance_last_stop_date(self, instance_id, default=misc.epoch()):
         return self.get_state_date("ec2.schedule.instance.last_stop_date.%s" % instance_id, default=default)
@@ -771,20 +862,12 @@ without any TargetGroup but another external health instance source exists).
         """
         if prefered_azs is None: return instances
 
-        sorted_instances = []
-        for i in instances:
-            if prefered_before and i["Placement"]["AvailabilityZone"] in prefered_azs:
-                sorted_instances.append(i)
-
+        prefered_azs = set(prefered_azs)
+        prefered     = []
+        others       = []
         for i in instances:
-            if i["Placement"]["AvailabilityZone"] not in prefered_azs:
-                sorted_instances.append(i)
-
-        for i in instances:
-            if not prefered_before and i["Placement"]["AvailabilityZone"] in prefered_azs:
-                sorted_instances.append(i)
-
-        return sorted_instances
+            (prefered if i["Placement"]["AvailabilityZone"] in prefered_azs else others).append(i)
+        return prefered + others if prefered_before else others + prefered
 
     def sort_by_prefered_instance_ids(self, instances, prefered_ids=None, prefered_before=True):
         """ Return a sorted list of instance structures based on 'prefered_ids'.
@@ -794,69 +877,51 @@ without any TargetGroup but another external health instance source exists).
         """
         if prefered_ids is None: return instances
 
-        sorted_instances = []
-        for i in instances:
-            if prefered_before and i["InstanceId"] in prefered_ids:
-                sorted_instances.append(i)
-
-        for i in instances:
-            if i["InstanceId"] not in prefered_ids:
-                sorted_instances.append(i)
-
+        prefered_ids = set(prefered_ids)
+        prefered     = []
+        others       = []
         for i in instances:
-            if not prefered_before and i["InstanceId"] in prefered_ids:
-                sorted_instances.append(i)
-
-        return sorted_instances
-
+            (prefered if i["InstanceId"] in prefered_ids else others).append(i)
+        return prefered + others if prefered_before else others + prefered
 
     def sort_by_balanced_az(self, candidate_instances, ref_instances, smallest_to_biggest_az=True, excluded_instance_ids=None):
         """ Sort the supplied candidate instance list in a way that keeps the AZ balanced.
 
         This is a critical method that scaling algorithm call to ensure AZs are always kept balanced the best possible.
 
+        Each AZ with remaining candidates is kept in a heap keyed by its (signed) instance count. When AZ counts are equal, the
+        AZ that reached this count most recently is picked first, then the AZ discovered first (in candidate list, then in 
+        reference list order). Candidates of the same AZ are picked in their supplied order.
+
         :param candidate_instances:     The list of instance structures to sort
         :param ref_instances:           The list of instance already running
         :param smallest_to_biggest_az:  Define if the order of sorting.
         :param excluded_instance_ids:   A list of instance ids to ignore in the AZ weighting.
         """
-        candidate_instances = candidate_instances.copy()
-        ref_azs = {} 
+        excluded_instance_ids = set(excluded_instance_ids) if excluded_instance_ids is not None else set()
+        ref_azs        = {}
+        candidates_azs = defaultdict(deque)
         for i in candidate_instances:
             az = i["Placement"]["AvailabilityZone"]
             ref_azs[az] = 0
+            candidates_azs[az].append(i)
         for i in ref_instances:
-            if excluded_instance_ids is not None and i["InstanceId"] in excluded_instance_ids:
+            if i["InstanceId"] in excluded_instance_ids:
                 continue
             az = i["Placement"]["AvailabilityZone"]
-            ref_azs[az] = 1 if az not in ref_azs else ref_azs[az] + 1
-
-        ref_azs_list = []
-        for az in ref_azs.keys():
-            ref_azs_list.append({
-                    "AZ": az,
-                    "Count": ref_azs[az]
-                })
+            ref_azs[az] = ref_azs.get(az, 0) + 1
 
         sort_direction = 1 if smallest_to_biggest_az else -1
-                
+        # Heap items: (signed AZ count, -date of last count update, discovery index, AZ name)
+        heap = [(sort_direction * ref_azs[az], 0, index, az) for index, az in enumerate(ref_azs.keys()) if az in candidates_azs]
+        heapq.heapify(heap)
+
         optimized_instances = []
-        while len(candidate_instances) > 0:
-            # Sort based on number of instances per AZ 
-            ref_azs_list.sort(key=lambda x: sort_direction * x["Count"])
-
-            found_candidate = False
-            for prefered_az in ref_azs_list:
-                for i in candidate_instances:
-                    az = i["Placement"]["AvailabilityZone"]
-                    if az == prefered_az["AZ"]:
-                        prefered_az["Count"] += sort_direction
-                        optimized_instances.append(i)
-                        candidate_instances.remove(i)
-                        found_candidate = True
-                        break
-                if found_candidate:
-                    break
+        while len(heap):
+            key, _, index, az = heapq.heappop(heap)
+            optimized_instances.append(candidates_azs[az].popleft())
+            if len(candidates_azs[az]):
+                heapq.heappush(heap, (key + 1, -len(optimized_instances), index, az))
         return optimized_instances
 
     def get_instance_tags(self, instance, default=None):
@@ -976,6 +1041,28 @@ without any TargetGroup but another external health instance source exists).
                 i_s.append(i)
         return i_s
 
+    def count_instances(self, State=None, ScalingState=None, instance_id_filter=None):
+        """ Return the number of instances matching the 'State' and 'ScalingState' selectors (see get_instances()).
+
+        Unlike get_instances(), no time sorted instance list is built.
+
+        :param instance_id_filter: An optional predicate on instance id to further filter counted instances
+        """
+        details     = {"state": {"filtered-in": [], "filtered-out": []}, "scalingstate": {"filtered-in": [], "filtered-out": []}}
+        is_matching = self._get_instance_selector(State, ScalingState, details)
+        return sum(1 for i in self.instances if is_matching(i) and (instance_id_filter is None or instance_id_filter(i["InstanceId"])))
+
+    def _get_instance_selector(self, State, ScalingState, details):
+        """ Return a predicate on instance structure implementing the 'State' and 'ScalingState' selectors.
+        """
+        def _is_matching(instance):
+           state_test        = self._match_instance(details["state"], instance, State, 
+                   lambda i, value: i["State"]["Name"] in value.split(","))
+           scalingstate_test = self._match_instance(details["scalingstate"], instance, ScalingState, 
+                   lambda i, value: self.get_scaling_state(i["InstanceId"], do_not_return_excluded=True) in value.split(",") or self.get_scaling_state(i["InstanceId"]) in value.split(","))
+           return state_test and scalingstate_test
+        return _is_matching
+
     def _match_instance(self, details, instance, value, default_func):
         exclude = False
         filter_func = value
@@ -1034,6 +1121,9 @@ without any TargetGroup but another external health instance source exists).
             except Exception as e:
                 log.exception("Failed to convert '%s' as a int()!" % debug_state_key)
 
+        if self.is_cpu_credit_projected(instance):
+            return self.get_projected_cpu_creditbalance(instance)
+
         if "_Metrics" not in instance:
             return -1
         metrics = instance["_Metrics"]
@@ -1054,14 +1144,40 @@ without any TargetGroup but another external health instance source exists).
             r[state].append(instance_id)
         return dict(r)
 
-    def compute_scaling_states(self, instance_id=None):
+    def get_scaling_record(self, instance_id):
+        """ Return the consolidated scaling record of an instance.
+
+        The record is a dict holding the scaling state and the last action dates (last_draining_date, last_error_date, 
+        last_bounced_date) of the instance. It is stored as a single key in the 'ec2.instance.' state aggregate.
+
+        :param instance_id: The instance id
+        :return A dict (empty if the instance has no scaling state)
+        """
+        record = self.get_state_json(f"ec2.instance.scaling.record.{instance_id}", default=None)
+        if record is not None:
+            return record
+        # Legacy layout: Scaling state and action dates were stored in separate keys
+        record = {}
+        state  = self.get_state(f"ec2.instance.scaling.state.{instance_id}", default=None)
+        if state not in [None, ""]: 
+            record["state"] = state
+        for action in ["draining", "error", "bounced"]:
+            date = self.get_state(f"ec2.instance.scaling.last_{action}_date.{instance_id}", default=None)
+            if date not in [None, ""]:
+                record[f"last_{action}_date"] = date
+        return record
+
+    def compute_scaling_states(self, instance_id=None, record=None):
         """ Compute an optimized lookup structure of scaling instance state.
+
+        :param instance_id: Update only the specified instance (all instances if None)
+        :param record: Scaling record to use for the specified instance (read from the state table if None)
         """
-        def _update_scaling_state(i):
+        def _update_scaling_state(i, record):
             instance_id  = i["InstanceId"]
-            state        = self.scaling_states[instance_id]
-            key          = f"ec2.instance.scaling.state.{instance_id}"
-            state["raw"] = self.get_state(key, default=None)
+            state        = {}
+            state["record"]            = record if record is not None else self.get_scaling_record(instance_id)
+            state["raw"]               = state["record"].get("state")
             state["state"]             = state["raw"]
             state["state_no_excluded"] = state["raw"]
             if (self.is_instance_excluded(i) or self.is_subfleet_instance(instance_id)):
@@ -1070,32 +1186,34 @@ without any TargetGroup but another external health instance source exists).
             if instance_id in error_instance_ids:
                 state["state_no_excluded"] = "error"
                 state["state"]             = "error"
+            self.scaling_states[instance_id] = state
 
         error_instance_ids  = Cfg.get_list("ec2.state.error_instance_ids", default=[]) 
         if instance_id is not None:
-            _update_scaling_state(self.get_instance_by_id(instance_id))
+            _update_scaling_state(self.get_instance_by_id(instance_id), record)
         else:
             self.scaling_states = defaultdict(dict)
             for i in self.get_instances():
-                _update_scaling_state(i)
+                _update_scaling_state(i, None)
 
     def get_scaling_state(self, instance_id, default=None, meta=None, default_date=None, do_not_return_excluded=False, raw=False):
         """ Return the scaling state for specified instance.
 
         """
+        state = self.scaling_states.get(instance_id, {"raw": default, "state_no_excluded": default, "state": default})
         if meta is not None:
             newest_action_date = None
             i                  = self.get_instance_by_id(instance_id)
             last_start_date    = i["LaunchTime"] if "LaunchTime" in i else None
+            record             = state.get("record", {})
             for action in ["draining", "error", "bounced"]:
-                date = misc.str2utc(self.get_state(f"ec2.instance.scaling.last_{action}_date.{instance_id}", TTL=self.ttl))
+                date = misc.str2utc(record.get(f"last_{action}_date"))
                 meta[f"last_{action}_date"] = date if (date is None or last_start_date is None or date >= last_start_date) else None
                 if date is not None and (newest_action_date is None or newest_action_date < date):
                     newest_action_date = date
             meta["last_start_date"]  = last_start_date
             meta["last_action_date"] = newest_action_date
 
-        state = self.scaling_states.get(instance_id, {"raw": default, "state_no_excluded": default, "state": default})
         if raw:
             return state["raw"] if state["raw"] is not None else default
         if do_not_return_excluded:
@@ -1103,8 +1221,15 @@ without any TargetGroup but another external health instance source exists).
         return state["state"] if state["state"] is not None else default
 
     def set_scaling_state(self, instance_id, value, ttl=None, meta=None, default_date=None, force=False):
+        """ Set the scaling state of an instance.
+
+        The state and its last action dates are updated in the consolidated scaling record (see get_scaling_record()) 
+        and in the in-memory lookup structure at once. The 'ec2.instance.scaling.state.<instance_id>' key is also
+        maintained outside of the state aggregate as the Interact API reads it directly from the DynamoDB table.
+        """
         if ttl is None: ttl = self.ttl
         if default_date is None: default_date = self.context["now"]
+        self.notify_instance_change(instance_id, "ScalingState", before=True)
 
         if value != "":
             meta                  = {} if meta is None else meta
@@ -1112,19 +1237,40 @@ without any TargetGroup but another external health instance source exists).
             date                       = meta["last_action_date"] if not force and previous_value == value else default_date
             meta[f"last_{value}_date"] = date
             meta["last_action_date"]   = date
-            previous_action_date       = self.get_state_date(f"ec2.instance.scaling.last_{value}_date.{instance_id}", TTL=ttl)
-            # The following condition is focused on cost reduction. We know that the 'draining' state is marked multiple times
-            #  by upper algorithms so we try to optimize when to write this specific state.
-            if (value not in ["draining"] or previous_action_date is None or "last_start_date" not in meta 
+            record                     = dict(self.scaling_states.get(instance_id, {}).get("record", {}))
+            previous_action_date       = misc.str2utc(record.get(f"last_{value}_date"))
+            # The 'draining' state is marked multiple times by upper algorithms so we keep the original draining date
+            #   unless the instance has been restarted since.
+            if (value not in ["draining"] or previous_action_date is None or meta.get("last_start_date") is None
                 or previous_action_date <= meta["last_start_date"]):
-                self.set_state(f"ec2.instance.scaling.last_{value}_date.{instance_id}", date, TTL=ttl)
+                if date is not None:
+                    record[f"last_{value}_date"] = str(date)
+                else:
+                    record.pop(f"last_{value}_date", None)
+            record["state"] = value
+            self.set_state_json(f"ec2.instance.scaling.record.{instance_id}", record, compress=False, TTL=ttl)
         else:
-            # Remove all state keys
-            for action in ["action", "draining", "error", "bounced"]:
-                self.set_state(f"ec2.instance.scaling.last_{action}_date.{instance_id}", "", TTL=ttl)
+            # Reset the whole record (an empty record is kept to mask legacy keys until they expire)
+            record = {}
+            self.set_state_json(f"ec2.instance.scaling.record.{instance_id}", record, compress=False, TTL=ttl)
         self.set_state(f"ec2.instance.scaling.state.{instance_id}", value, TTL=ttl)
         # Update the cache
-        self.compute_scaling_states(instance_id=instance_id)
+        self.compute_scaling_states(instance_id=instance_id, record=record)
+        self.notify_instance_change(instance_id, "ScalingState")
+
+    def register_instance_change_listener(self, listener, before=False):
+        """ Register a callable notified when an instance changes during the current execution.
+
+        :param listener: A callable receiving the instance id and the kind of change ('State' or 'ScalingState')
+        :param before: If 'True', the listener is notified just before the change instead of just after
+        """
+        listeners = self.instance_pre_change_listeners if before else self.instance_change_listeners
+        if listener not in listeners:
+            listeners.append(listener)
+
+    def notify_instance_change(self, instance_id, change, before=False):
+        for listener in (self.instance_pre_change_listeners if before else self.instance_change_listeners):
+            listener(instance_id, change)
 
     def list_states(self, prefix="ec2.instance.scaling_state.", not_matching_instances=None):
         r = self.state_table.get_keys(prefix) 
@@ -1197,6 +1343,11 @@ without any TargetGroup but another external health instance source exists).
         self.set_state(key, ";".join(recs_s), TTL=TTL)
 
 
+    def get_float_state_series(self, key, integration_period):
+        """ Return the (date, value) samples of an integrated float state, oldest first.
+        """
+        return [(d, v) for s, d, v in reversed(self._decode_integrate_float(key, integration_period))]
+
     def _decode_integrate_float(self, key, integration_period):
         now = self.context["now"]
         v = self.get_state(key, None)
@@ -1257,6 +1408,75 @@ without any TargetGroup but another external health instance source exists).
             return
         self.set_state_json("ec2.control.state", state, TTL=(ttl-now))
 
+    def _build_instance_tag_index(self, instances):
+        """ Build an inverted index of instance tags.
+
+        :param instances: List of instance structures
+        :return A dict of tag key -> dict of tag value -> set of instance ids
+        """
+        index = defaultdict(lambda: defaultdict(set))
+        for i in instances:
+            for t in i.get("Tags", []):
+                index[t["Key"]][t["Value"]].add(i["InstanceId"])
+        return index
+
+    def _compile_instance_filter_query(self, filter_query):
+        """ Precompile a filter query so each tag criterion is evaluated once against the tag index.
+
+        Tag criteria semantic:
+            * None: The tag must not be present on the instance,
+            * "*": The tag must be present whatever its value,
+            * Value containing a '*': The value is a regex matched against the tag value,
+            * Other values: The tag value must be strictly equal.
+
+        :param filter_query: The filter query dict (see interact.py 'control/instances/(unstoppable|unstartable)')
+        :return A list of (tag key, kind, operand) tuples
+        """
+        compiled = []
+        tags     = filter_query["Tags"] if "Tags" in filter_query else {}
+        for key, value in tags.items():
+            if value is None:
+                compiled.append((key, "absent", None))
+            elif value == "*":
+                compiled.append((key, "present", None))
+            elif "*" in value:
+                try:
+                    compiled.append((key, "regex", re.compile(value)))
+                except Exception as e:
+                    log.warning(f"Failed to compile tag filter regex '{value}' for tag '{key}': {e}! Falling back to exact match...")
+                    compiled.append((key, "exact", value))
+            else:
+                compiled.append((key, "exact", value))
+        return compiled
+
+    def _match_instance_filter_query(self, compiled_tags, tag_index, all_ids):
+        """ Evaluate a compiled tag query against the tag inverted index.
+
+        :param compiled_tags: Output of _compile_instance_filter_query()
+        :param tag_index: Output of _build_instance_tag_index()
+        :param all_ids: Set of all known instance ids
+        :return A set of matching instance ids (all tag criteria must match)
+        """
+        matching_ids = None
+        for key, kind, operand in compiled_tags:
+            values = tag_index.get(key, {})
+            if kind == "exact":
+                ids = set(values.get(operand, set()))
+            elif kind == "regex":
+                ids = set()
+                for v, v_ids in values.items():
+                    if operand.match(v): ids |= v_ids
+            else:
+                ids = set()
+                for v_ids in values.values():
+                    ids |= v_ids
+                if kind == "absent":
+                    ids = all_ids - ids
+            matching_ids = ids if matching_ids is None else matching_ids & ids
+            if not len(matching_ids):
+                break
+        return matching_ids if matching_ids is not None else set()
+
     def update_instance_control_state(self, listname, mode, filter_query, ttl_string):
         ctrl = self.get_instance_control_state()
         ttl  = Cfg.get_duration_secs("ec2.instance.control.ttl")
@@ -1269,60 +1489,38 @@ without any TargetGroup but another external health instance source exists).
         # Lookup matching instances
         instances = self.get_instances()
         ids       = [ i["InstanceId"] for i in instances]
+        ids_set   = set(ids)
+        tag_index = self._build_instance_tag_index(instances)
 
         instance_ids = filter_query["InstanceIds"] if "InstanceIds" in filter_query else []
         if "all" in instance_ids:
             instance_ids = ids # Wildcard matches all instances
         else:
-            instance_ids = [i for i in instance_ids if i in ids] # Filter out unknown instance id
+            instance_ids = [i for i in instance_ids if i in ids_set] # Filter out unknown instance id
+        matched_ids = set(instance_ids)
 
-        for i in instances:
-            # Match instance by name
-            for tag, values in [("Name", "InstanceNames"), ("clonesquad:subfleet-name", "SubfleetNames")]:
-                if not len(filter_query.get(values, [])):
-                    continue
-                t = next(filter(lambda t: t["Key"] == tag, i["Tags"]), None)
-                if (t and t["Value"] in filter_query.get(values, [])) or (not t and not filter_query.get(values, None)):
-                    if i["InstanceId"] not in instance_ids:
-                        instance_ids.append(i["InstanceId"]) 
+        # Match instance by name and subfleet name
+        for tag, values in [("Name", "InstanceNames"), ("clonesquad:subfleet-name", "SubfleetNames")]:
+            if not len(filter_query.get(values) or []):
+                continue
+            for value in set(filter_query[values]):
+                matched_ids |= tag_index.get(tag, {}).get(value, set())
 
         # Match tags specified in query filter
-        tags      = filter_query["Tags"] if "Tags" in filter_query else {}
-        if len(tags.keys()):
-            log.info(f"Matching tags {tags}...")
-            for i in instances:
-                instance_id = i["InstanceId"]
-                if instance_id in instance_ids:
-                    continue
-                i_tags = {}
-                for t in i["Tags"]:
-                    i_tags[t["Key"]] = t["Value"]
-                #log.info(f"Checking instance {instance_id} with tags {i_tags}...")
-                match = False
-                for t in tags:
-                    # All instance tags must match the query
-                    if tags.get(t) is None:
-                        if t not in i_tags:
-                            match = True
-                            continue # Tag not present on the instance as requested
-                        match = False
-                        break
-                    if (t in i_tags and (
-                            tags[t] == "*" 
-                            or (re.match(tags[t], i_tags[t])) if "*" in tags[t] else False)
-                            or (tags[t] == i_tags[t])
-                            ):
-                        match = True
-                        continue # Tag not present or this a different value than the filtered one
-                    match = False
-                    break
-                if match: instance_ids.append(instance_id)
+        compiled_tags = self._compile_instance_filter_query(filter_query)
+        if len(compiled_tags):
+            log.info(f"Matching tags {filter_query['Tags']}...")
+            matched_ids |= self._match_instance_filter_query(compiled_tags, tag_index, ids_set)
+
+        # Keep explicitly specified instance ids first, then the matched ones in discovery order
+        explicit_ids  = set(instance_ids)
+        instance_ids  = list(instance_ids) + [i for i in ids if i in matched_ids and i not in explicit_ids]
        
         # Perform action according to specified mode
         log.info(f"Action {mode} for list {listname} on instance ids: {instance_ids}.")
         for instance_id in instance_ids:
             if mode == "delete":
-                if instance_id in list(ctrl[listname].keys()):
+                if instance_id in ctrl[listname]:
                     del ctrl[listname][instance_id]
             else:
                 ctrl[listname][instance_id] = {
@@ -1333,8 +1531,8 @@ without any TargetGroup but another external health instance source exists).
                 }
 
         # Garbage collection of older instance ids
-        for instance_id in ctrl[listname].keys():
-            if instance_id not in ids:
+        for instance_id in list(ctrl[listname].keys()):
+            if instance_id not in ids_set:
                 del ctrl[listname][instance_id]
         self.set_instance_control_state(ctrl)
         
@@ -1433,6 +1631,156 @@ without any TargetGroup but another external health instance source exists).
                 "\n".join(volume_serialized))
 
 
+###############################################
+#### CAPACITY FAILURE MEMORY ##################
+###############################################
+
+    def get_capacity_pool(self, i):
+        """ Return the capacity pool key (instance type, AZ and Spot flag) of an instance.
+        """
+        if isinstance(i, str):
+            i = self.get_instance_by_id(i)
+        return "%s/%s/%s" % (i["InstanceType"], i["Placement"]["AvailabilityZone"], "spot" if self.is_spot_instance(i) else "ondemand")
+
+    def load_capacity_failures(self):
+        """ Read the capacity failure memory and forget pools that did not fail for a long time.
+        """
+        now         = self.context["now"]
+        backoff_max = Cfg.get_duration_secs("ec2.instance.capacity_failure.backoff_max")
+        failures    = self.get_state_json("ec2.instance.capacity_failures", default={})
+        self.capacity_failures = {}
+        for pool, f in failures.items():
+            backoff_until = misc.str2utc(f.get("BackoffUntil"), default=None) if isinstance(f, dict) else None
+            if backoff_until is not None and (now - backoff_until).total_seconds() < backoff_max:
+                self.capacity_failures[pool] = f
+
+    def save_capacity_failures(self):
+        self.set_state_json("ec2.instance.capacity_failures", self.capacity_failures, 
+                TTL=Cfg.get_duration_secs("ec2.instance.capacity_failure.backoff_max") * 2)
+
+    def record_capacity_failure(self, instance_id):
+        """ Remember that the capacity pool of an instance failed to provide capacity.
+
+        The pool is considered constrained for an exponentially growing period on consecutive failures 
+        ('ec2.instance.capacity_failure.backoff_base' doubled at each failure up to 'ec2.instance.capacity_failure.backoff_max').
+        """
+        now     = self.context["now"]
+        pool    = self.get_capacity_pool(instance_id)
+        count   = self.capacity_failures.get(pool, {}).get("Count", 0) + 1
+        backoff = min(Cfg.get_duration_secs("ec2.instance.capacity_failure.backoff_base") * (2 ** (count - 1)),
+                Cfg.get_duration_secs("ec2.instance.capacity_failure.backoff_max"))
+        self.capacity_failures[pool] = {
+            "Count": count,
+            "LastFailure": str(now),
+            "BackoffUntil": str(now + timedelta(seconds=backoff))
+        }
+        log.info(f"Capacity pool '{pool}' failed to start instance '{instance_id}' ({count} consecutive failure(s)): "
+                f"Deprioritizing it for {backoff} seconds.")
+        self.save_capacity_failures()
+
+    def clear_capacity_failure(self, instance_id):
+        """ Forget capacity failures of an instance pool (on successful start).
+        """
+        pool = self.get_capacity_pool(instance_id)
+        if pool in self.capacity_failures:
+            del self.capacity_failures[pool]
+            self.save_capacity_failures()
+
+    def is_capacity_constrained(self, i):
+        """ Return 'True' if the capacity pool of an instance recently failed to provide capacity.
+        """
+        f = self.capacity_failures.get(self.get_capacity_pool(i))
+        if f is None:
+            return False
+        return self.context["now"] < misc.str2utc(f["BackoffUntil"])
+
+    def sort_by_capacity_availability(self, instances):
+        """ Move instances part of capacity constrained pools at end of list (stable sort).
+        """
+        if not len(self.capacity_failures):
+            return instances
+        available   = []
+        constrained = []
+        for i in instances:
+            (constrained if self.is_capacity_constrained(i) else available).append(i)
+        if len(constrained):
+            log.info("Instances %s are part of capacity constrained pools: Use them as last resort candidates." %
+                    [i["InstanceId"] for i in constrained])
+        return available + constrained
+
+###############################################
+#### CPU CREDIT PROJECTION ####################
+###############################################
+
+    def record_cpu_credit_observations(self, observations):
+        """ Remember CPU Credit balances observed through CloudWatch metrics.
+
+        Observations of instances that do not exist anymore are forgotten.
+
+        :param observations: A dict {instance_id: (balance, observation_date)}
+        """
+        instance_ids = set(i["InstanceId"] for i in self.instances)
+        records      = {instance_id: r for instance_id, r in self.cpu_credit_observations.items() if instance_id in instance_ids}
+        for instance_id, (balance, date) in observations.items():
+            records[instance_id] = {
+                "Balance": balance,
+                "Date": str(date)
+            }
+        if records != self.cpu_credit_observations or len(observations):
+            self.cpu_credit_observations = records
+            self.set_state_json("ec2.instance.cpu_credit_observations", records, TTL=self.ttl)
+
+    def is_cpu_credit_projected(self, instance):
+        """ Return 'True' if the CPU Credit balance of a burstable instance is projected instead of polled.
+
+        Only draining instances are projected: Their credit earning is predictable as they are no more serving. Other 
+        instances keep the regular polling rate so CPU Credit exhaustion is detected without delay.
+        """
+        return (Cfg.get_int("ec2.instance.cpu_credit_projection.enable") and 
+                self.get_scaling_state(instance["InstanceId"]) == "draining")
+
+    def get_projected_cpu_creditbalance(self, instance):
+        """ Return the projected CPU Credit balance of a burstable instance.
+
+        The projection starts from the last observed balance. A draining instance is considered idle (it is no more
+        serving) so it earns credits at the rate defined in 'cpu-credits.yaml' from its draining date, up to the maximum
+        credits that can be accrued. As the consumption of other instances can't be predicted, their last observed balance
+        is returned.
+
+        :return The projected balance or -1 if not a burstable instance or no balance was observed yet
+        """
+        instance_id   = instance["InstanceId"]
+        instance_type = instance["InstanceType"]
+        record        = self.cpu_credit_observations.get(instance_id)
+        if record is None or instance_type not in self.cpu_credits:
+            return -1
+        balance = record["Balance"]
+        meta    = {}
+        if self.get_scaling_state(instance_id, meta=meta) == "draining" and meta["last_draining_date"] is not None:
+            earned_per_hour, max_earned_credits = self.cpu_credits[instance_type][:2]
+            idle_since = max(misc.str2utc(record["Date"]), meta["last_draining_date"])
+            idle_time  = max((self.context["now"] - idle_since).total_seconds(), 0)
+            balance    = min(balance + earned_per_hour * idle_time / 3600, max(max_earned_credits, balance))
+        return balance
+
+    def is_cpu_credit_polling_needed(self, instance):
+        """ Return 'True' if the CPU Credit balance of a burstable instance needs to be observed again.
+
+        Balances are refreshed when the last observation is older than 'ec2.instance.cpu_credit_projection.max_observation_age'
+        or, for instances with a balance below 'ec2.schedule.burstable_instance.min_cpu_credit_required', older than
+        'cloudwatch.metrics.cache.max_retention_period'.
+        """
+        record = self.cpu_credit_observations.get(instance["InstanceId"])
+        if record is None:
+            return True
+        max_age = Cfg.get_duration_secs("ec2.instance.cpu_credit_projection.max_observation_age")
+        if instance["InstanceType"] in self.cpu_credits:
+            min_cpu_credit_required = Cfg.get_abs_or_percent("ec2.schedule.burstable_instance.min_cpu_credit_required", -1, 
+                    self.cpu_credits[instance["InstanceType"]][1])
+            if record["Balance"] < min_cpu_credit_required:
+                max_age = min(max_age, Cfg.get_duration_secs("cloudwatch.metrics.cache.max_retention_period"))
+        return (self.context["now"] - misc.str2utc(record["Date"])).total_seconds() > max_age
+
 ###############################################
 #### SPOT INSTANCE MANAGEMENT #################
 ###############################################
@@ -36,10 +36,8 @@ import math
 import re
 import boto3
 import json
-import yaml
 import pdb
 import hashlib
-import random
 from datetime import datetime
 from datetime import timedelta
 from collections import defaultdict
@@ -79,6 +77,7 @@ class EC2_Schedule:
         self.instance_scale_score     = 0.0
         self.raw_instance_scale_score = 0.0
         self.integrated_raw_instance_scale_score = 0.0
+        self.instance_scale_score_forecast = None
         self.would_like_to_scalein    = False
         self.would_like_to_scaleout   = False
         self.spot_rebalance_recommended   = []
@@ -86,6 +85,11 @@ class EC2_Schedule:
         self.excluded_spot_instance_types = []
         self.spot_excluded_instance_ids = []
         self.letter_box_subfleet_to_stop_drained_instances = defaultdict(int)
+        self.vertical_policy_matchers = {}
+        self.prewarm_instance_count   = 0
+        self.bounce_plan              = None
+        self.instance_classification  = None
+        self.decision_record          = None
         Cfg.register({
                  "ec2.schedule.min_instance_count,Stable" : {
                      "DefaultValue" : 0,
@@ -216,6 +220,52 @@ to let the autoscaler algorithm do its smoother job instead)
                  "ec2.schedule.horizontalscale.unknown_divider_target": "0.8",
                  "ec2.schedule.horizontalscale.integration_period": "minutes=5",
                  "ec2.schedule.horizontalscale.raw_integration_period": "minutes=10",
+                 "ec2.schedule.horizontalscale.predictive.enable,Stable": {
+                         "DefaultValue": "0",
+                         "Format"      : "Bool",
+                         "Description" : """Enable predictive scaleout.
+
+When enabled, a short-horizon trend (Holt linear smoothing) is fitted on the recent raw scale score history and projected
+[`ec2.schedule.start.warmup_delay`](#ec2schedulestartwarmup_delay) ahead. If the projected score reaches 1.0 while the integrated
+score is still below, the scaleout algorithm is triggered in advance so that new instances are ready when the load arrives.
+
+The forecast is always computed and published as the `InstanceScaleScoreForecast` CloudWatch metric to help tuning.
+                         """
+                 },
+                 "ec2.schedule.horizontalscale.predictive.alpha": 0.5,
+                 "ec2.schedule.horizontalscale.predictive.beta": 0.3,
+                 "ec2.schedule.horizontalscale.predictive.min_samples": 3,
+                 "ec2.schedule.prewarm.enable,Stable": {
+                         "DefaultValue": "0",
+                         "Format"      : "Bool",
+                         "Description" : """Enable pre-warming of the Main fleet from its learned weekly load profile.
+
+CloneSquad continuously learns, for each hour of the week (local time), the number of instances that were needed to serve the load 
+(derived from the serving fleet size and the scale score). When enabled, the minimum instance count is raised ahead of recurring 
+peaks so that instances are already started and warmed up when the load arrives.
+
+The lead time is controlled by [`ec2.schedule.prewarm.max_lead_time`](#ec2scheduleprewarmmax_lead_time) and a safety margin
+can be added with [`ec2.schedule.prewarm.safety_margin`](#ec2scheduleprewarmsafety_margin).
+
+Note: Learning always occurs even when this setting is disabled so the profile is ready when pre-warming gets enabled.
+                         """
+                 },
+                 "ec2.schedule.prewarm.max_lead_time,Stable": {
+                         "DefaultValue": "minutes=30",
+                         "Format"      : "Duration",
+                         "Description" : """How much time ahead of a learned peak the fleet is pre-warmed.
+                         """
+                 },
+                 "ec2.schedule.prewarm.safety_margin,Stable": {
+                         "DefaultValue": "10%",
+                         "Format"      : "IntegerOrPercentage",
+                         "Description" : """Number of instances to add to the learned peak when pre-warming.
+
+Percentages are relative to the learned peak instance count.
+                         """
+                 },
+                 "ec2.schedule.prewarm.learning_rate": 0.5,
+                 "ec2.schedule.prewarm.profile_ttl": "days=21",
                  "ec2.schedule.verticalscale.instance_type_distribution,Stable": {
                          "DefaultValue": "",
                          "Format"      : "MetaStringList",
@@ -266,6 +316,10 @@ is enabled, from an instance type distribution PoV.
                  "ec2.schedule.bounce_instance_jitter" : 'minutes=10',
                  "ec2.schedule.bounce_instance_cooldown" : 'minutes=10',
                  "ec2.schedule.bounce.instances_with_issue_grace_period": "minutes=10",
+                 "ec2.schedule.bounce.max_concurrent_bounces": "1",
+                 "ec2.schedule.decision_log.enable": "1",
+                 "ec2.schedule.decision_log.size": "60",
+                 "ec2.schedule.decision_log.s3_export": "0",
                  "ec2.schedule.draining.instance_cooldown,Stable": {
                          "DefaultValue": "minutes=2",
                          "Format": "Duration",
@@ -416,6 +470,9 @@ By default, the dashboard is enabled.
                 { "MetricName": "InstanceScaleScore",
                   "Unit": "None",
                   "StorageResolution": self.metric_time_resolution },
+                { "MetricName": "InstanceScaleScoreForecast",
+                  "Unit": "None",
+                  "StorageResolution": self.metric_time_resolution },
                 { "MetricName": "FleetSize",
                   "Unit": "Count",
                   "StorageResolution": self.metric_time_resolution },
@@ -464,6 +521,11 @@ By default, the dashboard is enabled.
                 "Prefix": "ec2.schedule.instance.",
                 "Compress": True,
                 "DefaultTTL": Cfg.get_duration_secs("ec2.schedule.state_ttl")
+            },
+            {
+                "Prefix": "ec2.schedule.fast_path.",
+                "Compress": True,
+                "DefaultTTL": Cfg.get_duration_secs("ec2.schedule.state_ttl")
             }
             ])
 
@@ -472,7 +534,7 @@ By default, the dashboard is enabled.
     def get_prerequisites(self):
         """ This method loads, gathers and prepares data needed by all others methods in this module.
         """
-        self.cpu_credits          = yaml.safe_load(str(misc.get_url("internal:cpu-credits.yaml"),"utf-8"))
+        self.cpu_credits          = self.ec2.cpu_credits
         self.ec2_alarmstate_table = kvtable.KVTable(self.context, self.context["AlarmStateEC2Table"])
         self.ec2_alarmstate_table.reread_table()
         self.known_spot_advisories = self.ec2.get_state_json("ec2.schedule.instance.spot.known_spot_advisories", default={})
@@ -494,66 +556,32 @@ By default, the dashboard is enabled.
             log.info("Instances %s are marked as 'unstartable'." % self.unstartable_ids)
 
         # The scheduler part is making an extensive use of filtered/sorted lists that could become
-        #   cpu and time consuming to build. We build here a library of filtered/sorted lists 
-        #   available to all algorithms.
-        # Library of filtered/sorted lists excluding the 'excluded' instances
-        xray_recorder.begin_subsegment("prerequisites:prepare_instance_lists")
-        log.debug("Computing all instance lists needed for scheduling")
-        self.all_instances                                        = self.ec2.get_instances()
-        self.all_main_fleet_instances                             = self.ec2.get_instances(main_fleet_only=True)
-        self.pending_running_instances                            = self.ec2.get_instances(State="pending,running")
-        self.instances_wo_excluded                                = self.ec2.get_instances(ScalingState="-excluded")
-        self.instances_wo_excluded_error                          = self.ec2.get_instances(instances=self.instances_wo_excluded, ScalingState="-error")
-        self.running_instances_wo_excluded                        = self.ec2.get_instances(instances=self.instances_wo_excluded, State="running")
-        self.pending_instances_wo_draining_excluded               = self.ec2.get_instances(instances=self.instances_wo_excluded, State="pending", ScalingState="-draining")
-        self.stopped_instances_wo_excluded                        = self.ec2.get_instances(instances=self.instances_wo_excluded, State="stopped")
-        self.stopped_instances_wo_excluded_error                  = self.ec2.get_instances(instances=self.instances_wo_excluded, State="stopped", ScalingState="-error")
-        self.stopping_instances_wo_excluded                       = self.ec2.get_instances(instances=self.instances_wo_excluded, State="stopping")
-        self.pending_running_instances_draining_wo_excluded       = self.ec2.get_instances(instances=self.instances_wo_excluded, State="pending,running", ScalingState="draining")
-        self.pending_running_instances_bounced_wo_excluded        = self.ec2.get_instances(instances=self.instances_wo_excluded, State="pending,running", ScalingState="bounced")
-        self.pending_running_instances_wo_excluded                = self.ec2.get_instances(instances=self.instances_wo_excluded, State="pending,running")
-        self.pending_running_instances_wo_excluded_draining_error = self.ec2.get_instances(instances=self.instances_wo_excluded, State="pending,running", ScalingState="-draining,error")
-        # Other filtered/sorted lists
-        self.stopped_instances_wo_excluded_error    = self.ec2.get_instances(State="stopped", ScalingState="-excluded,error")
-        self.pending_running_instances_draining     = self.ec2.get_instances(State="pending,running", ScalingState="draining")
-        self.excluded_instances                     = self.ec2.get_instances(ScalingState="excluded")
-        self.error_instances                        = self.ec2.get_instances(ScalingState="error")
-        self.non_burstable_instances                = self.ec2.get_non_burstable_instances()
-        self.stopped_instances_bounced_draining     = self.ec2.get_instances(State="stopped", ScalingState="bounced,draining")
+        #   cpu and time consuming to build. We declare here a library of filtered/sorted lists 
+        #   available to all algorithms. They are lazily computed on first access and frozen
+        #   before the first instance change of the run (see get_instance_list_library()).
+        self.instance_list_library = self.get_instance_list_library()
+        self.instance_list_cache   = {}
+        self.instance_lists_frozen = False
+        self.ec2.register_instance_change_listener(self.freeze_instance_lists, before=True)
+
+        # Scaling decisions and actions of this run are recorded in the decision log (see save_decision_record())
+        self.decision_record = {
+            "Date": str(self.context["now"]),
+            "Direction": None,
+            "Scores": None,
+            "ScaleCount": None,
+            "Actions": [],
+            "StartedInstanceIds": [],
+            "StoppedInstanceIds": [],
+            "ScalingStates": {}
+        }
+        self.ec2.register_instance_change_listener(self.record_decision_instance_change)
 
-        # Useable and serving instances
+        # Spot exclusion lists are needed to qualify instances with issues
         self.compute_spot_exclusion_lists()
-        self.initializing_instances                 = self.get_initial_instances()
-        self.cpu_exhausted_instances                = self.get_cpu_exhausted_instances()
-        self.unhealthy_instances_in_targetgroups    = self.targetgroup.get_registered_instance_ids(state="unavail,unhealthy")
-        self.subfleet_cpu_crediting_ids             = defaultdict(list)
-        self.need_mainfleet_cpu_crediting_ids       = []
-        self.need_cpu_crediting_instance_ids        = self.compute_cpu_crediting_instances(self.need_mainfleet_cpu_crediting_ids, 
-                self.subfleet_cpu_crediting_ids)
-        self.ready_for_operation_timeouted_instances = self.get_ready_for_operation_timeouted_instances()
-        self.ready_for_shutdown_timeouted_instances = self.get_ready_for_shutdown_timeouted_instances()
-        self.instances_with_issues                  = self.get_instances_with_issues()
-        self.useable_instances                      = self.get_useable_instances()
-        self.useable_instance_count                 = self.get_useable_instance_count()
-        self.useable_instances_wo_excluded_draining = self.get_useable_instances(instances=self.instances_wo_excluded, ScalingState="-draining")
-        self.serving_instances                      = self.get_useable_instances(exclude_initializing_instances=True)
 
-        # LightHouse filtered/sorted lists
-        self.lighthouse_instances_wo_excluded_ids     = self.get_lighthouse_instance_ids(self.instances_wo_excluded)
-        self.draining_lighthouse_instances_ids        = self.get_lighthouse_instance_ids(instances=self.pending_running_instances_draining_wo_excluded)
-        self.serving_lighthouse_instances_ids         = self.get_lighthouse_instance_ids(self.serving_instances)
-        self.useable_lighthouse_instance_ids          = self.get_lighthouse_instance_ids(self.useable_instances)
-        self.serving_non_lighthouse_instance_ids      = list(filter(lambda i: i["InstanceId"] not in self.lighthouse_instances_wo_excluded_ids, self.useable_instances_wo_excluded_draining))
-        self.serving_non_lighthouse_instance_ids_initializing = list(filter(lambda i: i["InstanceId"] not in self.useable_lighthouse_instance_ids, self.get_useable_instances(initializing_only=True)))
-        self.lh_stopped_instances_wo_excluded_error   = self.get_lighthouse_instance_ids(instances=self.stopped_instances_wo_excluded_error)
-
-        # Subfleets
-        self.subfleet_instances              = self.ec2.get_subfleet_instances()
-        self.subfleet_instances_w_excluded   = self.ec2.get_subfleet_instances(with_excluded_instances=True)
-        self.running_subfleet_instances      = self.ec2.get_instances(instances=self.subfleet_instances, State="pending,running")
-        self.draining_subfleet_instances     = self.ec2.get_instances(instances=self.subfleet_instances, ScalingState="draining")
-        log.debug("End of instance list computation.")
-        xray_recorder.end_subsegment()
+        # Pre-warming raises the minimum instance count from the learned weekly profile
+        self.load_prewarm_profile()
 
 
         # Garbage collect zombie states (i.e. instances do not exist anymore but have still states in state table)
@@ -664,6 +692,124 @@ By default, the dashboard is enabled.
 
 
 
+    ###############################################
+    #### INSTANCE LIST LIBRARY ####################
+    ###############################################
+
+    def get_instance_list_library(self):
+        """ Return the declaration of the lazily evaluated instance lists.
+
+        Lists are memoised on first access as a regular attribute (ex: 'self.useable_instances'). They are snapshots 
+        of the fleet at the beginning of the scheduling: All lists not yet computed are materialized just before the first 
+        instance change of the run (see freeze_instance_lists()) and are never recomputed afterward.
+
+        :return A dict of list name -> {"Func": callable}
+        """
+        ec2     = self.ec2
+        library = {}
+        def _declare(name, func):
+            library[name] = {"Func": func}
+
+        # Library of filtered/sorted lists excluding the 'excluded' instances
+        _declare("all_instances",                               lambda: ec2.get_instances())
+        _declare("all_main_fleet_instances",                    lambda: ec2.get_instances(main_fleet_only=True))
+        _declare("pending_running_instances",                   lambda: ec2.get_instances(State="pending,running"))
+        _declare("instances_wo_excluded",                       lambda: ec2.get_instances(ScalingState="-excluded"))
+        _declare("instances_wo_excluded_error",                 lambda: ec2.get_instances(instances=self.instances_wo_excluded, ScalingState="-error"))
+        _declare("running_instances_wo_excluded",               lambda: ec2.get_instances(instances=self.instances_wo_excluded, State="running"))
+        _declare("pending_instances_wo_draining_excluded",      lambda: ec2.get_instances(instances=self.instances_wo_excluded, State="pending", ScalingState="-draining"))
+        _declare("stopped_instances_wo_excluded",               lambda: ec2.get_instances(instances=self.instances_wo_excluded, State="stopped"))
+        _declare("stopping_instances_wo_excluded",              lambda: ec2.get_instances(instances=self.instances_wo_excluded, State="stopping"))
+        _declare("pending_running_instances_draining_wo_excluded", lambda: ec2.get_instances(instances=self.instances_wo_excluded, State="pending,running", ScalingState="draining"))
+        _declare("pending_running_instances_bounced_wo_excluded", lambda: ec2.get_instances(instances=self.instances_wo_excluded, State="pending,running", ScalingState="bounced"))
+        _declare("pending_running_instances_wo_excluded",       lambda: ec2.get_instances(instances=self.instances_wo_excluded, State="pending,running"))
+        _declare("pending_running_instances_wo_excluded_draining_error", lambda: ec2.get_instances(instances=self.instances_wo_excluded, State="pending,running", ScalingState="-draining,error"))
+        # Other filtered/sorted lists
+        _declare("stopped_instances_wo_excluded_error", lambda: ec2.get_instances(State="stopped", ScalingState="-excluded,error"))
+        _declare("pending_running_instances_draining",  lambda: ec2.get_instances(State="pending,running", ScalingState="draining"))
+        _declare("excluded_instances",                  lambda: ec2.get_instances(ScalingState="excluded"))
+        _declare("error_instances",                     lambda: ec2.get_instances(ScalingState="error"))
+        _declare("non_burstable_instances",             lambda: ec2.get_non_burstable_instances())
+        _declare("stopped_instances_bounced_draining",  lambda: ec2.get_instances(State="stopped", ScalingState="bounced,draining"))
+
+        # Useable and serving instances
+        _declare("initializing_instances",              lambda: self.get_initial_instances())
+        _declare("initializing_instance_ids",           lambda: set(i["InstanceId"] for i in self.initializing_instances))
+        _declare("cpu_exhausted_instances",             lambda: self.get_cpu_exhausted_instances())
+        _declare("unhealthy_instances_in_targetgroups", lambda: self.targetgroup.get_registered_instance_ids(state="unavail,unhealthy"))
+        def _cpu_crediting():
+            subfleet_cpu_crediting_ids       = defaultdict(list)
+            need_mainfleet_cpu_crediting_ids = []
+            need_cpu_crediting_instance_ids  = self.compute_cpu_crediting_instances(need_mainfleet_cpu_crediting_ids, 
+                    subfleet_cpu_crediting_ids)
+            return (need_cpu_crediting_instance_ids, need_mainfleet_cpu_crediting_ids, subfleet_cpu_crediting_ids)
+        _declare("cpu_crediting",                           _cpu_crediting)
+        _declare("need_cpu_crediting_instance_ids",         lambda: self.cpu_crediting[0])
+        _declare("need_mainfleet_cpu_crediting_ids",        lambda: self.cpu_crediting[1])
+        _declare("subfleet_cpu_crediting_ids",              lambda: self.cpu_crediting[2])
+        _declare("ready_for_operation_timeouted_instances", lambda: self.get_ready_for_operation_timeouted_instances())
+        _declare("ready_for_shutdown_timeouted_instances",  lambda: self.get_ready_for_shutdown_timeouted_instances())
+        _declare("instances_with_issues",                   lambda: self.get_instances_with_issues())
+        _declare("instance_ids_with_issues",                lambda: set(self.instances_with_issues))
+        _declare("useable_instances",                       lambda: self.get_useable_instances())
+        _declare("useable_instance_count",                  lambda: self.get_useable_instance_count())
+        _declare("useable_instances_wo_excluded_draining",  lambda: self.get_useable_instances(instances=self.instances_wo_excluded, ScalingState="-draining"))
+        _declare("serving_instances",                       lambda: self.get_useable_instances(exclude_initializing_instances=True))
+
+        # LightHouse filtered/sorted lists
+        _declare("lighthouse_instances_wo_excluded_ids",        lambda: self.get_lighthouse_instance_ids(self.instances_wo_excluded))
+        _declare("draining_lighthouse_instances_ids",           lambda: self.get_lighthouse_instance_ids(instances=self.pending_running_instances_draining_wo_excluded))
+        _declare("serving_lighthouse_instances_ids",            lambda: self.get_lighthouse_instance_ids(self.serving_instances))
+        _declare("useable_lighthouse_instance_ids",             lambda: self.get_lighthouse_instance_ids(self.useable_instances))
+        _declare("serving_non_lighthouse_instance_ids",         lambda: self._filter_out_instance_ids(self.useable_instances_wo_excluded_draining, self.lighthouse_instances_wo_excluded_ids))
+        _declare("serving_non_lighthouse_instance_ids_initializing", lambda: self._filter_out_instance_ids(self.get_useable_instances(initializing_only=True), self.useable_lighthouse_instance_ids))
+        _declare("lh_stopped_instances_wo_excluded_error",      lambda: self.get_lighthouse_instance_ids(instances=self.stopped_instances_wo_excluded_error))
+        _declare("useable_non_lighthouse_instance_count",       lambda: self.count_non_lighthouse_instances(self.useable_instances))
+        _declare("non_lighthouse_instance_count_wo_excluded_error_spotexcluded", lambda: self.count_non_lighthouse_instances(self.instances_wo_excluded_error_spotexcluded))
+
+        # Subfleets
+        _declare("subfleet_instances",            lambda: ec2.get_subfleet_instances())
+        _declare("subfleet_instances_w_excluded", lambda: ec2.get_subfleet_instances(with_excluded_instances=True))
+        _declare("running_subfleet_instances",    lambda: ec2.get_instances(instances=self.subfleet_instances, State="pending,running"))
+        _declare("draining_subfleet_instances",   lambda: ec2.get_instances(instances=self.subfleet_instances, ScalingState="draining"))
+
+        return library
+
+    def _filter_out_instance_ids(self, instances, instance_ids):
+        """ Return the supplied instance list without instances which id is in 'instance_ids'.
+        """
+        instance_ids = set(instance_ids)
+        return [i for i in instances if i["InstanceId"] not in instance_ids]
+
+    def __getattr__(self, name):
+        """ Lazily compute and memoise lists declared in the instance list library.
+
+        This method is only called when the regular attribute lookup fails.
+        """
+        library = self.__dict__.get("instance_list_library")
+        if library is None or name not in library or "Func" not in library[name]:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        cache = self.__dict__["instance_list_cache"]
+        if name not in cache:
+            cache[name] = library[name]["Func"]()
+        return cache[name]
+
+    def freeze_instance_lists(self, instance_id, change):
+        """ Materialize all the lists of the instance list library not yet computed.
+
+        Called by EC2 module just before the first instance state or scaling state change of the run (see 
+        EC2.register_instance_change_listener()) so algorithms keep working on a consistent snapshot of the fleet taken 
+        before any start, stop or scaling state change.
+
+        :param instance_id: The instance id about to change
+        :param change: 'State' or 'ScalingState'
+        """
+        if self.__dict__.get("instance_lists_frozen", True):
+            return
+        self.instance_lists_frozen = True
+        for name in self.instance_list_library:
+            getattr(self, name)
+
     ###############################################
     #### UTILITY FUNCTIONS ########################
     ###############################################
@@ -704,7 +850,81 @@ By default, the dashboard is enabled.
         :return An integer (number of instances)
         """
         instances = self.all_main_fleet_instances 
-        return max(0, Cfg.get_abs_or_percent("ec2.schedule.min_instance_count", -1, len(instances)))
+        min_instance_count = max(0, Cfg.get_abs_or_percent("ec2.schedule.min_instance_count", -1, len(instances)))
+        # Pre-warming can not require more instances than the fleet size
+        return max(min_instance_count, min(len(instances), self.prewarm_instance_count))
+
+    ###############################################
+    #### PRE-WARMING ##############################
+    ###############################################
+
+    PREWARM_BUCKETS = 7 * 24
+
+    def get_prewarm_bucket(self, local_date):
+        """ Return the weekly profile bucket (hour of the week) of a local date.
+        """
+        return local_date.weekday() * 24 + local_date.hour
+
+    def load_prewarm_profile(self):
+        """ Load the learned weekly profile and compute the pre-warming instance count for this run.
+        """
+        self.prewarm_local_now     = misc.local_now(self.context)
+        self.prewarm_instance_count = 0
+        profile = self.ec2.get_state("ec2.schedule.prewarm.weekly_profile", default="").split(",")
+        if len(profile) != self.PREWARM_BUCKETS:
+            profile = [""] * self.PREWARM_BUCKETS
+        self.prewarm_profile = profile
+
+        if not Cfg.get_int("ec2.schedule.prewarm.enable"):
+            return
+        # Look at all the buckets overlapping [now, now + max_lead_time]
+        lead_time = Cfg.get_duration_secs("ec2.schedule.prewarm.max_lead_time")
+        first     = self.get_prewarm_bucket(self.prewarm_local_now)
+        last      = self.get_prewarm_bucket(self.prewarm_local_now + timedelta(seconds=lead_time))
+        if last < first: last += self.PREWARM_BUCKETS
+        values    = [float(profile[b % self.PREWARM_BUCKETS]) for b in range(first, last + 1) if profile[b % self.PREWARM_BUCKETS] != ""]
+        if not len(values):
+            return
+        peak = max(values)
+        self.prewarm_instance_count = int(math.ceil(peak + max(0, Cfg.get_abs_or_percent("ec2.schedule.prewarm.safety_margin", 0, peak))))
+        if self.prewarm_instance_count:
+            log.info(f"Pre-warming: Learned peak of {peak:.1f} instance(s) within the next {lead_time} seconds. "
+                    f"Raising minimum instance count to {self.prewarm_instance_count}.")
+
+    def update_prewarm_profile(self):
+        """ Record the number of instances needed now in the weekly profile.
+
+        The peak need observed during the current hour is tracked in a state key of the 'ec2.schedule.instance.' aggregate 
+        (rewritten only when the peak rises or the hour changes) and folded into the profile (exponential smoothing 
+        across weeks) when the hour of the week changes.
+        """
+        # The serving fleet is fully needed while the score stays above the scalein threshold; below, only
+        #   a score-proportional part of it is (this avoids pre-warmed instances sustaining their own profile).
+        serving_count      = self.useable_instance_count
+        score              = self.integrated_raw_instance_scale_score
+        scalein_threshold  = Cfg.get_float("ec2.schedule.scalein.threshold_ratio")
+        need               = serving_count * (max(1.0, score) if score >= scalein_threshold else score / scalein_threshold)
+        need               = min(len(self.all_main_fleet_instances), need)
+        bucket             = self.get_prewarm_bucket(self.prewarm_local_now)
+
+        previous = self.ec2.get_state("ec2.schedule.instance.prewarm.current_bucket", default="")
+        current  = previous.split("=")
+        try:
+            current_bucket, current_peak = int(current[0]), float(current[1])
+        except:
+            current_bucket, current_peak = bucket, 0.0
+        ttl = Cfg.get_duration_secs("ec2.schedule.prewarm.profile_ttl")
+        if current_bucket != bucket:
+            rate     = Cfg.get_float("ec2.schedule.prewarm.learning_rate")
+            previous = self.prewarm_profile[current_bucket % self.PREWARM_BUCKETS]
+            learned  = current_peak if previous == "" else (1 - rate) * float(previous) + rate * current_peak
+            self.prewarm_profile[current_bucket % self.PREWARM_BUCKETS] = "%.1f" % learned
+            self.ec2.set_state("ec2.schedule.prewarm.weekly_profile", ",".join(self.prewarm_profile), TTL=ttl)
+            log.debug(f"Pre-warming: Learned {learned:.1f} instance(s) for hour-of-week bucket {current_bucket}.")
+            current_peak = 0.0
+        value = "%d=%.1f" % (bucket, max(current_peak, need))
+        if value != previous:
+            self.ec2.set_state("ec2.schedule.instance.prewarm.current_bucket", value, TTL=self.state_ttl)
 
     def desired_instance_count(self):
         """ Return the desired instance count linked in 'ec2.schedule.desired_instance_count'.
@@ -764,23 +984,27 @@ By default, the dashboard is enabled.
         active_instances        = self.pending_running_instances
         instances_with_issue_ids= []
 
+        seen_ids                = set()
+        def _add(instance_ids):
+            for i in instance_ids:
+                if i not in seen_ids:
+                    seen_ids.add(i)
+                    instances_with_issue_ids.append(i)
+
         # TargetGroup related issues
         instances_with_issue_ids.extend(self.unhealthy_instances_in_targetgroups)
+        seen_ids.update(instances_with_issue_ids)
 
         # EC2 related issues
-        impaired_instances      = [i["InstanceId"] for i in active_instances 
-                if self.ec2.is_instance_state(i["InstanceId"], ["impaired", "unhealthy", "az_evicted"]) ]
-        [ instances_with_issue_ids.append(i) for i in impaired_instances if i not in instances_with_issue_ids]
+        _add([i["InstanceId"] for i in active_instances 
+                if self.ec2.is_instance_state(i["InstanceId"], ["impaired", "unhealthy", "az_evicted"]) ])
 
         # Interrupted spot instances are 'unhealthy' too
-        for i in self.spot_excluded_instance_ids:
-            instance = self.ec2.get_instance_by_id(i)
-            if instance["State"]["Name"] == "running" and i not in instances_with_issue_ids:
-                instances_with_issue_ids.append(i)
+        _add([i for i in self.spot_excluded_instance_ids if self.ec2.get_instance_by_id(i)["State"]["Name"] == "running"])
 
         # Add faulty instances that go beyond their time for 'ready_for_operation' and 'ready_for_shutdown' event
-        instances_with_issue_ids.extend([i for i in self.ready_for_operation_timeouted_instances if i not in instances_with_issue_ids])
-        instances_with_issue_ids.extend([i for i in self.ready_for_shutdown_timeouted_instances  if i not in instances_with_issue_ids])
+        _add(self.ready_for_operation_timeouted_instances)
+        _add(self.ready_for_shutdown_timeouted_instances)
 
         return instances_with_issue_ids
 
@@ -801,19 +1025,25 @@ By default, the dashboard is enabled.
         """
         if ScalingState is None: ScalingState = "-excluded,draining,error%s" % (",bounced" if exclude_bounced_instances else "")
         active_instances = self.ec2.get_instances(instances=instances, State=State, ScalingState=ScalingState)
-        
-        instances_ids_with_issues   = self.instances_with_issues 
+        is_useable       = self._get_useable_instance_filter(exclude_problematic_instances=exclude_problematic_instances,
+                exclude_initializing_instances=exclude_initializing_instances, initializing_only=initializing_only)
+        return [i for i in active_instances if is_useable(i["InstanceId"])]
 
-        if exclude_problematic_instances:
-            active_instances = list(filter(lambda i: i["InstanceId"] not in instances_ids_with_issues, active_instances))
-
-        if initializing_only:
-            active_instances = list(filter(lambda i: i["InstanceId"] in self.initializing_instances, active_instances))
-
-        if exclude_initializing_instances:
-            active_instances = list(filter(lambda i: i["InstanceId"] not in self.initializing_instances, active_instances))
-
-        return active_instances
+    def _get_useable_instance_filter(self, exclude_problematic_instances=True, exclude_initializing_instances=False, initializing_only=False):
+        """ Return a predicate on instance id implementing useable instance criteria based on id sets.
+        """
+        instance_ids_with_issues  = self.instance_ids_with_issues if exclude_problematic_instances else set()
+        initializing_instance_ids = self.initializing_instance_ids if initializing_only or exclude_initializing_instances else set()
+        def _is_useable(instance_id):
+            if instance_id in instance_ids_with_issues:
+                return False
+            is_initializing = instance_id in initializing_instance_ids
+            if initializing_only and not is_initializing:
+                return False
+            if exclude_initializing_instances and is_initializing:
+                return False
+            return True
+        return _is_useable
 
     def get_useable_instance_count(self, exclude_problematic_instances=True, exclude_bounced_instances=True, 
             exclude_initializing_instances=False, initializing_only=False):
@@ -826,9 +1056,10 @@ By default, the dashboard is enabled.
         :param initializing_only:               Filter in instances are 'initializing' state
         :return An integer
         """ 
-        return len(self.get_useable_instances(exclude_problematic_instances=exclude_problematic_instances, 
-                exclude_bounced_instances=exclude_bounced_instances, exclude_initializing_instances=exclude_initializing_instances,
-                initializing_only=initializing_only))
+        ScalingState = "-excluded,draining,error%s" % (",bounced" if exclude_bounced_instances else "")
+        is_useable   = self._get_useable_instance_filter(exclude_problematic_instances=exclude_problematic_instances,
+                exclude_initializing_instances=exclude_initializing_instances, initializing_only=initializing_only)
+        return self.ec2.count_instances(State="pending,running", ScalingState=ScalingState, instance_id_filter=is_useable)
 
     def get_cpu_exhausted_instances(self, threshold=5):
         """ Return list of instances that have their CPU exhausted below the specified threshold
@@ -869,13 +1100,10 @@ By default, the dashboard is enabled.
         :param A list of instance structures.
         """
         active_instances        = self.pending_running_instances_wo_excluded if instances is None else instances
-        active_instance_ids     = [i["InstanceId"] for i in active_instances]
-        initializing_instances  = []
-        initializing_instances.extend([ i["InstanceId"] for i in active_instances if self.ec2.is_instance_state(i["InstanceId"], ["initializing"]) ])
-        registered_instance_ids = self.targetgroup.get_registered_instance_ids(state="initial")
-        initializing_instances.extend([i for i in registered_instance_ids if i in active_instance_ids])
-        young_instances         = self.get_young_instance_ids(instances=active_instances)
-        return list(filter(lambda i: i["InstanceId"] in young_instances or i["InstanceId"] in initializing_instances, active_instances))
+        initializing_ids        = set(i["InstanceId"] for i in active_instances if self.ec2.is_instance_state(i["InstanceId"], ["initializing"]))
+        initializing_ids.update(self.targetgroup.get_registered_instance_ids(state="initial"))
+        initializing_ids.update(self.get_young_instance_ids(instances=active_instances))
+        return [i for i in active_instances if i["InstanceId"] in initializing_ids]
 
     def get_initial_instances_ids(self):
         """ Return the list of 'initializing' instance ids.
@@ -913,6 +1141,7 @@ By default, the dashboard is enabled.
             self.scale_bounce()
             self.scale_bounce_instances_with_issues()
             self.scale_in_out()
+            self.update_prewarm_profile()
         else:
             log.info(meta["Message"])
 
@@ -921,6 +1150,7 @@ By default, the dashboard is enabled.
         self.manage_subfleets()
         self.generate_subfleet_dashboard()
         self.stop_drained_instances()
+        self.save_decision_record()
 
     @xray_recorder.capture()
     def send_events(self):
@@ -986,6 +1216,59 @@ By default, the dashboard is enabled.
                 o_ssm.send_events(ids, "ec2.scaling_state.change.draining.block_new_connections", 
                     "INSTANCE_BLOCK_NEW_CONNECTIONS_TO_PORTS", args, pretty_event_name="BlockNewConnectionsToPorts")
         
+    def get_unstable_reasons(self):
+        """ Return a list of reasons why the fleet is not in a stable state (empty list if stable).
+
+        A stable fleet has no instance in transition and no scaling sequence in progress so that skipping
+        the scheduling stages of a Main run can not delay a decision (see app.fast_path.enable).
+        """
+        reasons = []
+        if self.scaling_state_changed:
+            reasons.append("Instance states changed during the run")
+        for name, instances in [
+                ("pending", self.pending_instances_wo_draining_excluded),
+                ("stopping", self.stopping_instances_wo_excluded),
+                ("draining", self.pending_running_instances_draining),
+                ("bounced", self.pending_running_instances_bounced_wo_excluded),
+                ("error", self.error_instances),
+                ("initializing", self.initializing_instances),
+                ("with issues", self.instances_with_issues)]:
+            if len(instances):
+                reasons.append(f"{len(instances)} instance(s) {name}")
+        if len(self.spot_rebalance_recommended) or len(self.spot_interrupted):
+            reasons.append("Spot events in progress")
+        for direction in ["scaleout", "scalein"]:
+            if self.get_scale_start_date(direction) is not None:
+                reasons.append(f"{direction} sequence in progress")
+        if self.would_like_to_scaleout or self.would_like_to_scalein:
+            reasons.append("Scaling decision pending")
+        return reasons
+
+    def get_scale_score_band(self):
+        """ Return the band ('scaleout', 'steady' or 'scalein') of the raw scale score computed from current alarm states and metrics.
+
+        The band is a quantized view of the scaling inputs used to fingerprint the Main function runs: While the raw score
+        stays in the band of a stable run, the integrated scores can not cross a scaling threshold.
+        """
+        base_points = Cfg.get_int("ec2.schedule.base_points")
+        assessment  = {"upscale": {"guilties": [{"AlarmName": name} for name, a in self.cloudwatch.get_alarm_data_index().items()
+                            if a.get("StateValue") == "ALARM"]}}
+        score       = float(self.get_guilties_sum_points(assessment, base_points)) / float(base_points)
+        if score >= 1.0:
+            return "scaleout"
+        if score < Cfg.get_float("ec2.schedule.scalein.threshold_ratio"):
+            return "scalein"
+        return "steady"
+
+    def load_scale_scores(self):
+        """ Read back the latest integrated scale scores when take_scale_decision() is not run (fast path Main run).
+        """
+        self.integrated_raw_instance_scale_score = self.ec2.get_integrated_float_state("ec2.schedule.scaleout.raw_instance_scale_score",
+                Cfg.get_duration_secs("ec2.schedule.horizontalscale.raw_integration_period"), favor_max_value=False)
+        self.instance_scale_score = self.ec2.get_integrated_float_state("ec2.schedule.scaleout.instance_scale_score",
+                Cfg.get_duration_secs("ec2.schedule.horizontalscale.integration_period"))
+        self.instance_scale_score_forecast = self.get_scale_score_forecast(Cfg.get_duration_secs("ec2.schedule.start.warmup_delay"))
+
     @xray_recorder.capture()
     def prepare_metrics(self):
         """ Compute all module CloudWatch metrics and Synthetic metrics available through the API Gateway.
@@ -1001,7 +1284,7 @@ By default, the dashboard is enabled.
         bounced_instances           = self.pending_running_instances_bounced_wo_excluded
         error_instances             = self.error_instances
         exhausted_cpu_credits       = self.cpu_exhausted_instances
-        main_fleet_instance_ids     = [i["InstanceId"] for i in self.all_main_fleet_instances]
+        main_fleet_instance_ids     = set(i["InstanceId"] for i in self.all_main_fleet_instances)
         instances_with_issues       = [i for i in self.instances_with_issues if i in main_fleet_instance_ids]
         subfleet_instances          = self.subfleet_instances_w_excluded
         running_subfleet_instances  = self.running_subfleet_instances
@@ -1019,6 +1302,7 @@ By default, the dashboard is enabled.
         cw.set_metric("NbOfBouncedInstances",  len(bounced_instances) if fl_size > 0 else None)
         cw.set_metric("NbOfInstancesInError",  len(error_instances) if fl_size > 0 else None)
         cw.set_metric("InstanceScaleScore",    self.instance_scale_score if fl_size > 0 else None)
+        cw.set_metric("InstanceScaleScoreForecast", self.instance_scale_score_forecast if fl_size > 0 else None)
         cw.set_metric("RunningLighthouseInstances", len(self.get_lighthouse_instance_ids(running_instances)) if fl_size > 0 else None)
         cw.set_metric("NbOfInstanceInInitialState", len(self.get_initial_instances()) if fl_size > 0 else None)
         cw.set_metric("NbOfInstanceInUnuseableState", len(instances_with_issues) if fl_size > 0 else None)
@@ -1238,6 +1522,15 @@ By default, the dashboard is enabled.
 
         if delta_instance_count != 0: 
             log.debug("Instance_action (%d) from '%s'... " % (delta_instance_count, caller))
+        action = {
+            "Caller": caller,
+            "DesiredInstanceCount": desired_instance_count,
+            "ExpectedInstanceCount": expected_instance_count,
+            "UseableInstanceCount": useable_instances_count,
+            "Delta": delta_instance_count,
+            "CandidateCount": 0
+        }
+        self.decision_record["Actions"].append(action)
 
         if delta_instance_count > 0:
             # Request to add new running instances (scaleout)
@@ -1247,6 +1540,7 @@ By default, the dashboard is enabled.
             stopped_instances = self.filter_autoscaled_stopped_instance_candidates(caller, expected_instance_count, target_for_dispatch=target_for_dispatch)
             
             instance_ids_to_start = self.ec2.get_instance_ids(stopped_instances)
+            action["CandidateCount"] = len(instance_ids_to_start)
 
             # Start selected instances
             if len(instance_ids_to_start) > 0:
@@ -1283,6 +1577,7 @@ By default, the dashboard is enabled.
             active_instances = self.scaledown_sort_instances(active_instances, 
                     target_for_dispatch if target_for_dispatch is not None else expected_instance_count, 
                     caller)
+            action["CandidateCount"] = len(active_instances)
             
             instance_ids_to_drain = []
             for i in self.ec2.get_instance_ids(active_instances):
@@ -1390,13 +1685,70 @@ By default, the dashboard is enabled.
 
 
     @xray_recorder.capture()
+    def get_draining_timers(self, instances, maintenance_subfleets):
+        """ Return the draining timers of the supplied draining instances.
+
+        Each draining instance gets a timer due when its 'ec2.schedule.draining.instance_cooldown' period is elapsed.
+        Only the draining date is persisted so the due date always reflects the current cooldown setting.
+        Timers are persisted in the state table: They are created when an instance is seen draining for the first time (or
+        with a new draining date) and dropped when the instance is no more draining. The instance scaling state is refreshed when its timer is created 
+        and then only every half 'ec2.state.default_ttl' period (or at each call during a SSM Maintenance Window to force 
+        update of the draining date so the cooldown period restarts after the Maintenance Window).
+
+        :param instances: The list of draining instances
+        :param maintenance_subfleets: A dict {subfleet_name: bool} indicating if a SSM Maintenance Window is active 
+        :return A list of (due_date, instance) tuples sorted by due date
+        """
+        now       = self.context["now"]
+        cooldown  = timedelta(seconds=Cfg.get_duration_secs("ec2.schedule.draining.instance_cooldown"))
+        ttl       = self.ec2.ttl
+        timers    = self.ec2.get_state_json("ec2.schedule.draining.timers", default={})
+        if timers is None: timers = {}
+        changed   = False
+        r         = []
+        for i in instances:
+            instance_id = i["InstanceId"]
+            timer       = timers.get(instance_id)
+            meta        = {}
+            self.ec2.get_scaling_state(instance_id, meta=meta)
+            in_maintenance = maintenance_subfleets[self.ec2.get_subfleet_name_for_instance(i)]
+            if (timer is None or in_maintenance or timer["DrainingDate"] != str(meta["last_draining_date"]) or
+                    (now - misc.str2utc(timer["RefreshDate"])).total_seconds() > ttl / 2):
+                # Refresh the TTL if the 'draining' operation takes a long time
+                #   and collect metadata about the instance scaling state.
+                meta  = {}
+                self.ec2.set_scaling_state(instance_id, "draining", meta=meta, force=in_maintenance)
+                draining_date = meta["last_draining_date"]
+                if draining_date is None:
+                    log.warning(f"No 'last_draining_date' for instance {instance_id}. Bug??")
+                timer = {
+                    "DrainingDate": str(draining_date),
+                    "RefreshDate" : str(now)
+                }
+                timers[instance_id] = timer
+                changed = True
+            draining_date = misc.str2utc(timer["DrainingDate"])
+            r.append((draining_date + cooldown if draining_date is not None else now, i))
+
+        # Drop timers of instances that are no more draining
+        instance_ids = set(i["InstanceId"] for i in instances)
+        for instance_id in [i for i in timers.keys() if i not in instance_ids]:
+            del timers[instance_id]
+            changed = True
+        if changed:
+            self.ec2.set_state_json("ec2.schedule.draining.timers", timers, TTL=ttl)
+        return sorted(r, key=lambda t: t[0])
+
     def stop_drained_instances(self):
         """ Method responsible to stop instance marked as 'draining'.
+
+        Draining instances are managed with timers (see get_draining_timers()) so only instances which draining 
+        cooldown period is over are assessed.
         """
         now              = self.context["now"]
         cw               = self.cloudwatch
 
-        draining_target_instance_ids = self.targetgroup.get_registered_instance_ids(state="draining")
+        draining_target_instance_ids = set(self.targetgroup.get_registered_instance_ids(state="draining"))
         if len(draining_target_instance_ids):
             registered_targets = self.targetgroup.get_registered_targets(state="draining")
             log.debug("Registered targets: %s " % Dbg.pprint(registered_targets))
@@ -1410,7 +1762,11 @@ By default, the dashboard is enabled.
 
         # Retrieve list of instance marked as draining and running
         instances     = self.pending_running_instances_draining
-        instances_ids = self.ec2.get_instance_ids(instances) 
+        maintenance_subfleets = defaultdict(lambda: None)
+        for i in instances:
+            subfleet_name = self.ec2.get_subfleet_name_for_instance(i)
+            if maintenance_subfleets[subfleet_name] is None:
+                maintenance_subfleets[subfleet_name] = self.ssm.is_maintenance_time(fleet=subfleet_name)
 
         max_number_crediting_instances = Cfg.get_abs_or_percent("ec2.schedule.burstable_instance.max_cpu_crediting_instances", -1,
                          len(self.instances_wo_excluded))
@@ -1425,17 +1781,17 @@ By default, the dashboard is enabled.
         # Variable for autoscale fleet management
         ids_to_stop                    = []
         ssm_ready_for_shutdown_delay   = Cfg.get_duration_secs("ssm.feature.events.ec2.instance_ready_for_shutdown.max_shutdown_delay")
-        cooldown                       = Cfg.get_duration_secs("ec2.schedule.draining.instance_cooldown")
-        for i in instances:
+        registered_instance_ids        = self.targetgroup.get_instance_ids_in_targetgroup(None)
+        timers                         = self.get_draining_timers(instances, maintenance_subfleets)
+        for index, (due_date, i) in enumerate(timers):
            instance_id = i["InstanceId"]
-           # Refresh the TTL if the 'draining' operation takes a long time
-           #   and collect metadata about the instance scaling state.
-           subfleet_name = self.ec2.get_subfleet_name_for_instance(i)
-           meta          = {}
-           self.ec2.set_scaling_state(instance_id, "draining", meta=meta, 
-                   force=self.ssm.is_maintenance_time(fleet=subfleet_name)) # Fore update of 'last_draining_time' when in maintenance
+           if due_date > now:
+               log.log(log.NOTICE, "Instances %s are still in draining cooldown period (ec2.schedule.draining.instance_cooldown): "
+                    "Do not assess stop now..." % [t[1]["InstanceId"] for t in timers[index:]])
+               break
 
-           if self.ssm.is_feature_enabled("maintenance_window") and self.ssm.is_maintenance_time(fleet=subfleet_name):
+           subfleet_name = self.ec2.get_subfleet_name_for_instance(i)
+           if self.ssm.is_feature_enabled("maintenance_window") and maintenance_subfleets[subfleet_name]:
                log.info(f"Can't stop drained instance {instance_id} while a SSM Maintenance window is active.")
                continue
             
@@ -1447,20 +1803,15 @@ By default, the dashboard is enabled.
                log.info(f"Can't stop yet instance {instance_id} as marked as unstoppable...")
                continue
 
-           if self.targetgroup.is_instance_registered(None, instance_id):
+           if instance_id in registered_instance_ids:
                log.log(log.NOTICE, "Instance %s if still part of a Target Group. Wait for eviction before to stop it..." % instance_id)
                continue
 
+           meta          = {}
+           self.ec2.get_scaling_state(instance_id, meta=meta)
            draining_date = meta["last_draining_date"]
-           if draining_date is None:
-               log.warning(f"No 'last_draining_date' for instance {instance_id}. Bug??")
-           else:
+           if draining_date is not None:
                elapsed_time  = now - draining_date
-               if elapsed_time < timedelta(seconds=cooldown):
-                   log.log(log.NOTICE, "Instance '%s' is still in draining cooldown period (elapsed_time=%d, ec2.schedule.draining.instance_cooldown=%d): "
-                        "Do not assess stop now..." % (instance_id, elapsed_time.total_seconds(), cooldown))
-                   continue
-
                if (self.ssm.is_feature_enabled("events.ec2.instance_ready_for_shutdown") and 
                        elapsed_time < timedelta(seconds=ssm_ready_for_shutdown_delay)):
                    # Check SSM based instance-ready-for-shutdown status
@@ -1538,14 +1889,34 @@ By default, the dashboard is enabled.
                 self.ec2.start_instances([instance_id])
                 self.scaling_state_changed = True
 
-    def subfleet_action(self, subfleet, delta):
+    def get_subfleet_partitions(self, instances):
+        """ Partition subfleet instances per subfleet name in a single pass.
+
+        :param instances:   List of subfleet instances (including excluded ones)
+        :return A dict {subfleet_name: {"Instances": [<all instances>], "NotExcluded": [<instances not excluded>]}}
+        """
+        partitions = {}
+        for i in instances:
+            subfleet_name = self.ec2.get_subfleet_name_for_instance(i)
+            if subfleet_name not in partitions:
+                partitions[subfleet_name] = {"Instances": [], "NotExcluded": []}
+            partition = partitions[subfleet_name]
+            partition["Instances"].append(i)
+            if not self.ec2.is_instance_excluded(i):
+                partition["NotExcluded"].append(i)
+        return partitions
+
+    def subfleet_action(self, subfleet, delta, partition=None, start_requests=None):
         """ Method responsable to change the amount of running instances is a subfleet.
 
         It is similar to instance_action() but to manage subfleet instance count.
         The method is responsible to start/stop instances based on vertical scaling policy and instance conditions ('initializing', too young etc...)
 
-        :param subfleet:    Name of the subfleet to manage
-        :param delta:       Number of instances to start or stop in the subfleet
+        :param subfleet:        Name of the subfleet to manage
+        :param delta:           Number of instances to start or stop in the subfleet
+        :param partition:       Subfleet instance partition (see get_subfleet_partitions()). Computed from the inventory if None.
+        :param start_requests:  If specified, a dict where start requests are recorded (for a batched start with 
+                                    EC2.start_instances_by_group()) instead of being sent immediatly.
         """
         def _verticalscale_sort_and_warn(subfleet, candidates, reverse=False):
             """ Take into account vertical scaling policy if it exists for the subfleet.
@@ -1576,18 +1947,19 @@ By default, the dashboard is enabled.
                         ([i["InstanceId"] for i in vertical_sorted_instances["lh_instances"]]))
             return candidates
         
-        fleet_instances        = self.ec2.get_subfleet_instances(subfleet_name=subfleet, with_excluded_instances=True) 
+        if partition is None:
+            fleet_instances = self.ec2.get_subfleet_instances(subfleet_name=subfleet, with_excluded_instances=True) 
+            partition       = self.get_subfleet_partitions(fleet_instances).get(subfleet, {"Instances": [], "NotExcluded": []})
+        fleet_instances        = partition["Instances"]
         min_instance_count     = max(0, get_subfleet_key_abs_or_percent("ec2.schedule.min_instance_count", subfleet,
                                         0, len(fleet_instances)))
         desired_instance_count = max(0, get_subfleet_key_abs_or_percent("ec2.schedule.desired_instance_count", subfleet,
                                         len(fleet_instances), len(fleet_instances)))
 
         instance_count    = max(min_instance_count, desired_instance_count)
-        running_instances = self.ec2.get_instances(instances=fleet_instances, 
+        running_instances = self.ec2.get_instances(instances=partition["NotExcluded"], 
                 State="pending,running", ScalingState="-error,draining,bounced")
-        running_instances = self.ec2.filter_out_excluded_instances(running_instances)
-        stopped_instances = self.ec2.get_instances(instances=fleet_instances, State="stopped")
-        stopped_instances = self.ec2.filter_out_excluded_instances(stopped_instances)
+        stopped_instances = self.ec2.get_instances(instances=partition["NotExcluded"], State="stopped")
         delta             = instance_count - len(running_instances) + delta
         if delta > 0:
             # Request to add new running instances.
@@ -1607,7 +1979,10 @@ By default, the dashboard is enabled.
                 self.letter_box_subfleet_to_stop_drained_instances[subfleet] = delta - len(instances_to_start)
             if len(instances_to_start):
                 log.info(f"Starting up to {delta} subfleet instance(s) (fleet={subfleet})...")
-                self.ec2.start_instances(instances_to_start, max_started_instances=delta)
+                if start_requests is not None:
+                    start_requests[subfleet] = (instances_to_start, delta)
+                else:
+                    self.ec2.start_instances(instances_to_start, max_started_instances=delta)
                 self.scaling_state_changed = True
         if delta < 0:
             # Request to stop running instances.
@@ -1641,22 +2016,24 @@ By default, the dashboard is enabled.
 
     def manage_subfleets(self):
         """ Module entrypoint for subfleet instance management.
+
+        Subfleet instances are partitioned in a single pass and instances to start in all subfleets are 
+        batched together in shared start_instances() API calls.
         """
-        instances = self.subfleet_instances_w_excluded
-        subfleets = {}
-        for i in instances:
-            instance_id    = i["InstanceId"]
-            subfleet_name  = self.ec2.get_subfleet_name_for_instance(i)
+        partitions = self.get_subfleet_partitions(self.subfleet_instances_w_excluded)
+        subfleets  = {}
+        for subfleet_name, partition in partitions.items():
+            instance_ids    = [i["InstanceId"] for i in partition["Instances"]]
             forbidden_chars = "[ .]"
             if re.match(forbidden_chars, subfleet_name):
-                log.warning("Instance '%s' contains invalid characters (%s)!! Ignore this instance..." % (instance_id, forbidden_chars))
+                log.warning("Instances %s contain invalid characters (%s)!! Ignore these instances..." % (instance_ids, forbidden_chars))
                 continue
             expected_state = get_subfleet_key("state", subfleet_name, none_on_failure=True)
             if expected_state is None:
-                log.log(log.NOTICE, "Encountered a subfleet instance (%s) without state directive. Please set 'subfleet.%s.state' configuration key..." % 
-                        (instance_id, subfleet_name))
+                log.log(log.NOTICE, "Encountered subfleet instances (%s) without state directive. Please set 'subfleet.%s.state' configuration key..." % 
+                        (instance_ids, subfleet_name))
                 continue
-            log.debug("Manage subfleet instance '%s': subfleet_name=%s, expected_state=%s" % (instance_id, subfleet_name, expected_state))
+            log.debug("Manage subfleet instances '%s': subfleet_name=%s, expected_state=%s" % (instance_ids, subfleet_name, expected_state))
 
             meta = {}
             self.is_subfleet_enabled(subfleet_name, meta)
@@ -1665,26 +2042,21 @@ By default, the dashboard is enabled.
                 log.warning(meta["Message"])
                 continue
 
-            if subfleet_name not in subfleets:
-                subfleets[subfleet_name] = defaultdict(list)
-                subfleets[subfleet_name]["size"] = 0
-            subfleets[subfleet_name]["expected_state"] = expected_state
-            subfleets[subfleet_name]["size"] += 1
-
-            if self.ec2.is_instance_excluded(i):
-                continue # Ignore instances marked as excluded
-
-            if expected_state == "running":
-                subfleets[subfleet_name]["ToStart"].append(i)
-
-            if (expected_state == "stopped" and i["State"]["Name"] in ["pending", "running"]):
-                subfleets[subfleet_name]["ToStop"].append(i)
-
-            subfleets[subfleet_name]["All"].append(i)
+            # Instances marked as excluded are ignored
+            subfleets[subfleet_name] = {
+                "expected_state": expected_state,
+                "size": len(partition["Instances"]),
+                "All": partition["NotExcluded"],
+                "ToStop": [i for i in partition["NotExcluded"] 
+                    if expected_state == "stopped" and i["State"]["Name"] in ["pending", "running"]],
+                "Partition": partition,
+                "min_instance_count": 0,
+                "desired_instance_count": 0
+            }
 
         # Manage start/stop of 'running' subfleet
+        start_requests = {}
         for subfleet in subfleets:
-            min_instance_count = desired_instance_count = 0
             fleet              = subfleets[subfleet]
             expected_state     = fleet["expected_state"]
             if not self.is_subfleet_enabled(subfleet): #expected_state in ["undefined", ""]:
@@ -1699,7 +2071,7 @@ By default, the dashboard is enabled.
                     if len(instance_ids):
                         if self.ssm.is_feature_enabled("maintenance_window") and self.ssm.is_maintenance_time(fleet=subfleet):
                             log.info(f"Scale-in actions disabled during '{subfleet}' subfleet SSM Maintenance Window: "
-                                "Should have placed in 'draining' state up to %s instances..." % len(instances_to_stop))
+                                "Should have placed in 'draining' state up to %s instances..." % len(instance_ids))
                         else:
                             log.info(f"Draining instance(s) '{instance_ids}' from 'stopped' fleet '{subfleet}'...")
                             for instance_id in instance_ids:
@@ -1709,28 +2081,31 @@ By default, the dashboard is enabled.
 
                 if expected_state == "running":
                     # Ensure that the right number of instances are started
-                    min_instance_count, desired_instance_count = self.subfleet_action(subfleet, 0)
+                    fleet["min_instance_count"], fleet["desired_instance_count"] = self.subfleet_action(subfleet, 0, 
+                            partition=fleet["Partition"], start_requests=start_requests)
+
+        # Start instances of all subfleets at once
+        if len(start_requests):
+            self.ec2.start_instances_by_group(start_requests)
 
-            # Publish subfleet metrics if requested
+        # Publish subfleet metrics if requested
+        cw = self.cloudwatch
+        for subfleet in subfleets:
+            fleet      = subfleets[subfleet]
             dimensions = [{
                 "Name": "SubfleetName",
                 "Value": subfleet}]
-            cw = self.cloudwatch
             if Cfg.get_int(f"subfleet.{subfleet}.ec2.schedule.metrics.enable"):
                 running_instances  = self.ec2.get_instances(instances=fleet["All"], 
                         State="pending,running", ScalingState="-error")
-                running_instances  = self.ec2.filter_out_excluded_instances(running_instances)
                 initial_instances  = self.get_initial_instances(instances=running_instances)
                 draining_instances = self.ec2.get_instances(instances=fleet["All"], 
                         State="pending,running", ScalingState="draining")
-                draining_instances  = self.ec2.filter_out_excluded_instances(draining_instances)
-                subfleet_instances_w_excluded = self.ec2.get_subfleet_instances(subfleet_name=subfleet, 
-                        with_excluded_instances=True)
                 subfleet_faulty_instance_ids_w_excluded = [i["InstanceId"] for i in running_instances 
-                        if i["InstanceId"] in self.instances_with_issues]
+                        if i["InstanceId"] in self.instance_ids_with_issues]
                 fleet_size             = fleet["size"]
                 fleet_size_wo_excluded = len(fleet["All"]) 
-                excluded_count = len(subfleet_instances_w_excluded) - fleet_size_wo_excluded
+                excluded_count = len(fleet["Partition"]["Instances"]) - fleet_size_wo_excluded
                 cw.set_metric("EC2.Size", fleet_size if fleet_size else None, dimensions=dimensions)
                 cw.set_metric("EC2.ExcludedInstances", 
                         excluded_count if fleet_size else None, dimensions=dimensions)
@@ -1738,11 +2113,11 @@ By default, the dashboard is enabled.
                         len(running_instances) if fleet_size else None, dimensions=dimensions)
                 cw.set_metric("EC2.DrainingInstances", 
                         len(draining_instances) if fleet_size else None, dimensions=dimensions)
-                send_metric    = (expected_state == "running") and fleet_size
+                send_metric    = (fleet["expected_state"] == "running") and fleet_size
                 cw.set_metric("EC2.MinInstanceCount", 
-                        min_instance_count if send_metric else None, dimensions=dimensions)
+                        fleet["min_instance_count"] if send_metric else None, dimensions=dimensions)
                 cw.set_metric("EC2.DesiredInstanceCount", 
-                        desired_instance_count if send_metric else None, dimensions=dimensions)
+                        fleet["desired_instance_count"] if send_metric else None, dimensions=dimensions)
                 cw.set_metric("EC2.NbOfInstanceInUnuseableState", 
                         len(subfleet_faulty_instance_ids_w_excluded) if fleet_size else None, dimensions=dimensions)
                 cw.set_metric("EC2.NbOfInstanceInInitialState", 
@@ -1905,45 +2280,127 @@ By default, the dashboard is enabled.
         scale_down_disabled = Cfg.get_int("ec2.schedule.scalein.disable") != 0
         return scale_down_disabled or self.instance_scale_score < Cfg.get_float("ec2.schedule.scalein.threshold_ratio")
 
+    def get_bounce_jitter(self, instance_id):
+        """ Return a stable per-instance bouncing jitter in seconds.
+
+        The jitter is derived from the instance id so it stays the same from one run to another and
+        the bounce plan is deterministic.
+        """
+        max_jitter = Cfg.get_duration_secs("ec2.schedule.bounce_instance_jitter")
+        return int(hashlib.md5(instance_id.encode("utf-8")).hexdigest()[:8], 16) % (max_jitter + 1)
+
+    def get_bounce_plan(self):
+        """ Return the rolling bounce schedule of the fleet.
+
+        The plan lists all pending/running instances sorted by the date they are due for bouncing. The due date is the instance 
+        LaunchTime + 'ec2.schedule.bounce_delay' + a stable jitter. Due dates are then spread so that no more than 
+        'ec2.schedule.bounce.max_concurrent_bounces' instances are due within an 'ec2.schedule.bounce_instance_cooldown' period.
+
+        The plan is persisted in the 'ec2.schedule.instance.' state aggregate and updated per instance: Newly launched instances 
+        are appended and departed ones are dropped. It is only fully recomputed when the bouncing configuration changes.
+        When bouncing is not configured, an empty plan is returned without any computation.
+
+        :return A dict {"Fingerprint": str, "GeneratedAt": date, "Entries": [{"InstanceId", "LaunchTime", "DueDate"}...]}
+        """
+        if self.bounce_plan is not None:
+            return self.bounce_plan
+
+        bounce_delay    = Cfg.get_duration_secs("ec2.schedule.bounce_delay")
+        if bounce_delay == 0:
+            self.bounce_plan = {"Fingerprint": None, "GeneratedAt": str(self.context["now"]), "Entries": []}
+            return self.bounce_plan
+
+        cooldown        = Cfg.get_duration_secs("ec2.schedule.bounce_instance_cooldown")
+        max_concurrency = max(1, Cfg.get_int("ec2.schedule.bounce.max_concurrent_bounces"))
+        fingerprint     = "%s;%s;%s;%s" % (bounce_delay, cooldown, max_concurrency, Cfg.get_duration_secs("ec2.schedule.bounce_instance_jitter"))
+        instances       = {i["InstanceId"]: i for i in self.pending_running_instances_wo_excluded}
+
+        plan = self.ec2.get_state_json("ec2.schedule.instance.bounce.plan", default={})
+        if plan is None or plan.get("Fingerprint") != fingerprint:
+            plan = {"Fingerprint": fingerprint, "Entries": []}
+        # Drop instances that are no more running (or restarted since their entry was planned)
+        entries = [e for e in plan["Entries"] if e["InstanceId"] in instances and e["LaunchTime"] == str(instances[e["InstanceId"]]["LaunchTime"])]
+        changed = len(entries) != len(plan["Entries"]) or "GeneratedAt" not in plan
+
+        # Append newly launched instances
+        planned_ids = set(e["InstanceId"] for e in entries)
+        new_dates   = sorted([(i["LaunchTime"] + timedelta(seconds=bounce_delay + self.get_bounce_jitter(i["InstanceId"])), i) 
+                for instance_id, i in instances.items() if instance_id not in planned_ids], key=lambda d: d[0])
+        for due_date, i in new_dates:
+            # Rolling schedule: Spread bounces to avoid a tempest of restarts (and keep the plan sorted by due date)
+            if len(entries):
+                due_date = max(due_date, misc.str2utc(entries[-1]["DueDate"]))
+            if len(entries) >= max_concurrency:
+                due_date = max(due_date, misc.str2utc(entries[-max_concurrency]["DueDate"]) + timedelta(seconds=cooldown))
+            entries.append({
+                "InstanceId": i["InstanceId"],
+                "LaunchTime": str(i["LaunchTime"]),
+                "DueDate": str(due_date)
+                })
+            changed = True
+
+        if changed:
+            plan = {
+                "Fingerprint": fingerprint,
+                "GeneratedAt": str(self.context["now"]),
+                "Entries": entries
+            }
+            log.log(log.NOTICE, f"Updated the bounce plan ({len(new_dates)} new entries, {len(entries)} entries).")
+            self.ec2.set_state_json("ec2.schedule.instance.bounce.plan", plan, TTL=max(self.ec2.ttl, bounce_delay * 2))
+        self.bounce_plan = plan
+        return plan
+
+    def get_bounce_plan_due_instance_ids(self):
+        """ Return the instance ids that are due for bouncing according to the bounce plan.
+        """
+        now     = self.context["now"]
+        due_ids = []
+        for entry in self.get_bounce_plan()["Entries"]:
+            if misc.str2utc(entry["DueDate"]) > now:
+                break
+            due_ids.append(entry["InstanceId"])
+        return due_ids
+
     @xray_recorder.capture()
     def scale_bounce(self):
         """ IF configured, bounce old out-of-date instances by spawning new ones.
+
+        Instances to bounce are taken from the head of the bounce plan (see get_bounce_plan()) so only instances due for 
+        bouncing are assessed.
         """
         if self.scaling_state_changed:
             return
 
         now = self.context["now"]
+        # Instance count assessed before this algorithm changes any scaling state
+        useable_instance_count         = self.useable_instance_count
         bounce_delay_delta             = timedelta(seconds=Cfg.get_duration_secs("ec2.schedule.bounce_delay"))
         bounce_instance_cooldown_delta = timedelta(seconds=Cfg.get_duration_secs("ec2.schedule.bounce_instance_cooldown"))
+        max_concurrency                = max(1, Cfg.get_int("ec2.schedule.bounce.max_concurrent_bounces"))
 
-        instances = self.pending_running_instances_wo_excluded 
-        bouncing_ids = []
+        bounced_instances = self.pending_running_instances_bounced_wo_excluded
         if self.scale_bounce_is_draining_condition():
-            most_recent_bouncing_action = None
-            for i in instances:
+            for i in bounced_instances:
                 instance_id = i["InstanceId"]
                 meta={}
-                status = self.ec2.get_scaling_state(instance_id, meta=meta)
-                bounce_instance_jitter = timedelta(seconds=random.randint(0, Cfg.get_duration_secs("ec2.schedule.bounce_instance_jitter")))
-
-                if status == "bounced":
-                    bouncing_ids.append(instance_id)
-                    if meta["last_action_date"] is not None:
-                        bounce_time = meta["last_action_date"]
-                        if most_recent_bouncing_action is None or most_recent_bouncing_action < bounce_time: most_recent_bouncing_action = bounce_time 
-                        if now - bounce_time < bounce_instance_cooldown_delta + bounce_instance_jitter:
-                            continue
-
-                    subfleet = self.ec2.get_subfleet_name_for_instance(i)
-                    if self.ssm.is_feature_enabled("maintenance_window") and self.ssm.is_maintenance_time(fleet=subfleet):
-                        log.info(f"Bouncing actions disabled during '{subfleet}' subfleet SSM Maintenance Window: "
-                            f"Should have placed in 'draining' state instance {instance_id}...")
+                self.ec2.get_scaling_state(instance_id, meta=meta)
+                bounce_instance_jitter = timedelta(seconds=self.get_bounce_jitter(instance_id))
+
+                if meta["last_action_date"] is not None:
+                    bounce_time = meta["last_action_date"]
+                    if now - bounce_time < bounce_instance_cooldown_delta + bounce_instance_jitter:
                         continue
 
-                    self.ec2.set_scaling_state(instance_id, "draining")
-                    self.scaling_state_changed = True
-            if len(bouncing_ids):
-                log.debug("Instances %s are already marked for bouncing..." % bouncing_ids)
+                subfleet = self.ec2.get_subfleet_name_for_instance(i)
+                if self.ssm.is_feature_enabled("maintenance_window") and self.ssm.is_maintenance_time(fleet=subfleet):
+                    log.info(f"Bouncing actions disabled during '{subfleet}' subfleet SSM Maintenance Window: "
+                        f"Should have placed in 'draining' state instance {instance_id}...")
+                    continue
+
+                self.ec2.set_scaling_state(instance_id, "draining")
+                self.scaling_state_changed = True
+            if len(bounced_instances):
+                log.debug("Instances %s are already marked for bouncing..." % [i["InstanceId"] for i in bounced_instances])
 
         if bounce_delay_delta.total_seconds() == 0:
             log.log(log.NOTICE, "Instance bouncing not configured.")
@@ -1959,47 +2416,47 @@ By default, the dashboard is enabled.
             log.log(log.NOTICE, "Some targets are still in 'initial' state: Delaying instance bouncing assessment...")
             return
 
-        #fleet_instances        = self.instances_wo_excluded # ec2.get_instances(ScalingState="-excluded")
-        if len(self.pending_running_instances_bounced_wo_excluded): # ec2.get_instances(instances=fleet_instances, State="pending,running", ScalingState="bounced")):
+        if len(bounced_instances) >= max_concurrency:
             log.log(log.NOTICE, "Some instances are already bouncing... Wait to finish this task before another bounce...")
             return
 
+        due_instance_ids = self.get_bounce_plan_due_instance_ids()
+        if len(due_instance_ids) == 0:
+            return
 
         to_bounce_instance_ids = []
-        # Put in front of the instance list, instances with issues to bounce them first
+        # Put in front of the due instance list, instances with issues to bounce them first
         unuseable_instance_ids = self.instances_with_issues
-        instances = self.ec2.sort_by_prefered_instance_ids(instances, prefered_ids=unuseable_instance_ids) 
-        bounce_instance_jitter = timedelta(seconds=random.randint(0, Cfg.get_duration_secs("ec2.schedule.bounce_instance_jitter")))
+        due_instances = [self.ec2.get_instance_by_id(instance_id) for instance_id in due_instance_ids]
+        due_instances = self.ec2.sort_by_prefered_instance_ids(due_instances, prefered_ids=unuseable_instance_ids) 
 
-        for i in instances:
+        for i in due_instances:
+            if len(to_bounce_instance_ids) + len(bounced_instances) >= max_concurrency:
+                break #Note: We bounce a limited number of instances at a time to avoid tempest of restarts
             instance_id = i["InstanceId"]
-            timegap = now - i["LaunchTime"]
-
-            status = self.ec2.get_scaling_state(instance_id)
+            status      = self.ec2.get_scaling_state(instance_id)
+            if status in ["bounced", "draining", "error"]:
+                continue
 
             # Mark instance 'bounced'
-            if (status not in ["bounced", "draining", "error"] and timegap > bounce_delay_delta + bounce_instance_jitter
-                    and len(to_bounce_instance_ids) == 0): #Note: We bounce only one instance at a time to avoid tempest of restarts
-                instance_id = i["InstanceId"]
-                log.info("Bounced instance '%s' (%s)..." % (instance_id, 
-                    "oldest" if instance_id not in unuseable_instance_ids else "unuseable"))
+            log.info("Bounced instance '%s' (%s)..." % (instance_id, 
+                "oldest" if instance_id not in unuseable_instance_ids else "unuseable"))
 
-                subfleet = self.ec2.get_subfleet_name_for_instance(i)
-                if self.ssm.is_feature_enabled("maintenance_window") and self.ssm.is_maintenance_time(fleet=subfleet):
-                    log.info(f"Bouncing actions disabled during '{subfleet}' subfleet SSM Maintenance Window: "
-                        f"Should have placed in 'bounced' state instance {instance_id}..")
-                    continue
+            subfleet = self.ec2.get_subfleet_name_for_instance(i)
+            if self.ssm.is_feature_enabled("maintenance_window") and self.ssm.is_maintenance_time(fleet=subfleet):
+                log.info(f"Bouncing actions disabled during '{subfleet}' subfleet SSM Maintenance Window: "
+                    f"Should have placed in 'bounced' state instance {instance_id}..")
+                continue
 
-                to_bounce_instance_ids.append(instance_id)
-                # Mark instance as 'bounced' with a not too big TTL. If bouncing
-                self.ec2.set_scaling_state(instance_id, "bounced")
-                                                                                                      
+            to_bounce_instance_ids.append(instance_id)
+            # Mark instance as 'bounced' with a not too big TTL. If bouncing
+            self.ec2.set_scaling_state(instance_id, "bounced")
 
         if len(to_bounce_instance_ids) == 0:
             return
 
         log.info("Bouncing of instances %s in progress..." % to_bounce_instance_ids)
-        self.instance_action(self.useable_instance_count + len(to_bounce_instance_ids), "scale_bounce")
+        self.instance_action(useable_instance_count + len(to_bounce_instance_ids), "scale_bounce")
 
     @xray_recorder.capture()
     def scale_bounce_instances_with_issues(self):
@@ -2055,34 +2512,78 @@ By default, the dashboard is enabled.
     #### CORE SCALEUP/DOWN ALGORITHM ##############
     ###############################################
 
+    def classify_instance(self, matcher, instance):
+        """ Return the classification of an instance.
+
+        :param matcher: The matcher of the Main fleet vertical scaling policy (see get_vertical_policy_matcher())
+        :param instance: An instance structure
+        :return A dict {"LightHouse": bool, "LightHouseRank": int or None, "VerticalTier": int or None}
+        """
+        subfleet = self.ec2.get_subfleet_name_for_instance(instance)
+        rank     = None
+        if not subfleet:
+            # Instances marked as LightHouse through a Tag come first
+            if self.ec2.instance_has_tag(instance, "clonesquad:lighthouse", ["True","true"]):
+                rank = -1
+            else:
+                rank = self.get_vertical_policy_lighthouse_rank(matcher, instance["InstanceType"])
+        return {
+            "LightHouse"    : rank is not None,
+            "LightHouseRank": rank,
+            "VerticalTier"  : self.resolve_vertical_policy_directive(matcher, instance)
+        }
+
+    def get_instance_classification(self):
+        """ Return the classification of all instances.
+
+        The classification (LightHouse rank and vertical scaling tier) does not change during 
+        an execution so it is computed in one pass and shared by all scaling algorithms. It is only recomputed 
+        if the vertical scaling policy of the Main fleet is modified.
+
+        :return A dict {instance_id: classification} (see classify_instance())
+        """
+        directive = Cfg.get("ec2.schedule.verticalscale.instance_type_distribution")
+        if self.instance_classification is None or self.instance_classification["Directive"] != directive:
+            matcher = self.get_vertical_policy_matcher(directive)
+            self.instance_classification = {
+                "Directive": directive,
+                "Instances": {i["InstanceId"]: self.classify_instance(matcher, i) for i in self.ec2.get_instances()}
+            }
+        return self.instance_classification["Instances"]
+
+    def get_instance_class(self, instance):
+        """ Return the classification of the specified instance (see classify_instance()).
+        """
+        classification = self.get_instance_classification()
+        instance_id    = instance["InstanceId"]
+        if instance_id not in classification:
+            matcher = self.get_vertical_policy_matcher(self.instance_classification["Directive"])
+            classification[instance_id] = self.classify_instance(matcher, instance)
+        return classification[instance_id]
+
+    def is_lighthouse_instance(self, instance):
+        return self.get_instance_class(instance)["LightHouse"]
+
+    def count_non_lighthouse_instances(self, instances):
+        return sum(1 for i in instances if not self.is_lighthouse_instance(i))
+
     def get_lighthouse_instance_ids(self, instances):
         """ Retrieve the list of LightHouse instances.
 
         LightHouse instances are designated based on their instance type. LightHouse types are 
         defined in the vertical scaling configuration (defined in 'ec2.schedule.verticalscale.instance_type_distribution').
+        Subfleet instances are never LightHouse instances.
 
         (TODO: Remove the code provision that allow definition of LightHouse instance with Tag that is deprecated.)
 
-        :return A list of Instance Ids
+        :return A list of Instance Ids sorted by LightHouse rank
         """
-        # Excluded subfleet instances
-        subfleet_instances    = self.ec2.filter_instance_list_by_tag(instances, "clonesquad:subfleet-name")
-        subfleet_instance_ids = [i["InstanceId"] for i in subfleet_instances]
-        instances             = [i for i in instances if i["InstanceId"] not in subfleet_instance_ids]
-
-        # Collect instances that are marked as LightHouse through a Tag
-        ins = self.ec2.filter_instance_list_by_tag(instances, "clonesquad:lighthouse", ["True","true"])
-        ids = [i["InstanceId"] for i in ins]
-
-        # Collect instances that are declared as LightHouse through Vertical scaling
-        cfg = Cfg.get_list_of_dict("ec2.schedule.verticalscale.instance_type_distribution")
-        lighthouse_instance_types = [t["_"] for t in list(filter(lambda c: "lighthouse" in c and c["lighthouse"], cfg))]
-
-        for t in lighthouse_instance_types:
-            ins = list(filter(lambda i: re.match(t, i["InstanceType"]), instances))
-            for i in [i["InstanceId"] for i in ins]: 
-                if i not in ids: ids.append(i)
-        return ids
+        lh_instances = []
+        for i in instances:
+            c = self.get_instance_class(i)
+            if c["LightHouse"]:
+                lh_instances.append((c["LightHouseRank"], i["InstanceId"]))
+        return [instance_id for rank, instance_id in sorted(lh_instances, key=lambda x: x[0])]
 
     def are_lighthouse_instance_disabled(self):
         """ Return True if LightHouse instance support is disable by 'ec2.schedule.verticalscale.lighthouse_disable'.
@@ -2094,13 +2595,7 @@ By default, the dashboard is enabled.
     def are_all_non_lh_instances_started(self):
         """ Return 'True' if all startable non-LightHouse instances are already started.
         """
-        all_instances              = self.instances_wo_excluded_error_spotexcluded
-        lh_ids                     = self.lighthouse_instances_wo_excluded_ids
-        useable_instances          = self.useable_instances
-        non_lighthouse_instances   = list(filter(lambda i: i["InstanceId"] not in lh_ids, useable_instances))
-        all_non_lighthouse_instances       = list(filter(lambda i: i["InstanceId"] not in lh_ids, all_instances))
-        all_non_lighthouse_instances_count = len(all_non_lighthouse_instances)
-        return all_non_lighthouse_instances_count == len(non_lighthouse_instances)
+        return self.non_lighthouse_instance_count_wo_excluded_error_spotexcluded == self.useable_non_lighthouse_instance_count
 
     def shelve_instance_dispatch(self, expected_count):
         """ This method returns the expected amount of LightHouse and non-LightHouse instances depending of overall expected
@@ -2148,6 +2643,73 @@ By default, the dashboard is enabled.
         recommended_amount_of_non_lh = target_count - recommended_amount_of_lh
         return [recommended_amount_of_lh, recommended_amount_of_non_lh]
 
+    def get_vertical_policy_matcher(self, directive):
+        """ Return a compiled matcher for a vertical scaling directive string.
+
+        The directive (ex: 'ec2.schedule.verticalscale.instance_type_distribution' value) is parsed and its regexes
+        compiled once per directive string. Resolution of an instance to its first matching directive is
+        cached by (instance type, is_spot) couple.
+
+        :param directive: A vertical scaling directive string
+        :return A matcher dict to use with resolve_vertical_policy_directive() and is_vertical_policy_lighthouse_type()
+        """
+        matcher = self.vertical_policy_matchers.get(directive)
+        if matcher is not None:
+            return matcher
+        directive_items = misc.parse_line_as_list_of_dict(directive, default=[])
+        compiled        = []
+        for index, d in enumerate(directive_items):
+            try:
+                compiled.append((index, re.compile(d["_"]), d))
+            except Exception as e:
+                log.error(f"Format error with Regex '%s' inside vertical scaling directive '{directive}'! Please express a valid Regex to match instance type!" %
+                            (d["_"]))
+        matcher = {
+            "directives": directive_items,
+            "compiled"  : compiled,
+            "cache"     : {},
+            "lh_cache"  : {}
+        }
+        self.vertical_policy_matchers[directive] = matcher
+        return matcher
+
+    def resolve_vertical_policy_directive(self, matcher, instance):
+        """ Return the index of the first directive matching the instance (or None if no directive matches).
+
+        :param matcher: A matcher returned by get_vertical_policy_matcher()
+        :param instance: An instance structure
+        """
+        is_spot = self.ec2.is_spot_instance(instance)
+        key     = (instance["InstanceType"], is_spot)
+        cache   = matcher["cache"]
+        if key not in cache:
+            cache[key] = None
+            for index, regex, d in matcher["compiled"]:
+                if not regex.match(instance["InstanceType"]):
+                    continue
+                if "spot" in d:
+                    if d["spot"] and not is_spot: continue
+                    if not d["spot"] and is_spot: continue
+                cache[key] = index
+                break
+        return cache[key]
+
+    def get_vertical_policy_lighthouse_rank(self, matcher, instance_type):
+        """ Return the rank of the first LightHouse directive matching the instance type (or None if not a LightHouse type).
+
+        :param matcher: A matcher returned by get_vertical_policy_matcher()
+        :param instance_type: An instance type string
+        """
+        lh_cache = matcher["lh_cache"]
+        if instance_type not in lh_cache:
+            lh_cache[instance_type] = None
+            lh_directives = [(index, regex) for index, regex, d in matcher["compiled"] if "lighthouse" in d and d["lighthouse"]]
+            for rank, (index, regex) in enumerate(lh_directives):
+                if regex.match(instance_type):
+                    lh_cache[instance_type] = rank
+                    break
+        return lh_cache[instance_type]
+
     def verticalscaling_sort_instances(self, directive, instances, reverse=False):
         """ Sort the supplied instance list according to vertical scaling directive string.
 
@@ -2158,45 +2720,44 @@ By default, the dashboard is enabled.
             - One list for sorted non-LightHouse instance,
             - One list for instances that do not match the vertical scaling policy.
         """
-        def _match_spot(i, c, spot_implicit=None):
-            cc = c.copy()
-            if spot_implicit is not None and "spot" not in cc:
-                cc["spot"] = spot_implicit
-            if "spot" in cc:
-                is_spot = self.ec2.is_spot_instance(i)
-                if cc["spot"] and not is_spot: return False
-                if not cc["spot"] and is_spot: return False
-            return True
-
-        directive_items = misc.parse_line_as_list_of_dict(directive, default=[])
+        matcher = self.get_vertical_policy_matcher(directive)
         if reverse:
             instances = instances.copy()
             instances.reverse()
-        lh_ids          = self.get_lighthouse_instance_ids(instances)
-        r               = { "directives" : directive_items }
+        r               = { "directives" : matcher["directives"] }
 
-        r["lh_instances"]     = list(filter(lambda i: i["InstanceId"] in lh_ids, instances))
+        # The Main fleet policy tier is already resolved in the shared instance classification
+        self.get_instance_classification()
+        use_class        = directive == self.instance_classification["Directive"]
+
+        # Bucket instances by their first matching directive in a single pass
+        lh_instances     = []
+        buckets          = defaultdict(list)
+        not_matching     = []
+        for i in instances:
+            if self.is_lighthouse_instance(i):
+                lh_instances.append(i)
+                continue
+            if use_class:
+                index = self.get_instance_class(i)["VerticalTier"]
+            else:
+                index = self.resolve_vertical_policy_directive(matcher, i)
+            if index is None:
+                not_matching.append(i)
+            else:
+                buckets[index].append(i)
+        r["lh_instances"]     = lh_instances
 
         # Sort non-LH instances
         insts          = []
-        non_lh_ids     = []
-        for d in directive_items:
-            try:
-                i_s        = list(filter(lambda i: re.match(d["_"], i["InstanceType"]) and i["InstanceId"] not in lh_ids and i["InstanceId"] not in non_lh_ids and _match_spot(i, d), instances))
-            except Exception as e:
-                log.error(f"Format error with Regex '%s' inside vertical scaling directive '{directive}'! Please express a valid Regex to match instance type!" %
-                            (d["_"]))
-                continue
-            for i in i_s:
-                insts.append(i)
-                non_lh_ids.append(i["InstanceId"])
+        for index in sorted(buckets.keys()):
+            insts.extend(buckets[index])
         r["non_lh_instances"] = insts
         if reverse:
             r["non_lh_instances"].reverse()
 
         # Identify all instances that are not LH or not part of the vertical policy
-        valid_non_lh_instance_ids                 = [ i["InstanceId"] for i in insts]
-        r["non_lh_instances_not_matching_policy"] = list(filter(lambda i: i["InstanceId"] not in valid_non_lh_instance_ids and i["InstanceId"] not in lh_ids, instances))
+        r["non_lh_instances_not_matching_policy"] = not_matching
 
         return r
 
@@ -2219,13 +2780,13 @@ By default, the dashboard is enabled.
         vertical_sorted_instances  = self.verticalscaling_sort_instances(
                 Cfg.get("ec2.schedule.verticalscale.instance_type_distribution"), candidates)
 
-        lh_ids = self.get_lighthouse_instance_ids(candidates)
+        lh_ids = set(self.get_lighthouse_instance_ids(candidates))
 
         instances                  = []
         useable_instances          = self.useable_instances
-        non_lighthouse_instances   = list(filter(lambda i: i["InstanceId"] not in lh_ids, useable_instances))
+        non_lighthouse_instances   = self._filter_out_instance_ids(useable_instances, lh_ids)
         min_instance_count         = self.get_min_instance_count()
-        running_lh_ids             = self.get_lighthouse_instance_ids(useable_instances)
+        running_lh_ids             = self.useable_lighthouse_instance_ids
 
         lighthouse_need     = 0
         lighthouse_only     = False
@@ -2277,7 +2838,8 @@ By default, the dashboard is enabled.
                    ):
                     instances.extend(vertical_sorted_instances["lh_instances"][lighthouse_need:])
 
-        return instances
+        # Try first instances in pools that did not recently fail with capacity errors
+        return self.ec2.sort_by_capacity_availability(instances)
 
     def scaledown_sort_instances(self, candidates, expected_count, caller):
         """ Sort candidate instances to be stopped on a scalein event in the Main fleet.
@@ -2303,11 +2865,11 @@ By default, the dashboard is enabled.
 
 
         # Pickup lighthouse instances first if enough other instances are up
-        lh_ids                     = self.get_lighthouse_instance_ids(candidates)
-        useable_instances          = self.get_useable_instances()
-        running_lh_ids             = self.get_lighthouse_instance_ids(useable_instances)
-        non_lighthouse_instances   = list(filter(lambda i: i["InstanceId"] not in lh_ids, candidates))
-        lighthouse_instances       = list(filter(lambda i: i["InstanceId"] in lh_ids, candidates))
+        running_lh_ids             = self.get_lighthouse_instance_ids(self.get_useable_instances())
+        non_lighthouse_instances   = []
+        lighthouse_instances       = []
+        for i in candidates:
+            (lighthouse_instances if self.is_lighthouse_instance(i) else non_lighthouse_instances).append(i)
         amount_of_lh, amount_of_non_lh = self.shelve_instance_dispatch(expected_count)
         bouncing_instances         = self.ec2.get_instances(
                 instances=self.get_useable_instances(exclude_bounced_instances = False), 
@@ -2316,7 +2878,7 @@ By default, the dashboard is enabled.
         lighthouse_need            = -min(amount_of_lh - len(running_lh_ids), 0)
         if len(bouncing_instances) and len(non_lighthouse_instances): 
             lighthouse_need = 0 # We favor bouncing of non-LH instances first
-        if self.are_lighthouse_instance_disabled(): lighthouse_need = len(lh_ids)
+        if self.are_lighthouse_instance_disabled(): lighthouse_need = len(lighthouse_instances)
 
         # In some cases, we want to stop lighthouse instances first
         instances.extend(lighthouse_instances[:lighthouse_need])
@@ -2352,7 +2914,8 @@ By default, the dashboard is enabled.
         all_useable_plus_special_state_instances = self.useable_instances_wo_excluded_draining 
         serving_instances                        = self.serving_instances   
         lh_ids                                   = self.lighthouse_instances_wo_excluded_ids  
-        running_lh_ids                           = self.get_lighthouse_instance_ids(all_useable_plus_special_state_instances)
+        running_lh_ids                           = [i["InstanceId"] for i in all_useable_plus_special_state_instances 
+                                                        if self.is_lighthouse_instance(i)]
         non_lighthouse_instances                 = self.serving_non_lighthouse_instance_ids  
         non_lighthouse_instances_initializing    = self.serving_non_lighthouse_instance_ids_initializing 
         serving_non_lighthouse_instance_count    = len(non_lighthouse_instances) - len(non_lighthouse_instances_initializing)
@@ -2382,15 +2945,14 @@ By default, the dashboard is enabled.
         amount_of_lh, amount_of_non_lh = self.shelve_instance_dispatch(expected_count)
 
         # Take into account unhealthy/unavailable LH instances
-        instances_with_issues_ids = self.instances_with_issues 
-        instances_with_issues     = [ i for i in self.instances_wo_excluded if i["InstanceId"] in instances_with_issues_ids] 
-        lh_instances_with_issues  = self.get_lighthouse_instance_ids(instances_with_issues) 
-        lh_instances_to_exclude   = lh_instances_with_issues.copy()
-        lh_draining_instances     = self.get_lighthouse_instance_ids(
-                self.ec2.get_instances(State="pending,running", ScalingState="draining,error"))
-        [lh_instances_to_exclude.append(i) for i in lh_draining_instances if i not in lh_instances_to_exclude]
+        instances_with_issues_ids = self.instance_ids_with_issues 
+        lh_instances_to_exclude   = set(i["InstanceId"] for i in self.instances_wo_excluded 
+                                        if i["InstanceId"] in instances_with_issues_ids and self.is_lighthouse_instance(i))
+        lh_instances_to_exclude.update(i["InstanceId"] for i in self.ec2.get_instances(State="pending,running", ScalingState="draining,error")
+                                        if self.is_lighthouse_instance(i))
         # Exclude also LH Spot instances if marked for interrruption
-        [lh_instances_to_exclude.append(i) for i in self.spot_excluded_instance_ids if i in lh_ids and i not in lh_instances_to_exclude]
+        lh_ids_set                = set(lh_ids)
+        lh_instances_to_exclude.update(i for i in self.spot_excluded_instance_ids if i in lh_ids_set)
 
         amount_of_lh     = min(max_lh_instances - len(lh_instances_to_exclude), amount_of_lh)
 
@@ -2508,9 +3070,11 @@ By default, the dashboard is enabled.
         useable_instances_count = self.get_useable_instance_count(exclude_initializing_instances=True)
         alarm_with_metrics      = self.cloudwatch.get_alarm_names_with_metrics()
         alarm_in_ALARM          = [ a["AlarmName"] for a in assessment["upscale"]["guilties"] ]
+        alarm_in_ALARM_set      = set(alarm_in_ALARM)
+        alarm_with_metrics_set  = set(alarm_with_metrics)
 
         all_alarm_names         = alarm_with_metrics.copy()
-        all_alarm_names.extend(list(filter(lambda a: a not in alarm_with_metrics, alarm_in_ALARM)))
+        all_alarm_names.extend(list(filter(lambda a: a not in alarm_with_metrics_set, alarm_in_ALARM)))
 
         # Target for weighted unknown divider:
         #   When a divider is not specified, the algorithm will divide the individual scores by the number of
@@ -2520,20 +3084,31 @@ By default, the dashboard is enabled.
         #   will reach 1.0 (so scaling) before invidual alarms are close to trig.
         unknown_divider_target = min(1.0, max(0.1, Cfg.get_float("ec2.schedule.horizontalscale.unknown_divider_target")))
 
+        # Index alarm data and metrics once
+        alarm_data_index = self.cloudwatch.get_alarm_data_index()
+        metric_index     = self.cloudwatch.get_metric_index()
+        now_secs         = misc.seconds_from_epoch_utc(now=now)
+        def _age_secs(sampling_time):
+            return now_secs - sampling_time
+
         oldest_metric_secs   = 0
         for a in alarm_with_metrics:
-            metric = self.cloudwatch.get_metric_by_id(a)
+            metric = metric_index.get(a)
             if metric is not None:
-                metric_date = misc.str2utc(metric["_SamplingTime"])
-                oldest_metric_secs = max(oldest_metric_secs, (now - metric_date).total_seconds())
+                oldest_metric_secs = max(oldest_metric_secs, _age_secs(metric["_SamplingTime"]))
         oldest_metric_secs   = max(0.001, oldest_metric_secs) # Avoid DIV#0 later in the algorithm
 
-
+        # Build the alarm score table: One column per score input, one row per alarm with metric
         all_points       = defaultdict(dict)
-        sum_of_deltas    = 1 
-        sum_of_unkwnown_divider_delta_time = 0
-        scores           = []
         no_metric_alarms = []
+        table            = {
+            "AlarmName"    : [],
+            "ResourceKey"  : [],
+            "GapRatio"     : [],
+            "DividerWeight": [],
+            "Divider"      : []
+        }
+        alarm_points     = int(default_points)
         for alarm_name in all_alarm_names:
             alarm_def           = self.cloudwatch.get_alarm_configuration_by_name(alarm_name)
             if alarm_def is None: 
@@ -2541,12 +3116,13 @@ By default, the dashboard is enabled.
 
             instance_id  = alarm_def["InstanceId"] if "InstanceId" in alarm_def else None
             meta         = alarm_def["AlarmDefinition"]["Metadata"]
-            alarm_group  = alarm_def["AlarmDefinition"]["Metadata"]["AlarmGroup"] if "AlarmGroup" in alarm_def["AlarmDefinition"]["Metadata"] else None
+            alarm_group  = meta["AlarmGroup"] if "AlarmGroup" in meta else None
 
             k = "alarmname:%s" % alarm_name if alarm_group is None else "alarmgroup:%s" % alarm_group
             if instance_id is not None: k = "instance:%s" % instance_id
 
             all_points[k][alarm_name] = 0
+            # Note: The points of the last processed alarm are used to compute all the alarm scores below.
             alarm_points              = int(default_points)
             if "Points" in meta:
                 try:
@@ -2554,12 +3130,12 @@ By default, the dashboard is enabled.
                 except:
                     log.exception("[WARNING] Failed to process 'Points' metadata for alarm %s! (%s)" % (alarm_name, meta["Points"]))
 
-            metric_data        = self.cloudwatch.get_alarm_data_by_name(alarm_name)
-            if alarm_name in alarm_in_ALARM or (metric_data is not None and metric_data["StateValue"] == "ALARM"):
+            metric_data        = alarm_data_index.get(alarm_name)
+            if alarm_name in alarm_in_ALARM_set or (metric_data is not None and metric_data["StateValue"] == "ALARM"):
                 # Alarm that are in ALARM state are directly earning their points
                 all_points[k][alarm_name] = int(alarm_points)
 
-            if "MetricDetails" not in metric_data or len(metric_data["MetricDetails"]["Values"]) == 0:
+            if metric_data is None or "MetricDetails" not in metric_data or len(metric_data["MetricDetails"]["Values"]) == 0:
                 no_metric_alarms.append(alarm_name)
                 continue
 
@@ -2577,52 +3153,42 @@ By default, the dashboard is enabled.
 
             gap       = abs(alarm_threshold - baseline_threshold)
             if gap == 0: continue
-            gap_ratio = (latest_metric_value - baseline_threshold) / gap 
 
-            # Extrapolation algorithm
-            #   Youngest metric data got 80% weight ; oldest get 20% 
-            pcent = 0.20 + (0.6 * (oldest_metric_secs - (now - misc.str2utc(metric_data["MetricDetails"]["_SamplingTime"])).total_seconds()) / oldest_metric_secs)
-            s = {
-                "AlarmName": alarm_name,
-                "ResourceKey": k,
-                "GapRatio": gap_ratio,
-                "DividerWeight": pcent
-                }
+            divider   = None
             try:
                 if "Divider" in meta:
-                    s["Divider"] = float(meta["Divider"])
+                    divider = float(meta["Divider"])
             except: 
                 log.warning("Failed to convert Divider '%s' as float for alarm '%s'!" % (meta["Divider"], alarm_name))
-            if not "Divider" in s: 
-                sum_of_unkwnown_divider_delta_time += s["DividerWeight"]
-            scores.append(s)
 
-        log.log(log.NOTICE, "No metric available yet for '%s'..." % no_metric_alarms)
-
-        for s in scores:
-            # Determine the divider to use (default is the amount of useable instances)
-            if "Divider" in s:
-                weight    = 1 / s["Divider"]
-                gap_ratio = s["GapRatio"] 
-            else:
+            table["AlarmName"].append(alarm_name)
+            table["ResourceKey"].append(k)
+            table["GapRatio"].append((latest_metric_value - baseline_threshold) / gap)
+            # Extrapolation algorithm
+            #   Youngest metric data got 80% weight ; oldest get 20% 
+            table["DividerWeight"].append(0.20 + (0.6 * (oldest_metric_secs - _age_secs(metric_data["MetricDetails"]["_SamplingTime"])) / oldest_metric_secs))
+            table["Divider"].append(divider)
 
-                weight    = s["DividerWeight"] / float(sum_of_unkwnown_divider_delta_time) 
-                gap_ratio = s["GapRatio"] / unknown_divider_target
+        log.log(log.NOTICE, "No metric available yet for '%s'..." % no_metric_alarms)
 
-            score_points = alarm_points * gap_ratio * weight
+        # Compute all the alarm scores in batch
+        sum_of_unkwnown_divider_delta_time = sum(w for w, d in zip(table["DividerWeight"], table["Divider"]) if d is None)
+        weights    = [ (1 / d) if d is not None else (w / float(sum_of_unkwnown_divider_delta_time)) 
+                for w, d in zip(table["DividerWeight"], table["Divider"]) ]
+        gap_ratios = [ g if d is not None else (g / unknown_divider_target) 
+                for g, d in zip(table["GapRatio"], table["Divider"]) ]
+        scores     = [ int(alarm_points * g * w) for g, w in zip(gap_ratios, weights) ]
 
-            alarm_name   = s["AlarmName"]
-            resource_key = s["ResourceKey"]
-            all_points[resource_key][alarm_name] = max(all_points[resource_key][alarm_name], int(score_points))
+        for alarm_name, resource_key, score_points in zip(table["AlarmName"], table["ResourceKey"], scores):
+            all_points[resource_key][alarm_name] = max(all_points[resource_key][alarm_name], score_points)
 
         # Take only the biggest score point per instance
         points = 0
         for k in all_points.keys():
-            ps = [ all_points[k][p] for p in all_points[k] ]
-            ps = sorted(ps, reverse=True)
+            ps = all_points[k].values()
             if len(ps): 
                 log.info("Scores for '%s' : %s" % (k, all_points[k]))
-                points += ps[0]
+                points += max(ps)
         return points
 
 
@@ -2740,6 +3306,16 @@ By default, the dashboard is enabled.
 
         if new_scale_sequence:
             self.set_state("ec2.schedule.%s.start_date" % direction, str(last_scale_start_date))
+        self.decision_record["ScaleCount"] = {
+            "Direction": direction,
+            "ScaleStartDate": str(last_scale_start_date),
+            "LatestScaleEventDate": str(last_event_date),
+            "Rate": rate,
+            "Period": period,
+            "BoostRate": boost_rate,
+            "RawInstanceCount": raw_instance_count,
+            "InstanceCount": delta_count
+        }
 
         # Report some printable statistics
         text.append("\n".join(["[INFO] Scaling data for direction '%s' :" % direction,
@@ -2787,23 +3363,47 @@ By default, the dashboard is enabled.
         self.instance_scale_score = self.ec2.get_integrated_float_state("ec2.schedule.scaleout.instance_scale_score",
                 integration_period, default=self.raw_instance_scale_score)
 
-        log.info("Scale score: (Raw=%f/IntegratedRaw=%f/Integrated=%f)" % 
-                (self.raw_instance_scale_score, self.integrated_raw_instance_scale_score, self.instance_scale_score))
+        # Project the raw score trend over the instance warmup delay
+        self.instance_scale_score_forecast = self.get_scale_score_forecast(Cfg.get_duration_secs("ec2.schedule.start.warmup_delay"))
+
+        log.info("Scale score: (Raw=%f/IntegratedRaw=%f/Integrated=%f/Forecast=%s)" % 
+                (self.raw_instance_scale_score, self.integrated_raw_instance_scale_score, self.instance_scale_score,
+                    "%f" % self.instance_scale_score_forecast if self.instance_scale_score_forecast is not None else "n/a"))
+        self.decision_record["Scores"] = {
+            "AlarmPoints": self.alarm_points,
+            "BasePoints": base_points,
+            "Guilties": [g["AlarmName"] if "AlarmName" in g else str(g) for g in assessment["upscale"]["guilties"]],
+            "Raw": self.raw_instance_scale_score,
+            "IntegratedRaw": self.integrated_raw_instance_scale_score,
+            "Integrated": self.instance_scale_score,
+            "Forecast": self.instance_scale_score_forecast
+        }
 
         if self.desired_instance_count() != -1:
             log.info("Autoscaler disabled due to 'ec2.schedule.desired_instance_count' set to a value different than -1!")
+            self.decision_record["Direction"] = "autoscaler_disabled"
             return
 
         scale_up_disabled = Cfg.get_int("ec2.schedule.scaleout.disable") != 0
         if scale_up_disabled: log.log(log.NOTICE, "ScaleOut scheduler disabled!")
 
         if self.scaling_state_changed:
+            self.decision_record["Direction"] = "deferred"
             return
 
         # Step 2.a) Check if we are allowed to scaleout now
         if not scale_up_disabled and self.instance_scale_score >= 1.0:
+            self.decision_record["Direction"] = "scaleout"
             self.take_scale_decision_scaleout()
             return
+        # Step 2.a') Check if the score trend predicts a scaleout condition within the warmup delay
+        if (not scale_up_disabled and Cfg.get_int("ec2.schedule.horizontalscale.predictive.enable") and
+                self.instance_scale_score_forecast is not None and self.instance_scale_score_forecast >= 1.0):
+            log.log(log.NOTICE, "Predictive scaleout: Scale score forecast %f reaches 1.0 within the warmup delay!" % 
+                    self.instance_scale_score_forecast)
+            self.decision_record["Direction"] = "predictive_scaleout"
+            self.take_scale_decision_scaleout(boost_rate=self.instance_scale_score_forecast)
+            return
 
         # Remember that we are not in an scaleout condition here
         self.set_state("ec2.schedule.scaleout.start_date", "")
@@ -2814,15 +3414,42 @@ By default, the dashboard is enabled.
         if scale_down_disabled: log.log(log.NOTICE, "ScaleIn scheduler disabled!")
 
         if not scale_down_disabled and self.instance_scale_score < Cfg.get_float("ec2.schedule.scalein.threshold_ratio"):
+            self.decision_record["Direction"] = "scalein"
             self.take_scale_decision_scalein()
             return
+        self.decision_record["Direction"] = "none"
 
         # Remember that we are not in an scalein condition here
         self.set_state("ec2.schedule.scalein.start_date", "")
         self.set_state("ec2.schedule.scalein.last_action_date", "")
 
+    def get_scale_score_forecast(self, horizon):
+        """ Forecast the raw scale score 'horizon' seconds ahead using Holt linear smoothing.
+
+        Samples are not evenly spaced so the trend is expressed per second and each step is weighted by its duration.
+
+        :param horizon: Forecast horizon in seconds
+        :return A float or None if there is not enough history
+        """
+        series = self.ec2.get_float_state_series("ec2.schedule.scaleout.raw_instance_scale_score",
+                Cfg.get_duration_secs("ec2.schedule.horizontalscale.raw_integration_period"))
+        if len(series) < max(2, Cfg.get_int("ec2.schedule.horizontalscale.predictive.min_samples")):
+            return None
+        alpha     = Cfg.get_float("ec2.schedule.horizontalscale.predictive.alpha")
+        beta      = Cfg.get_float("ec2.schedule.horizontalscale.predictive.beta")
+        prev_date, level = series[0]
+        trend     = 0.0
+        for d, v in series[1:]:
+            dt = (d - prev_date).total_seconds()
+            if dt <= 0: continue
+            prev_level = level
+            level      = alpha * v + (1 - alpha) * (level + trend * dt)
+            trend      = beta * (level - prev_level) / dt + (1 - beta) * trend
+            prev_date  = d
+        return max(0.0, level + trend * horizon)
+
     @xray_recorder.capture()
-    def take_scale_decision_scaleout(self):
+    def take_scale_decision_scaleout(self, boost_rate=None):
         now          = self.context["now"]
         time_to_wait = self.is_scale_transition_too_early("scaleout")
         if time_to_wait > 0:
@@ -2830,7 +3457,8 @@ By default, the dashboard is enabled.
             return
 
         text              = []
-        instance_to_start = self.get_scale_instance_count("scaleout", self.instance_scale_score, text)
+        instance_to_start = self.get_scale_instance_count("scaleout", 
+                boost_rate if boost_rate is not None else self.instance_scale_score, text)
         if instance_to_start == 0: 
             self.would_like_to_scaleout = True
             return
@@ -2875,6 +3503,98 @@ By default, the dashboard is enabled.
         self.instance_action(desired_instance_count, "scalein")
         self.set_state("ec2.schedule.scalein.last_action_date", now)
 
+    ###############################################
+    #### DECISION LOG #############################
+    ###############################################
+
+    def record_decision_instance_change(self, instance_id, change):
+        """ Record instances acted on during this run in the decision record.
+
+        Called by EC2 module on instance state or scaling state changes (see EC2.register_instance_change_listener()).
+        """
+        if change == "State":
+            state = self.ec2.get_instance_by_id(instance_id)["State"]["Name"]
+            if state == "pending":
+                self.decision_record["StartedInstanceIds"].append(instance_id)
+            elif state == "stopping":
+                self.decision_record["StoppedInstanceIds"].append(instance_id)
+        else:
+            self.decision_record["ScalingStates"][instance_id] = self.ec2.get_scaling_state(instance_id, default="", 
+                    do_not_return_excluded=True)
+
+    def get_decision_log_slot(self, date):
+        """ Return the ring buffer slot of the decision record taken at the specified date.
+        """
+        run_period = max(Cfg.get_duration_secs("app.run_period"), 1)
+        return int(misc.seconds_from_epoch_utc(now=date) / run_period) % max(Cfg.get_int("ec2.schedule.decision_log.size"), 1)
+
+    @xray_recorder.capture()
+    def save_decision_record(self):
+        """ Save the scaling decisions of this run in the decision log.
+
+        The decision log is a ring buffer of 'ec2.schedule.decision_log.size' records (one per Main Lambda run) stored in the 
+        State table. Each slot is a distinct compressed item so writing a record costs one small DynamoDB write and the log
+        size is not bounded by the DynamoDB item size limit.
+        As the State table is fully scanned at each run, each slot adds its size (~600 bytes compressed) to the read cost of 
+        every run: The default of 60 slots (20 minutes) adds ~36kB, so ~9 RCUs, per run.
+        If 'ec2.schedule.decision_log.s3_export' is set, the whole log is exported to the 'MetadataAndBackupS3Path' location 
+        each time a full ring buffer period has elapsed since the last export.
+        """
+        if not Cfg.get_int("ec2.schedule.decision_log.enable"):
+            return
+        record = self.decision_record
+        record["FleetSize"]              = len(self.instances_wo_excluded)
+        record["RunningInstanceCount"]   = len(self.pending_running_instances_wo_excluded)
+        record["UseableInstanceCount"]   = self.useable_instance_count
+        record["ServingInstanceCount"]   = len(self.serving_instances)
+        record["DrainingInstanceCount"]  = len(self.pending_running_instances_draining)
+        record["MinInstanceCount"]       = self.get_min_instance_count()
+        record["DesiredInstanceCount"]   = self.desired_instance_count()
+        now        = self.context["now"]
+        log_period = max(Cfg.get_int("ec2.schedule.decision_log.size"), 1) * Cfg.get_duration_secs("app.run_period")
+        slot       = self.get_decision_log_slot(now)
+        self.ec2.set_state_json(f"ec2.schedule.decision_log.{slot}", record, compress=True, TTL=log_period * 2)
+
+        export_url = self.context.get("MetadataAndBackupS3Path")
+        if not Cfg.get_int("ec2.schedule.decision_log.s3_export") or export_url in [None, "", "None"]:
+            return
+        # Runs can be skipped or delayed so the ring buffer wrap is detected from the date of the last export
+        last_export_date = self.ec2.get_state("ec2.schedule.instance.decision_log.last_export_date", default=None)
+        if last_export_date is None:
+            self.ec2.set_state("ec2.schedule.instance.decision_log.last_export_date", str(now), TTL=log_period * 2)
+        elif (now - misc.str2utc(last_export_date)).total_seconds() >= log_period:
+            self.export_decision_log(export_url)
+            self.ec2.set_state("ec2.schedule.instance.decision_log.last_export_date", str(now), TTL=log_period * 2)
+
+    def get_decision_log(self, max_records=None):
+        """ Return the decision log records sorted from the oldest to the newest.
+
+        :param max_records: If not None, only the 'max_records' latest records are returned.
+        """
+        records = []
+        for key in self.context["o_state"].get_keys(prefix="ec2.schedule.decision_log."):
+            record = self.ec2.get_state_json(key)
+            if isinstance(record, dict) and "Date" in record:
+                records.append(record)
+        records.sort(key=lambda r: r["Date"])
+        if max_records is not None:
+            records = records[-max_records:] if max_records > 0 else []
+        return records
+
+    def export_decision_log(self, export_url):
+        """ Export the decision log to S3 as a JSON Lines document.
+        """
+        account_id, region, group_name = (self.context["ACCOUNT_ID"], self.context["AWS_DEFAULT_REGION"], self.context["GroupName"])
+        now     = self.context["now"]
+        path    = f"accountid={account_id}/region={region}/groupname={group_name}/date={now.strftime('%Y-%m-%d')}"
+        records = self.get_decision_log()
+        log.info(f"Exporting {len(records)} scaling decision record(s) to {export_url}...")
+        misc.put_url(f"{export_url}/metadata/decisions/{path}/{account_id}-{region}-scaling-decisions-cs-{group_name}-{now.strftime('%H%M%S')}.json", 
+                "\n".join(json.dumps(r, default=str) for r in records))
+
+    def exports_metadata_and_backup(self, export_url):
+        self.export_decision_log(export_url)
+
     ###############################################
     #### SPOT MANAGEMENT ##########################
     ###############################################
@@ -2925,6 +3645,8 @@ By default, the dashboard is enabled.
             log.info("EC2 Spot instances with 'rebalance_recommended' status: %s" % self.spot_rebalance_recommended_ids)
         if len(self.spot_interrupted_ids):
             log.info("EC2 Spot instances with 'interrupted' status: %s" % self.spot_interrupted_ids)
+        # Instance count assessed before this algorithm changes any scaling state
+        useable_instance_count = self.useable_instance_count
 
         # Mark all Spot interrupted as 'draining'
         for i in self.spot_interrupted:
@@ -2985,7 +3707,7 @@ By default, the dashboard is enabled.
 
         if instance_count_to_launch:
             # Launch needed instances in the Main fleet
-            self.instance_action(self.useable_instance_count + instance_count_to_launch, "manage_spot_events")
+            self.instance_action(useable_instance_count + instance_count_to_launch, "manage_spot_events")
 
         for subfleet in subfleet_deltas:
             # Launch needed instances in each subfleet
@@ -168,6 +168,21 @@ class Interact:
                     "prepare": self.fleet_status_prepare,
                     "func": self.fleet_status
                 },
+                "fleet/bounceplan": {
+                    "interface": ["apigw"],
+                    "cache": "global",
+                    "clients": [],
+                    "prerequisites": [],
+                    "prepare": self.fleet_bounceplan_prepare,
+                    "func": self.fleet_bounceplan
+                },
+                "fleet/decisions": {
+                    "interface": ["apigw"],
+                    "cache": "none",
+                    "clients": [],
+                    "prerequisites": ["o_state"],
+                    "func": self.fleet_decisions
+                },
                 "fleet/metadata"           : {
                     "interface": ["apigw"],
                     "cache": "global",
@@ -212,7 +227,7 @@ class Interact:
 
         o_ec2 = self.context["o_ec2"]
         # Export metadata and backup
-        for d in [Cfg, o_ec2, self.context["o_scheduler"], self.context["o_ssm"]]:
+        for d in [Cfg, o_ec2, self.context["o_ec2_schedule"], self.context["o_scheduler"], self.context["o_ssm"]]:
             d.exports_metadata_and_backup(export_url)
 
         # Export discovery metadata
@@ -313,6 +328,27 @@ class Interact:
         response["body"]       = Dbg.pprint(cacheddata)
         return True
 
+    def fleet_bounceplan_prepare(self):
+        return self.context["o_ec2_schedule"].get_bounce_plan()
+
+    def fleet_bounceplan(self, context, event, response, cacheddata):
+        response["statusCode"] = 200
+        response["body"]       = Dbg.pprint(cacheddata)
+        return True
+
+    def fleet_decisions(self, context, event, response, cacheddata):
+        max_records = None
+        if "count" in event:
+            try:
+                max_records = int(event["count"])
+            except:
+                response["statusCode"] = 400
+                response["body"]       = f"Invalid 'count' parameter '{event['count']}'! Must be an integer."
+                return False
+        response["statusCode"] = 200
+        response["body"]       = Dbg.pprint(self.context["o_ec2_schedule"].get_decision_log(max_records=max_records))
+        return True
+
     def cloudwatch_sentmetrics_prepare(self):
         return self.context["o_cloudwatch"].sent_metrics()
 
@@ -381,7 +417,13 @@ class Interact:
 
     def cloudwatch_metric_cache(self, context, event, response, cacheddata):
         response["statusCode"] = 200
-        response["body"] = Dbg.pprint(context["o_cloudwatch"].get_metric_cache())
+        metrics = context["o_cloudwatch"].get_metric_cache()
+        for m in metrics.values():
+            # Render dates (stored as seconds since Epoch) in a human readable form
+            for k in ["_SamplingTime", "_LastSamplingAttempt"]:
+                if k in m: m[k] = str(misc.seconds2utc(m[k]))
+            m["Timestamps"] = [str(misc.seconds2utc(t)) for t in m["Timestamps"]]
+        response["body"] = Dbg.pprint(metrics)
         return True
 
     def process_ack_event_dates(self, context, event, response, cacheddata):
@@ -5,6 +5,8 @@ import misc
 import json
 import yaml
 import time
+import threading
+import functools
 from datetime import datetime
 from datetime import timedelta
 from collections import defaultdict
@@ -22,7 +24,20 @@ log = cslog.logger(__name__)
 
 all_kv_objects = []
 
+def synchronized(f):
+    """ Serialize calls to the decorated KVTable method with the KVTable lock.
+    """
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        with KVTable.lock:
+            return f(*args, **kwargs)
+    return wrapper
+
 class KVTable():
+    # Main pipeline stages can run concurrently (see app.run_stages()): All table cache accesses are serialized
+    #   (DynamoDB writes of set_kv() are performed outside of the lock)
+    lock = threading.RLock()
+
     def __init__(self, context, table_name, aggregates=None):
         global all_kv_objects
         self.context     = context
@@ -57,6 +72,7 @@ class KVTable():
         log.debug(f"Lambda cache reuse for table {table_name}...")
         return existing_object
 
+    @synchronized
     def reread_table(self, force_reread=False):
         if not force_reread and self.table_cache is not None:
             return
@@ -231,6 +247,7 @@ class KVTable():
         return delta
 
 
+    @synchronized
     def persist_aggregates():
         global all_kv_objects
         for t in all_kv_objects:
@@ -304,6 +321,7 @@ class KVTable():
                     if k not in d:
                         self.set_kv(k, "")
 
+    @synchronized
     def get_keys(self, prefix=None, partition=None):
         def _enum(dt):
             for k in dt:
@@ -318,6 +336,7 @@ class KVTable():
         _enum(d)
         return keys
 
+    @synchronized
     def get_item(self, key, partition=None):
         now = self.context["now"]
         k   = key if partition is None else "[%s]%s" % (partition, key)
@@ -401,13 +420,14 @@ class KVTable():
         if direct:
             return self.get_kv_direct(key, self.table_name, default=default, TTL=TTL)
 
-        client = self.context["dynamodb.client"]
-        item = self.get_item(key, partition=partition)
-        if item is None:
-            return default
+        with KVTable.lock:
+            item = self.get_item(key, partition=partition)
+            if item is None:
+                return default
+            value = item["Value"]
         if TTL != 0 and TTL is not None:
-            self.set_kv(key, item["Value"], partition=partition, TTL=TTL)
-        return item["Value"]
+            self.set_kv(key, value, partition=partition, TTL=TTL)
+        return value
 
     def set_kv(self, key, value, partition=None, TTL=None):
         now      = self.context["now"]
@@ -423,40 +443,44 @@ class KVTable():
         # Optimize writes to KV table to reduce cost: Only write to the KV
         #   when value is different than in the cache or half-way of 
         #   expiration time
-        if self.table_cache is not None:
-            item = self.get_item(key, partition=partition)
-            if item is not None and "ExpirationTime" in item and item["Value"] == str(value):
-                delta = int(item["ExpirationTime"]) - now_secs
-                if delta > ttl/2:
-                    log.debug(f"KVtable: Optimized write to '{k}' with value '{value}'")
-                    return
-                else:
-                    log.debug(f"KVtable: Key {k} needs refresh (TTL passed mid-life)")
-                    # Fall through...
-
+        with KVTable.lock:
+            if self.table_cache is not None:
+                item = self.get_item(key, partition=partition)
+                if item is not None and "ExpirationTime" in item and item["Value"] == str(value):
+                    delta = int(item["ExpirationTime"]) - now_secs
+                    if delta > ttl/2:
+                        log.debug(f"KVtable: Optimized write to '{k}' with value '{value}'")
+                        return
+                    else:
+                        log.debug(f"KVtable: Key {k} needs refresh (TTL passed mid-life)")
+                        # Fall through...
+
+        # The DynamoDB write is performed outside of the lock so concurrent Main stages do not wait for each other I/Os
         if not self.is_aggregated_key(k):
             KVTable.set_kv_direct(k, value, self.table_name, TTL=ttl, context=self.context)
 
         # Update cache
-        if self.table_cache is None: # KV_Table not yet initialized
-            return
-        expiration_time = now_secs + ttl
-        new_item = {
-                "Key": k,
-                "Value": str(value),
-                "ExpirationTime": int(expiration_time)
-            }
+        with KVTable.lock:
+            if self.table_cache is None: # KV_Table not yet initialized
+                return
+            expiration_time = now_secs + ttl
+            new_item = {
+                    "Key": k,
+                    "Value": str(value),
+                    "ExpirationTime": int(expiration_time)
+                }
 
-        if item is not None:
-            if str(value) == "":
-                self.table_cache.remove(item)
+            item = self.get_item(key, partition=partition)
+            if item is not None:
+                if str(value) == "":
+                    self.table_cache.remove(item)
+                else:
+                    item.update(new_item)
             else:
-                item.update(new_item)
-        else:
-            self.table_cache.append(new_item)
+                self.table_cache.append(new_item)
 
-        # Rebuild the dict representation
-        self._build_dict()
+            # Rebuild the dict representation
+            self._build_dict()
 
     def export_to_s3(self, url, suffix, prefix="", athena_search_format=False):
         account_id = self.context["ACCOUNT_ID"]
@@ -189,6 +189,16 @@ class ManagedTargetGroup:
             return None
         return h
 
+    def get_instance_ids_in_targetgroup(self, targetgroup):
+        """ Return the set of instance ids registered in a target group (whatever their health state).
+
+        Set based equivalent of is_instance_registered(): When 'targetgroup' is None, the first target group is used.
+        """
+        t = next(filter(lambda target: targetgroup is None or target["TargetGroupArn"] == targetgroup, self.targetgroups), None)
+        if t is None:
+            return set()
+        return set(target["Target"]["Id"] for target in t["TargetHealthDescriptions"])
+
     def get_targetgroups(self):
         return self.targetgroups
 
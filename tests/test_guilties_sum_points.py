@@ -0,0 +1,133 @@
+#
+# Golden output tests for EC2_Schedule.get_guilties_sum_points(): Scaling scores computed from recorded alarm and
+#   metric inputs are pinned to detect any unwanted change of the scoring algorithm.
+#
+# Run with: python -m pytest tests/
+#
+import os
+import re
+import sys
+import copy
+from types import SimpleNamespace
+from datetime import datetime, timezone
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import misc
+import ec2_schedule
+from ec2_schedule import EC2_Schedule
+
+NOW         = datetime(2026, 1, 5, 10, 0, 0, tzinfo=timezone.utc)
+NOW_SECS    = misc.seconds_from_epoch_utc(now=NOW)
+GROUP_NAME  = "test"
+
+ALARM_DEFINITIONS = {
+    "00": {"Url": "internal:ec2.scaleup.alarm-cpu-gt-75pc.yaml", "Metadata": {"Points": "1001", "BaselineThreshold": "30.0"}},
+    "01": {"Url": "internal:ec2.scaleup.alarm-memory-gt-66pc.yaml", "Metadata": {}},
+    "02": {"Url": "alarmname:ALB-TargetResponseTime", "Metadata": {"Points": "1001", "BaselineThreshold": "0.200", "Divider": "2"}},
+    "03": {"Url": "alarmname:Queue-Depth-.*", "Metadata": {"Points": "1001", "AlarmGroup": "queues"}},
+}
+
+def instance_alarm(instance_id, index, value, age_secs, state="OK", threshold=75.0, operator="GreaterThanOrEqualToThreshold"):
+    return {
+        "AlarmName": "CloneSquad-%s-%s-%s" % (GROUP_NAME, instance_id, index),
+        "StateValue": state,
+        "Threshold": threshold,
+        "ComparisonOperator": operator,
+        "MetricDetails": {"Values": [value], "_SamplingTime": NOW_SECS - age_secs} if value is not None else None
+    }
+
+def user_alarm(alarm_name, value, age_secs, state="OK", threshold=1.0, operator="GreaterThanOrEqualToThreshold"):
+    a = instance_alarm("x", "00", value, age_secs, state=state, threshold=threshold, operator=operator)
+    a["AlarmName"] = alarm_name
+    return a
+
+# Recorded inputs: (Alarms returned by CloudWatch with their metric, alarms reported in ALARM state by SNS, golden points)
+#   Golden points are the ones computed by the implementation preceding the batched score computation.
+GOLDEN_CASES = {
+    "no_alarm": ([], [], 0),
+    "fleet_below_baseline": ([
+            instance_alarm("i-01", "00", 12.0, 10),
+            instance_alarm("i-02", "00", 25.0, 40),
+            instance_alarm("i-03", "00", 5.0, 80),
+        ], [], 0),
+    "fleet_under_load": ([
+            instance_alarm("i-01", "00", 60.0, 10),
+            instance_alarm("i-02", "00", 70.0, 40),
+            instance_alarm("i-03", "00", 45.0, 80),
+            instance_alarm("i-01", "01", 50.0, 20, threshold=66.0),
+            instance_alarm("i-02", "01", 64.0, 20, threshold=66.0),
+        ], [], 857),
+    "alarm_state_and_metrics": ([
+            instance_alarm("i-01", "00", 90.0, 10, state="ALARM"),
+            instance_alarm("i-02", "00", 55.0, 30),
+            instance_alarm("i-03", "00", 40.0, 60),
+        ], [], 1794),
+    "user_alarms_divider_and_group": ([
+            instance_alarm("i-01", "00", 50.0, 10),
+            instance_alarm("i-02", "00", 50.0, 10),
+            user_alarm("ALB-TargetResponseTime", 0.6, 20, threshold=1.0),
+            user_alarm("Queue-Depth-orders", 800.0, 30, threshold=1000.0),
+            user_alarm("Queue-Depth-invoices", 300.0, 30, threshold=1000.0),
+        ], [], 1091),
+    "reverse_alarm": ([
+            instance_alarm("i-01", "01", 20.0, 10, threshold=10.0, operator="LessThanOrEqualToThreshold"),
+            instance_alarm("i-02", "01", 35.0, 10, threshold=10.0, operator="LessThanOrEqualToThreshold"),
+        ], [], 250),
+    "alarms_without_metric": ([
+            instance_alarm("i-01", "00", 60.0, 10),
+            instance_alarm("i-02", "00", None, 0),
+            instance_alarm("i-03", "00", None, 0, state="ALARM"),
+        ], [], 2335),
+    # An alarm reported in ALARM state that CloudWatch did not return (no alarm data) earns its points
+    #   and is counted as 'no metric yet' (the previous implementation raised a TypeError).
+    "alarm_in_ALARM_without_alarm_data": ([
+            instance_alarm("i-01", "00", 60.0, 10),
+            instance_alarm("i-02", "00", 40.0, 10),
+        ], ["CloneSquad-%s-i-03-00" % GROUP_NAME], 1890),
+}
+
+class FakeCloudWatch:
+    def __init__(self, alarms):
+        self.alarms = []
+        for a in alarms:
+            a = copy.deepcopy(a)
+            details = a.pop("MetricDetails")
+            if details is not None:
+                a["MetricDetails"] = details
+            self.alarms.append(a)
+
+    def get_alarm_names_with_metrics(self):
+        return [a["AlarmName"] for a in self.alarms]
+
+    def get_alarm_data_index(self):
+        return {a["AlarmName"]: a for a in self.alarms}
+
+    def get_metric_index(self):
+        return {a["AlarmName"]: a["MetricDetails"] for a in self.alarms if "MetricDetails" in a}
+
+    def get_alarm_configuration_by_name(self, alarm_name):
+        m = re.match(r"^CloneSquad-%s-(i-[0-9a-z]+)-(\d\d)$" % GROUP_NAME, alarm_name)
+        if m is not None:
+            return {"InstanceId": m.group(1), "AlarmDefinition": ALARM_DEFINITIONS[m.group(2)]}
+        for alarm_def in ALARM_DEFINITIONS.values():
+            if alarm_def["Url"].startswith("alarmname:") and re.match(alarm_def["Url"][len("alarmname:"):], alarm_name):
+                return {"AlarmName": alarm_def["Url"][len("alarmname:"):], "AlarmDefinition": alarm_def}
+        return None
+
+@pytest.fixture(autouse=True)
+def unknown_divider_target(monkeypatch):
+    monkeypatch.setattr(ec2_schedule.Cfg, "get_float",
+            lambda key, fmt=None: {"ec2.schedule.horizontalscale.unknown_divider_target": 0.5}[key])
+
+@pytest.mark.parametrize("case", sorted(GOLDEN_CASES.keys()))
+def test_guilties_sum_points_golden(case):
+    alarms, in_alarm, expected_points = GOLDEN_CASES[case]
+    scheduler = SimpleNamespace(
+            context={"now": NOW},
+            cloudwatch=FakeCloudWatch(alarms),
+            get_useable_instance_count=lambda exclude_initializing_instances=False: 3
+        )
+    assessment = {"upscale": {"guilties": [{"AlarmName": a} for a in in_alarm]}}
+    assert EC2_Schedule.get_guilties_sum_points(scheduler, assessment, 1000) == expected_points
@@ -0,0 +1,81 @@
+#
+# Property tests for EC2.sort_by_balanced_az(): The heap-based implementation must return the same order than the
+#   previous list-based algorithm (embedded below as reference) on randomized fleets.
+#
+# Run with: python -m pytest tests/
+#
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from ec2 import EC2
+
+def reference_sort_by_balanced_az(candidate_instances, ref_instances, smallest_to_biggest_az=True, excluded_instance_ids=None):
+    """ Previous implementation of EC2.sort_by_balanced_az() (before the heap-based selector).
+    """
+    candidate_instances = candidate_instances.copy()
+    ref_azs = {}
+    for i in candidate_instances:
+        az = i["Placement"]["AvailabilityZone"]
+        ref_azs[az] = 0
+    for i in ref_instances:
+        if excluded_instance_ids is not None and i["InstanceId"] in excluded_instance_ids:
+            continue
+        az = i["Placement"]["AvailabilityZone"]
+        ref_azs[az] = 1 if az not in ref_azs else ref_azs[az] + 1
+
+    ref_azs_list = []
+    for az in ref_azs.keys():
+        ref_azs_list.append({
+                "AZ": az,
+                "Count": ref_azs[az]
+            })
+
+    sort_direction = 1 if smallest_to_biggest_az else -1
+
+    optimized_instances = []
+    while len(candidate_instances) > 0:
+        # Sort based on number of instances per AZ
+        ref_azs_list.sort(key=lambda x: sort_direction * x["Count"])
+
+        found_candidate = False
+        for prefered_az in ref_azs_list:
+            for i in candidate_instances:
+                az = i["Placement"]["AvailabilityZone"]
+                if az == prefered_az["AZ"]:
+                    prefered_az["Count"] += sort_direction
+                    optimized_instances.append(i)
+                    candidate_instances.remove(i)
+                    found_candidate = True
+                    break
+            if found_candidate:
+                break
+    return optimized_instances
+
+def random_fleet(rnd, size, azs):
+    return [{
+            "InstanceId": "i-%016x" % rnd.getrandbits(64),
+            "Placement": {"AvailabilityZone": rnd.choice(azs)}
+        } for _ in range(size)]
+
+def test_sort_by_balanced_az_matches_reference():
+    rnd = random.Random(0)
+    for _ in range(2000):
+        azs        = ["eu-west-3%s" % c for c in "abcdef"[:rnd.randint(1, 6)]]
+        candidates = random_fleet(rnd, rnd.randint(0, 30), azs)
+        refs       = random_fleet(rnd, rnd.randint(0, 30), azs + ["eu-west-3z"])
+        excluded   = None
+        if rnd.random() < 0.5 and len(refs):
+            excluded = [i["InstanceId"] for i in rnd.sample(refs, rnd.randint(0, len(refs)))]
+        smallest_to_biggest_az = rnd.random() < 0.5
+
+        expected = reference_sort_by_balanced_az(candidates, refs, smallest_to_biggest_az=smallest_to_biggest_az,
+                excluded_instance_ids=excluded)
+        result   = EC2.sort_by_balanced_az(None, candidates, refs, smallest_to_biggest_az=smallest_to_biggest_az,
+                excluded_instance_ids=excluded)
+        assert [i["InstanceId"] for i in result] == [i["InstanceId"] for i in expected]
+
+if __name__ == "__main__":
+    test_sort_by_balanced_az_matches_reference()
+    print("OK")